@@ -2,10 +2,13 @@ from base64 import b64decode, b64encode
 from datetime import datetime
 import logging
 import os
-from sqlalchemy import Column, ForeignKey, create_engine
+import prometheus_client
+from sqlalchemy import Column, ForeignKey, Index, create_engine, event, \
+    inspect, text
 from sqlalchemy.exc import OperationalError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship, sessionmaker
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.types import Boolean, DateTime, Integer, String, Text
 import time
 
@@ -15,6 +18,24 @@ from .shortid import ShortIDs
 logger = logging.getLogger(__name__)
 
 
+PROM_POOL_SIZE = prometheus_client.Gauge(
+    'db_pool_size',
+    "Number of connections kept in the database pool",
+)
+PROM_POOL_CHECKED_OUT = prometheus_client.Gauge(
+    'db_pool_checked_out',
+    "Database connections in use",
+)
+PROM_POOL_OVERFLOW = prometheus_client.Gauge(
+    'db_pool_overflow',
+    "Database connections open beyond the pool size",
+)
+PROM_POOL_INVALIDATED = prometheus_client.Counter(
+    'db_pool_invalidated_total',
+    "Database connections found broken and discarded",
+)
+
+
 Base = declarative_base()
 
 
@@ -33,6 +54,12 @@ class Experiment(Base):
     last_access = Column(DateTime, nullable=False,
                          default=lambda: datetime.utcnow())
     info = Column(Text, nullable=False)
+    # Status of the image pre-build: None, 'queued', 'building', 'built',
+    # 'error'
+    build_status = Column(Text, nullable=True)
+    # Whether to reuse results of identical runs, None to use the server
+    # default. Should be False for non-deterministic experiments
+    reuse_runs = Column(Boolean, nullable=True)
 
     uploads = relationship('Upload', back_populates='experiment')
     runs = relationship('Run', back_populates='experiment')
@@ -40,9 +67,9 @@ class Experiment(Base):
     paths = relationship('Path', back_populates='experiment')
 
     def __repr__(self):
-        return "<Experiment hash=%r, docker_image=%r>" % (
+        return "<Experiment hash=%r, build_status=%r>" % (
             self.hash,
-            self.docker_image)
+            self.build_status)
 
 
 class Upload(Base):
@@ -135,6 +162,36 @@ class Path(Base):
             self.id, self.experiment_hash, descr, self.name)
 
 
+class Batch(Base):
+    """A group of runs submitted together, for example a parameter sweep.
+    """
+    __tablename__ = 'batches'
+
+    id = Column(Integer, primary_key=True)
+    experiment_hash = Column(String(64), ForeignKey('experiments.hash',
+                                                    ondelete='CASCADE'))
+    experiment = relationship('Experiment', uselist=False)
+    upload_id = Column(Integer, ForeignKey('uploads.id',
+                                           ondelete='RESTRICT'))
+    upload = relationship('Upload', uselist=False)
+    submitted = Column(DateTime, nullable=False,
+                       default=lambda: datetime.utcnow())
+
+    runs = relationship('Run', back_populates='batch')
+
+    @property
+    def short_id(self):
+        return batch_short_ids.encode(self.id)
+
+    @staticmethod
+    def decode_id(short_id):
+        return batch_short_ids.decode(short_id)
+
+    def __repr__(self):
+        return "<Batch id=%d, experiment_hash=%r, submitted=%r>" % (
+            self.id, self.experiment_hash, self.submitted)
+
+
 class Run(Base):
     """A run.
 
@@ -151,16 +208,32 @@ class Run(Base):
     upload_id = Column(Integer, ForeignKey('uploads.id',
                                            ondelete='RESTRICT'))
     upload = relationship('Upload', uselist=False)
+    batch_id = Column(Integer, ForeignKey('batches.id', ondelete='CASCADE'),
+                      nullable=True, index=True)
+    batch = relationship('Batch', uselist=False, back_populates='runs')
     submitted = Column(DateTime, nullable=False,
                        default=lambda: datetime.utcnow())
+    # Runs are queued until the scheduler dispatches them to a runner
+    dispatched = Column(DateTime, nullable=True)
+    priority = Column(Integer, nullable=False, default=0, server_default='0')
     started = Column(DateTime, nullable=True)
     done = Column(DateTime, nullable=True)
+    success = Column(Boolean, nullable=True)
+    # Identifies runs that give the same results, see run.memoize
+    cache_key = Column(String(64), nullable=True, index=True)
+    # Set if the results were copied from a previous run instead of running
+    reused_run_id = Column(Integer, ForeignKey('runs.id',
+                                               ondelete='SET NULL'),
+                           nullable=True)
+    # Kubernetes pod from the warm pool that took the run, or 'pool' while
+    # it is offered to those pods
+    runner_lease = Column(String(253), nullable=True, index=True)
 
     parameter_values = relationship('ParameterValue', back_populates='run')
     input_files = relationship('InputFile', back_populates='run')
     ports = relationship('RunPort', back_populates='run')
 
-    log = relationship('RunLogLine', back_populates='run')
+    log_chunks = relationship('RunLogChunk', back_populates='run')
     output_files = relationship('OutputFile', back_populates='run')
 
     @property
@@ -171,14 +244,13 @@ class Run(Base):
     def decode_id(short_id):
         return run_short_ids.decode(short_id)
 
-    def get_log(self, from_line=0):
-        return [log.line for log in self.log[from_line:]]
-
     def __repr__(self):
         if self.done:
             status = "done"
         elif self.started:
             status = "started"
+        elif self.dispatched:
+            status = "dispatched"
         else:
             status = "submitted"
         return ("<Run id=%d, experiment_hash=%r, %s, %d parameters, "
@@ -187,22 +259,33 @@ class Run(Base):
             len(self.input_files), len(self.output_files))
 
 
-class RunLogLine(Base):
-    """A line of run log.
+class RunLogChunk(Base):
+    """A chunk of run log.
 
-    FIXME: Storing this in the database is not a great idea.
+    The lines themselves are stored compressed in the 'logs' bucket of the
+    object store, this only records which lines are in which object.
     """
-    __tablename__ = 'run_logs'
+    __tablename__ = 'run_log_chunks'
+    __table_args__ = (
+        Index('ix_run_log_chunks_run_id_first_line', 'run_id', 'first_line'),
+    )
 
     id = Column(Integer, primary_key=True)
-    run_id = Column(Integer, ForeignKey('runs.id', ondelete='CASCADE'))
-    run = relationship('Run', uselist=False, back_populates='log')
+    run_id = Column(Integer, ForeignKey('runs.id', ondelete='CASCADE'),
+                    nullable=False)
+    run = relationship('Run', uselist=False, back_populates='log_chunks')
     timestamp = Column(DateTime, nullable=False,
                        default=lambda: datetime.utcnow())
-    line = Column(Text, nullable=False)
+    first_line = Column(Integer, nullable=False)
+    nb_lines = Column(Integer, nullable=False)
+    object_name = Column(Text, nullable=False)
 
     def __repr__(self):
-        return "<RunLogLine id=%d, run_id=%d>" % (self.id, self.run_id)
+        return ("<RunLogChunk id=%d, run_id=%d, lines %d-%d, "
+                "object_name=%r>") % (
+            self.id, self.run_id,
+            self.first_line, self.first_line + self.nb_lines - 1,
+            self.object_name)
 
 
 class ParameterValue(Base):
@@ -279,6 +362,89 @@ class Setting(Base):
     value = Column(Text, nullable=False)
 
 
+# Statements filling in the existing rows when a column is added
+_COLUMN_BACKFILL = {
+    # Runs from before the queue were all started right away, they must not
+    # be picked up by the scheduler
+    ('runs', 'dispatched'): 'UPDATE runs SET dispatched = submitted',
+}
+
+
+def _add_missing_columns(engine):
+    """Add the columns that were added to the models since table creation.
+
+    Those have to be nullable, or have a server default. Missing indexes are
+    created as well.
+    """
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            existing = set(
+                c['name'] for c in inspector.get_columns(table.name)
+            )
+            existing_indexes = set(
+                i['name'] for i in inspector.get_indexes(table.name)
+            )
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                logger.warning("Adding missing column %s.%s",
+                               table.name, column.name)
+                ddl = 'ALTER TABLE %s ADD COLUMN %s %s' % (
+                    table.name, column.name,
+                    column.type.compile(dialect=engine.dialect),
+                )
+                if column.server_default is not None:
+                    ddl += ' DEFAULT %s' % column.server_default.arg
+                conn.execute(text(ddl))
+                backfill = _COLUMN_BACKFILL.get((table.name, column.name))
+                if backfill is not None:
+                    conn.execute(text(backfill))
+            for index in table.indexes:
+                if index.name not in existing_indexes:
+                    logger.warning("Adding missing index %s", index.name)
+                    index.create(bind=conn)
+
+
+def _engine_options(environ=os.environ):
+    """Read the PostgreSQL connection settings from environment variables.
+
+    Returns the keyword arguments for `create_engine()`.
+    """
+    connect_args = {'connect_timeout': 10}
+    # Maximum duration of queries in milliseconds, 0 for no limit
+    statement_timeout = int(environ.get('DB_STATEMENT_TIMEOUT', '0'), 10)
+    if statement_timeout > 0:
+        connect_args['options'] = '-c statement_timeout=%d' % statement_timeout
+    return dict(
+        connect_args=connect_args,
+        # Connections kept open, and how many more can be opened under load
+        pool_size=int(environ.get('DB_POOL_SIZE', '5'), 10),
+        max_overflow=int(environ.get('DB_MAX_OVERFLOW', '10'), 10),
+        # Seconds to wait for a connection when the pool is exhausted
+        pool_timeout=int(environ.get('DB_POOL_TIMEOUT', '30'), 10),
+        # Seconds after which connections are replaced, -1 to keep them
+        pool_recycle=int(environ.get('DB_POOL_RECYCLE', '1800'), 10),
+        # Whether to check connections before using them
+        pool_pre_ping=environ.get('DB_POOL_PRE_PING', '1').lower() not in (
+            '0', 'no', 'false', 'off',
+        ),
+    )
+
+
+def _export_pool_metrics(engine):
+    pool = engine.pool
+    if not isinstance(pool, QueuePool):
+        return
+    PROM_POOL_SIZE.set_function(pool.size)
+    PROM_POOL_CHECKED_OUT.set_function(pool.checkedout)
+    PROM_POOL_OVERFLOW.set_function(lambda: max(0, pool.overflow()))
+
+    @event.listens_for(engine, 'invalidate')
+    def invalidated(dbapi_connection, connection_record, exception):
+        PROM_POOL_INVALIDATED.inc()
+
+
 def purge(url=None):
     Session = connect(url)
 
@@ -298,9 +464,14 @@ def connect(url=None):
             host=os.environ['POSTGRES_HOST'],
             database=os.environ['POSTGRES_DB'],
         )
-        engine = create_engine(url, connect_args={'connect_timeout': 10})
+        engine = create_engine(url, **_engine_options())
+        _export_pool_metrics(engine)
     else:
-        engine = create_engine(url)
+        connect_args = {}
+        if url.startswith('sqlite:'):
+            # The web handlers' sessions are used from multiple threads
+            connect_args['check_same_thread'] = False
+        engine = create_engine(url, connect_args=connect_args)
 
     start = time.perf_counter()
     while True:
@@ -316,11 +487,17 @@ def connect(url=None):
         else:
             break
 
-    tables_exist = engine.dialect.has_table(conn, 'experiments')
+    try:
+        tables_exist = engine.dialect.has_table(conn, 'experiments')
+    finally:
+        conn.close()
 
     if not tables_exist:
         logger.warning("The tables don't seem to exist; creating")
-        Base.metadata.create_all(bind=engine)
+    # Also creates tables that were added since the database was set up
+    Base.metadata.create_all(bind=engine)
+    if tables_exist:
+        _add_missing_columns(engine)
 
     DBSession = sessionmaker(bind=engine)
     db = DBSession()
@@ -336,9 +513,22 @@ def connect(url=None):
         if shortids_salt is None:
             raise RuntimeError("Database exists but no shortids_salt set")
         shortids_salt = b64decode(shortids_salt.value.encode('ascii'))
+    db.close()
 
-    global run_short_ids, upload_short_ids
+    global run_short_ids, upload_short_ids, batch_short_ids
     run_short_ids = ShortIDs(b'run' + shortids_salt)
     upload_short_ids = ShortIDs(b'upload' + shortids_salt)
+    batch_short_ids = ShortIDs(b'batch' + shortids_salt)
 
     return DBSession
+
+
+def dispose(DBSession):
+    """Close the connections of a sessionmaker returned by `connect()`.
+    """
+    db = DBSession()
+    try:
+        engine = db.get_bind()
+    finally:
+        db.close()
+    engine.dispose()
@@ -25,9 +25,11 @@ def main():
         logger.warning("Debug mode is ON")
         asyncio.get_event_loop().set_debug(True)
     app = make_app(debug)
+    # Forms with files are streamed to disk, see MAX_UPLOAD_SIZE; other
+    # request bodies are small
     app.listen(8000, address='0.0.0.0',
                xheaders=True,
-               max_buffer_size=1_073_741_824)
+               max_buffer_size=10_485_760)
 
     loop = tornado.ioloop.IOLoop.current()
     print("\n    reproserver is now running: http://localhost:8000/\n")
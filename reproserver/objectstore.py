@@ -1,15 +1,110 @@
 import asyncio
 import boto3
+from boto3.exceptions import S3UploadFailedError
+from boto3.s3.transfer import TransferConfig
 from botocore.client import Config
 import botocore.exceptions
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
 import io
 import logging
 import os
+import threading
+import time
+import uuid
 
 
 logger = logging.getLogger(__name__)
 
 
+BUCKETS = ('experiments', 'inputs', 'outputs', 'logs')
+
+# Maximum number of connections to the object store
+S3_MAX_POOL_CONNECTIONS = int(
+    os.environ.get('S3_MAX_POOL_CONNECTIONS', '50'),
+    10,
+)
+# Number of threads doing transfers in the background
+S3_TRANSFER_WORKERS = int(os.environ.get('S3_TRANSFER_WORKERS', '16'), 10)
+
+# Whether to use multipart uploads: 'on', 'off', or 'auto' to detect whether
+# the object store supports them
+S3_MULTIPART = os.environ.get('S3_MULTIPART', 'auto').lower()
+# Size from which multipart uploads are used, and size of the parts
+MULTIPART_THRESHOLD = 64 * 1024 ** 2
+MULTIPART_CHUNKSIZE = 16 * 1024 ** 2
+# Error codes meaning that the store doesn't implement multipart uploads
+MULTIPART_UNSUPPORTED_ERRORS = {
+    'NotImplemented', 'NotSupported', 'MethodNotAllowed',
+}
+# Number of parts uploaded concurrently for each upload
+MULTIPART_CONCURRENCY = int(
+    os.environ.get('S3_MULTIPART_CONCURRENCY', '8'),
+    10,
+)
+
+# Number of content-addressed objects remembered as present in the store
+S3_KNOWN_OBJECTS = int(os.environ.get('S3_KNOWN_OBJECTS', '100000'), 10)
+# Size under which hashed streams are read in memory, so that the upload can
+# be skipped if the object exists
+HASHED_BUFFER_SIZE = 8 * 1024 * 1024
+
+# How long presigned URLs are valid for, in seconds
+PRESIGNED_URL_EXPIRY = int(
+    os.environ.get('S3_PRESIGNED_URL_EXPIRY', '3600'),
+    10,
+)
+# Number of presigned URLs kept, for half their lifetime
+PRESIGNED_URL_CACHE_SIZE = 10000
+
+
+class _HashingReader(object):
+    """File object wrapper computing the SHA-256 of what is read.
+    """
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.hasher = sha256()
+        self.size = 0
+
+    def read(self, size=-1):
+        chunk = self.fileobj.read(size)
+        self.hasher.update(chunk)
+        self.size += len(chunk)
+        return chunk
+
+
+class _KeepOpen(object):
+    """File object wrapper that ignores `close()`.
+
+    The transfer manager closes the file it uploads from, even if the upload
+    failed, so this is needed to retry from the same file.
+    """
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+
+    def __getattr__(self, name):
+        return getattr(self.fileobj, name)
+
+    def close(self):
+        pass
+
+
+def _stream_config():
+    # Don't sign or checksum the payload, so it doesn't need to be read
+    # twice; this allows uploading from streams that can't seek
+    kwargs = dict(
+        signature_version='s3v4',
+        s3={'payload_signing_enabled': False},
+        max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+    )
+    try:
+        return Config(request_checksum_calculation='when_required', **kwargs)
+    except TypeError:
+        # Older botocore, doesn't compute checksums by default
+        return Config(**kwargs)
+
+
 def get_object_store():
     logger.info("Logging in to S3")
     return ObjectStore(
@@ -20,13 +115,28 @@ def get_object_store():
 
 
 class ObjectStore(object):
+    """Access to the object store, through the S3 API.
+
+    Methods ending in `_async` run on a dedicated thread pool, so transfers
+    don't compete with other work on the event loop's default executor.
+    """
     def __init__(self, endpoint_url, client_endpoint_url, bucket_prefix):
         self.s3 = boto3.resource(
             's3', endpoint_url=endpoint_url,
             aws_access_key_id=os.environ['S3_KEY'],
             aws_secret_access_key=os.environ['S3_SECRET'],
             region_name='us-east-1',
-            config=Config(signature_version='s3v4'),
+            config=Config(
+                signature_version='s3v4',
+                max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+            ),
+        )
+        self.s3_stream = boto3.client(
+            's3', endpoint_url=endpoint_url,
+            aws_access_key_id=os.environ['S3_KEY'],
+            aws_secret_access_key=os.environ['S3_SECRET'],
+            region_name='us-east-1',
+            config=_stream_config(),
         )
         self.s3_client = boto3.resource(
             's3', endpoint_url=client_endpoint_url,
@@ -36,9 +146,34 @@ class ObjectStore(object):
             config=Config(signature_version='s3v4'),
         )
         self.bucket_prefix = bucket_prefix
+        self.executor = ThreadPoolExecutor(
+            S3_TRANSFER_WORKERS,
+            thread_name_prefix='s3',
+        )
+        self.transfer_config = TransferConfig(
+            multipart_threshold=MULTIPART_THRESHOLD,
+            multipart_chunksize=MULTIPART_CHUNKSIZE,
+            max_concurrency=MULTIPART_CONCURRENCY,
+        )
+        if S3_MULTIPART in ('on', 'off'):
+            self._multipart = S3_MULTIPART == 'on'
+        else:
+            self._multipart = None
+        self._multipart_lock = threading.Lock()
+        self._known_objects = OrderedDict()
+        self._known_objects_lock = threading.Lock()
+        self._presigned_urls = OrderedDict()
+        self._presigned_urls_lock = threading.Lock()
+
+    def _run_async(self, func, *args):
+        return asyncio.get_event_loop().run_in_executor(
+            self.executor,
+            func,
+            *args,
+        )
 
     def bucket_name(self, name):
-        if name not in ('experiments', 'inputs', 'outputs'):
+        if name not in BUCKETS:
             raise ValueError("Invalid bucket name %s" % name)
 
         name = '%s%s' % (self.bucket_prefix, name)
@@ -50,39 +185,256 @@ class ObjectStore(object):
     def download_file(self, bucket, objectname, filename):
         self.bucket(bucket).download_file(objectname, filename)
 
+    def download_fileobj(self, bucket, objectname, fileobj):
+        self.s3.meta.client.download_fileobj(
+            Bucket=self.bucket_name(bucket),
+            Key=objectname,
+            Fileobj=fileobj,
+        )
+
+    def download_bytes(self, bucket, objectname):
+        response = self.s3.meta.client.get_object(
+            Bucket=self.bucket_name(bucket),
+            Key=objectname,
+        )
+        return response['Body'].read()
+
+    def download_bytes_async(self, bucket, objectname):
+        return self._run_async(self.download_bytes, bucket, objectname)
+
+    async def download_many_async(self, bucket, objectnames):
+        return await asyncio.gather(*[
+            self.download_bytes_async(bucket, objectname)
+            for objectname in objectnames
+        ])
+
+    def _remember_object(self, bucket, objectname):
+        with self._known_objects_lock:
+            self._known_objects[(bucket, objectname)] = True
+            self._known_objects.move_to_end((bucket, objectname))
+            while len(self._known_objects) > S3_KNOWN_OBJECTS:
+                self._known_objects.popitem(last=False)
+
+    def has_object(self, bucket, objectname):
+        """Check whether an object exists.
+
+        This is meant for content-addressed objects, which never change once
+        uploaded: objects known to exist are remembered, so they don't need to
+        be checked again.
+        """
+        with self._known_objects_lock:
+            if (bucket, objectname) in self._known_objects:
+                self._known_objects.move_to_end((bucket, objectname))
+                return True
+        try:
+            self.s3.meta.client.head_object(
+                Bucket=self.bucket_name(bucket),
+                Key=objectname,
+            )
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+        self._remember_object(bucket, objectname)
+        return True
+
+    def supports_multipart(self, bucket):
+        """Check whether multipart uploads can be used.
+
+        Multipart uploads don't work on every S3-compatible store (e.g. GCP),
+        so this is detected by starting (and aborting) one, unless
+        S3_MULTIPART is set.
+        """
+        with self._multipart_lock:
+            if self._multipart is None:
+                self._multipart = self._detect_multipart(bucket)
+            return self._multipart
+
+    def _detect_multipart(self, bucket):
+        client = self.s3.meta.client
+        objectname = 'tmp/multipart-check-%s' % uuid.uuid4().hex
+        try:
+            response = client.create_multipart_upload(
+                Bucket=self.bucket_name(bucket),
+                Key=objectname,
+            )
+            client.abort_multipart_upload(
+                Bucket=self.bucket_name(bucket),
+                Key=objectname,
+                UploadId=response['UploadId'],
+            )
+        except botocore.exceptions.ClientError as e:
+            logger.warning("Multipart uploads are not supported: %s", e)
+            return False
+        logger.info("Multipart uploads are supported")
+        return True
+
+    def _multipart_failed(self, error):
+        """Disable multipart uploads if `error` shows they are unsupported.
+
+        Detection might have been wrong, for example if starting multipart
+        uploads works but uploading parts doesn't. Returns False for other
+        errors (network, permissions, throttling), which should be raised.
+        """
+        # The transfer manager might have wrapped the ClientError
+        while (
+            error is not None and
+            not isinstance(error, botocore.exceptions.ClientError)
+        ):
+            error = error.__cause__ or error.__context__
+        if error is None:
+            return False
+        code = error.response.get('Error', {}).get('Code')
+        if code not in MULTIPART_UNSUPPORTED_ERRORS:
+            return False
+        logger.warning("Multipart upload failed, disabling them: %s", error)
+        with self._multipart_lock:
+            if S3_MULTIPART == 'auto':
+                self._multipart = False
+        return True
+
     def upload_fileobj(self, bucket, objectname, fileobj):
-        # s3.Object(...).put(...) and s3.meta.client.upload_file(...) do
-        # multipart uploads which don't work on GCP
+        if self.supports_multipart(bucket):
+            # Uses multiple parts uploaded in parallel if the file is large
+            start = fileobj.tell()
+            try:
+                self.s3.meta.client.upload_fileobj(
+                    _KeepOpen(fileobj),
+                    self.bucket_name(bucket),
+                    objectname,
+                    Config=self.transfer_config,
+                )
+                return
+            except (S3UploadFailedError,
+                    botocore.exceptions.ClientError) as e:
+                if not self._multipart_failed(e):
+                    raise
+                fileobj.seek(start, 0)
+
+        # Single request
         self.s3.meta.client.put_object(
             Bucket=self.bucket_name(bucket),
             Key=objectname,
             Body=fileobj,
         )
 
+    def upload_stream(self, bucket, objectname, fileobj, size):
+        """Upload from a stream that can't seek, whose size is known.
+        """
+        if size >= MULTIPART_THRESHOLD and self.supports_multipart(bucket):
+            # The parts are read in memory, so they can be retried
+            self.s3.meta.client.upload_fileobj(
+                fileobj,
+                self.bucket_name(bucket),
+                objectname,
+                Config=self.transfer_config,
+            )
+            return
+
+        self.s3_stream.put_object(
+            Bucket=self.bucket_name(bucket),
+            Key=objectname,
+            Body=fileobj,
+            ContentLength=size,
+        )
+
+    def upload_fileobj_hashed(self, bucket, fileobj, size):
+        """Upload a stream under its SHA-256, computed while uploading.
+
+        The data is uploaded to a temporary name, then copied to its final
+        name once the hash is known, unless it already exists. Small streams
+        are read in memory instead, and not uploaded at all if the object
+        already exists. Returns the hash.
+        """
+        if size <= HASHED_BUFFER_SIZE:
+            data = fileobj.read(size)
+            if len(data) != size:
+                raise ValueError("Stream ended after %d bytes, expected %d" % (
+                    len(data), size,
+                ))
+            filehash = sha256(data).hexdigest()
+            self.upload_bytes_once(bucket, filehash, data)
+            return filehash
+
+        reader = _HashingReader(fileobj)
+        temp_name = 'tmp/%s' % uuid.uuid4().hex
+        self.upload_stream(bucket, temp_name, reader, size)
+        try:
+            if reader.size != size:
+                raise ValueError("Stream ended after %d bytes, expected %d" % (
+                    reader.size, size,
+                ))
+            filehash = reader.hasher.hexdigest()
+            if not self.has_object(bucket, filehash):
+                self._copy(bucket, temp_name, filehash)
+                self._remember_object(bucket, filehash)
+        finally:
+            self.s3.meta.client.delete_object(
+                Bucket=self.bucket_name(bucket),
+                Key=temp_name,
+            )
+        return filehash
+
+    def _copy(self, bucket, source, objectname):
+        copy_source = {'Bucket': self.bucket_name(bucket), 'Key': source}
+        if self.supports_multipart(bucket):
+            # CopyObject is limited to 5 GB, larger objects are copied in parts
+            self.s3.meta.client.copy(
+                copy_source,
+                self.bucket_name(bucket),
+                objectname,
+                Config=self.transfer_config,
+            )
+        else:
+            self.s3.meta.client.copy_object(
+                Bucket=self.bucket_name(bucket),
+                Key=objectname,
+                CopySource=copy_source,
+            )
+
     def upload_file(self, bucket, objectname, filename):
         with open(filename, 'rb') as fileobj:
             self.upload_fileobj(bucket, objectname, fileobj)
 
     def upload_file_async(self, bucket, objectname, filename):
-        return asyncio.get_event_loop().run_in_executor(
-            None,
-            self.upload_file,
-            bucket, objectname, filename,
-        )
+        return self._run_async(self.upload_file, bucket, objectname, filename)
 
     def upload_bytes(self, bucket, objectname, bytestr):
         self.upload_fileobj(bucket, objectname, io.BytesIO(bytestr))
 
     def upload_bytes_async(self, bucket, objectname, bytestr):
-        return asyncio.get_event_loop().run_in_executor(
-            None,
-            self.upload_bytes,
-            bucket, objectname, bytestr,
+        return self._run_async(self.upload_bytes, bucket, objectname, bytestr)
+
+    def upload_bytes_once(self, bucket, objectname, bytestr):
+        """Upload a content-addressed object, unless it already exists.
+
+        Returns True if it was uploaded.
+        """
+        if self.has_object(bucket, objectname):
+            return False
+        self.upload_bytes(bucket, objectname, bytestr)
+        self._remember_object(bucket, objectname)
+        return True
+
+    def upload_file_once(self, bucket, objectname, filename):
+        """Upload a content-addressed file, unless it already exists.
+
+        Returns True if it was uploaded.
+        """
+        if self.has_object(bucket, objectname):
+            return False
+        self.upload_file(bucket, objectname, filename)
+        self._remember_object(bucket, objectname)
+        return True
+
+    def upload_file_once_async(self, bucket, objectname, filename):
+        return self._run_async(
+            self.upload_file_once, bucket, objectname, filename,
         )
 
     def create_buckets(self):
         missing = []
-        for name in ('experiments', 'inputs', 'outputs'):
+        for name in BUCKETS:
             name = self.bucket_name(name)
             try:
                 self.s3.meta.client.head_bucket(Bucket=name)
@@ -96,11 +448,36 @@ class ObjectStore(object):
                 self.s3.create_bucket(Bucket=name)
 
     def presigned_serve_url(self, bucket, objectname, filename, mime=None):
-        return self.s3_client.meta.client.generate_presigned_url(
+        """Get a URL from which a client can download an object.
+
+        URLs are cached, and reused until they have less than half of their
+        lifetime left.
+        """
+        key = (bucket, objectname, filename, mime)
+        now = time.monotonic()
+        with self._presigned_urls_lock:
+            try:
+                url, expires = self._presigned_urls[key]
+            except KeyError:
+                pass
+            else:
+                if now < expires:
+                    self._presigned_urls.move_to_end(key)
+                    return url
+                del self._presigned_urls[key]
+
+        url = self.s3_client.meta.client.generate_presigned_url(
             ClientMethod='get_object',
             Params={'Bucket': self.bucket_name(bucket),
                     'Key': objectname,
                     'ResponseContentType': mime or 'application/octet-stream',
                     'ResponseContentDisposition': 'inline; filename=%s' %
                                                   filename},
+            ExpiresIn=PRESIGNED_URL_EXPIRY,
         )
+
+        with self._presigned_urls_lock:
+            self._presigned_urls[key] = url, now + PRESIGNED_URL_EXPIRY / 2
+            while len(self._presigned_urls) > PRESIGNED_URL_CACHE_SIZE:
+                self._presigned_urls.popitem(last=False)
+        return url
@@ -193,7 +193,7 @@ def docker_proxy():
     _setup()
 
     # Database connection is not used, but we still need to prime short ids
-    database.connect()
+    database.dispose(database.connect())
 
     proxy = DockerProxyHandler.make_app()
     proxy.listen(8001, address='0.0.0.0', xheaders=True)
@@ -205,7 +205,7 @@ def k8s_proxy():
     _setup()
 
     # Database connection is not used, but we still need to prime short ids
-    database.connect()
+    database.dispose(database.connect())
 
     proxy = K8sProxyHandler.make_app(
         connection_token=os.environ['CONNECTION_TOKEN'],
@@ -1,7 +1,12 @@
 import asyncio
 import logging
 import prometheus_client
-import subprocess
+import threading
+import time
+
+from ..runlogs import write_log_chunk
+from .memoize import reuse_results
+from .scheduler import RunScheduler
 
 
 logger = logging.getLogger(__name__)
@@ -13,20 +18,104 @@ PROM_RUNS = prometheus_client.Gauge(
 )
 
 
-def run_cmd_and_log(session, run_id, cmd, to_db):
-    proc = subprocess.Popen(cmd,
-                            stdin=subprocess.PIPE,
-                            stdout=subprocess.PIPE,
-                            stderr=subprocess.STDOUT)
-    proc.stdin.close()
-    for line in iter(proc.stdout.readline, b''):
-        line = line.decode('utf-8', 'replace')
-        line = line.rstrip()
-        logger.info("> %s", line)
-        if to_db is not None:
-            session.add(to_db(line))
-            session.commit()
-    return proc.wait()
+class RunLogWriter(object):
+    """Writes the log of a run in batches.
+
+    Lines are buffered and written as a single chunk to the object store
+    once `max_lines` have accumulated, or `max_delay` seconds after the first
+    buffered line, whichever comes first. A background thread takes care of
+    the time-based flushes; `close()` does a final flush.
+    """
+    def __init__(self, DBSession, object_store, run_id,
+                 max_lines=500, max_delay=1.0, on_flush=None):
+        self.DBSession = DBSession
+        self.object_store = object_store
+        self.run_id = run_id
+        self.on_flush = on_flush
+        self.next_line = 0
+        self.max_lines = max_lines
+        self.max_delay = max_delay
+        self._buffer = []
+        self._first_buffered = None
+        self.closed = False
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._thread = threading.Thread(
+            target=self._flush_loop,
+            name='log-writer-%d' % run_id,
+            daemon=True,
+        )
+        self._thread.start()
+
+    def write(self, line):
+        with self._lock:
+            if self.closed:
+                raise ValueError("Log writer is closed")
+            if not self._buffer:
+                self._first_buffered = time.perf_counter()
+                self._wakeup.notify()
+            self._buffer.append(line)
+            full = len(self._buffer) >= self.max_lines
+        if full:
+            self.flush()
+
+    __call__ = write
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                lines, self._buffer = self._buffer, []
+                self._first_buffered = None
+            if not lines:
+                return
+            db = self.DBSession()
+            try:
+                write_log_chunk(
+                    db, self.object_store,
+                    self.run_id, self.next_line, lines,
+                )
+                db.commit()
+            finally:
+                db.close()
+            self.next_line += len(lines)
+            if self.on_flush is not None:
+                self.on_flush(self.run_id)
+
+    def _flush_loop(self):
+        while True:
+            with self._lock:
+                if self.closed:
+                    return
+                if self._first_buffered is None:
+                    self._wakeup.wait()
+                    continue
+                delay = (self._first_buffered + self.max_delay -
+                         time.perf_counter())
+                if delay > 0:
+                    self._wakeup.wait(delay)
+                    continue
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Error writing log for run %d", self.run_id)
+
+    def close(self):
+        """Flush remaining lines and stop the background thread.
+        """
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+            self._wakeup.notify()
+        self._thread.join()
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
 
 
 class BaseRunner(object):
@@ -34,10 +123,35 @@ class BaseRunner(object):
 
     This is in charge of taking an experiment and running it, building it first
     if necessary.
+
+    `run_updated` is called with a run ID when its log or status changes, so
+    that watchers can be notified.
+
+    Runs are not started right away, they are queued and started by the
+    `scheduler` once there is capacity. Call `start()` to begin dispatching.
+
+    Queries made from the event loop run on `db_executor` (the loop's default
+    executor if None).
     """
-    def __init__(self, *, DBSession, object_store):
+    def __init__(self, *, DBSession, object_store, run_updated=None,
+                 db_executor=None):
         self.DBSession = DBSession
         self.object_store = object_store
+        self.run_updated = run_updated
+        self.db_executor = db_executor
+        self.scheduler = RunScheduler(
+            DBSession, self._start_run,
+            db_executor=db_executor,
+        )
+
+    def start(self):
+        """Start running the queued runs.
+        """
+        self.scheduler.start()
+
+    def _notify(self, run_id):
+        if self.run_updated is not None:
+            self.run_updated(run_id)
 
     def _run_callback(self, run_id):
         """Provides a callback that marks the Run as completed/failed.
@@ -48,17 +162,65 @@ class BaseRunner(object):
                 logger.info("Run %d successful", run_id)
             except Exception:
                 logger.exception("Exception in run %d", run_id)
+                # The run might not have been updated, e.g. if its image
+                # couldn't be built; don't leave it looking queued
+                self._run_db(
+                    self.scheduler.set_failed, run_id,
+                ).add_done_callback(failed)
             PROM_RUNS.dec()
 
+        def failed(future):
+            try:
+                future.result()
+            except Exception:
+                logger.exception("Error marking run %d as failed", run_id)
+            self._notify(run_id)
+
         return callback
 
+    def _run_db(self, func, *args):
+        """Run a function using the database, on the database thread pool.
+        """
+        return asyncio.get_event_loop().run_in_executor(
+            self.db_executor,
+            func, *args,
+        )
+
     def run(self, run_id):
         """Called to trigger a run. Should not block.
+
+        The run is added to the queue, it will be started by the scheduler.
+        If an identical run already happened, its results are used instead.
+        """
+        future = self._run_db(self._reuse_results, run_id)
+
+        def done(future):
+            if not future.cancelled() and future.result():
+                self._notify(run_id)
+            else:
+                self.scheduler.submit(run_id)
+
+        future.add_done_callback(done)
+        return future
+
+    def _reuse_results(self, run_id):
+        db = self.DBSession()
+        try:
+            return reuse_results(db, run_id)
+        except Exception:
+            logger.exception("Error looking for previous results of run %d",
+                             run_id)
+            return False
+        finally:
+            db.close()
+
+    def _start_run(self, run_id):
+        """Called by the scheduler to start a run, returns a future.
         """
         # Default implementation calls run_sync() in a thread; either method
         # can be overloaded
         future = asyncio.get_event_loop().run_in_executor(
-            None,
+            self.scheduler.executor,
             self.run_sync,
             run_id,
         )
@@ -66,6 +228,12 @@ class BaseRunner(object):
         PROM_RUNS.inc()
         return future
 
+    def prebuild(self, experiment_hash):
+        """Called to build the image of an experiment ahead of its first run.
+
+        This is optional, and should not block.
+        """
+
     def run_sync(self, run_id):
         """Executes the experiment. Overridable in subclasses.
 
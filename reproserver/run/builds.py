@@ -0,0 +1,112 @@
+import contextlib
+import logging
+import prometheus_client
+from sqlalchemy import create_engine, text
+from sqlalchemy.pool import NullPool
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+PROM_BUILD_WAITS = prometheus_client.Counter(
+    'build_waits_total',
+    "Runs that waited for a concurrent build of the same image",
+)
+
+
+class BuildCoordinator(object):
+    """Makes sure a given image is only built once at a time.
+
+    Threads in this process building the same image wait on a shared lock.
+    If the database is PostgreSQL, an advisory lock is also available, so
+    that runners in other processes (e.g. other pods) can wait too.
+    """
+    def __init__(self, DBSession=None):
+        self.DBSession = DBSession
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+        self._lock_engine = None
+
+    @contextlib.contextmanager
+    def local_lock(self, key):
+        """Lock `key` for the threads of this process.
+        """
+        with self._locks_lock:
+            lock, users = self._locks.get(key, (None, 0))
+            if lock is None:
+                lock = threading.Lock()
+            self._locks[key] = lock, users + 1
+        try:
+            if not lock.acquire(blocking=False):
+                logger.info("Waiting for concurrent build of %s", key)
+                PROM_BUILD_WAITS.inc()
+                lock.acquire()
+            try:
+                yield
+            finally:
+                lock.release()
+        finally:
+            with self._locks_lock:
+                lock, users = self._locks[key]
+                if users == 1:
+                    del self._locks[key]
+                else:
+                    self._locks[key] = lock, users - 1
+
+    def _get_lock_engine(self):
+        with self._locks_lock:
+            if self._lock_engine is None:
+                db = self.DBSession()
+                try:
+                    engine = db.get_bind()
+                finally:
+                    db.close()
+                if engine.dialect.name != 'postgresql':
+                    self._lock_engine = False
+                else:
+                    # A lock is held for a whole build, so its connection
+                    # doesn't come from the pool, and is not in a transaction
+                    self._lock_engine = create_engine(
+                        engine.url,
+                        poolclass=NullPool,
+                        isolation_level='AUTOCOMMIT',
+                    )
+            return self._lock_engine
+
+    def global_lock(self, key):
+        """Lock `key` across processes, blocking until it is available.
+
+        Returns a function that releases the lock. If the database doesn't
+        support it, this does nothing.
+        """
+        if self.DBSession is None:
+            return lambda: None
+        engine = self._get_lock_engine()
+        if not engine:
+            return lambda: None
+
+        # Advisory locks use a 64-bit key
+        lock_key = int(key[:15], 16)
+        conn = engine.connect()
+        try:
+            # Waiting for the lock is not a slow query, don't time it out
+            conn.execute(text('SET statement_timeout = 0'))
+            conn.execute(
+                text('SELECT pg_advisory_lock(:key)'),
+                {'key': lock_key},
+            )
+        except BaseException:
+            conn.close()
+            raise
+
+        def release():
+            try:
+                conn.execute(
+                    text('SELECT pg_advisory_unlock(:key)'),
+                    {'key': lock_key},
+                )
+            finally:
+                conn.close()
+
+        return release
@@ -0,0 +1,145 @@
+import contextlib
+import fcntl
+import logging
+import os
+import prometheus_client
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+PROM_CACHE = prometheus_client.Counter(
+    'package_cache_requests_total',
+    "Requests to the local package cache",
+    ['result'],
+)
+PROM_CACHE.labels('hit').inc(0)
+PROM_CACHE.labels('miss').inc(0)
+PROM_CACHE_SIZE = prometheus_client.Gauge(
+    'package_cache_bytes',
+    "Size of the local package cache",
+)
+
+
+@contextlib.contextmanager
+def _flock(path, operation):
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, operation)
+        yield fd
+    finally:
+        os.close(fd)
+
+
+class PackageCache(object):
+    """Local cache of experiment packages, keyed by hash.
+
+    This can be shared by all the runs on a machine, even from different
+    processes. When the total size goes over `max_bytes`, the least recently
+    used packages are removed. Packages that are in use (locked) are never
+    removed.
+    """
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    @classmethod
+    def from_environ(cls):
+        """Create a cache from the environment, or return None.
+        """
+        directory = os.environ.get('PACKAGE_CACHE_DIR')
+        if not directory:
+            return None
+        max_bytes = int(os.environ.get('PACKAGE_CACHE_SIZE', 10 * 1024 ** 3))
+        logger.info("Using package cache %s, %d bytes", directory, max_bytes)
+        return cls(directory, max_bytes)
+
+    def _path(self, filehash):
+        if not filehash or any(c not in '0123456789abcdef' for c in filehash):
+            raise ValueError("Invalid hash %r" % filehash)
+        return os.path.join(self.directory, filehash)
+
+    @contextlib.contextmanager
+    def get(self, filehash, download):
+        """Get a package, using `download(path)` to fetch it if necessary.
+
+        This is a context manager, the package will not be removed from the
+        cache until it exits.
+        """
+        path = self._path(filehash)
+        while True:
+            if not os.path.exists(path):
+                self._download(path, download)
+            else:
+                PROM_CACHE.labels('hit').inc()
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except FileNotFoundError:
+                # Evicted in the meantime
+                continue
+            try:
+                fcntl.flock(fd, fcntl.LOCK_SH)
+                if os.fstat(fd).st_nlink == 0:
+                    # Evicted in the meantime
+                    continue
+                # Update modification time, used for LRU
+                os.utime(fd)
+                self._evict()
+                yield path
+                return
+            finally:
+                os.close(fd)
+
+    def _download(self, path, download):
+        # Lock so that the same package is not downloaded multiple times
+        with _flock(path + '.lock', fcntl.LOCK_EX):
+            if os.path.exists(path):
+                PROM_CACHE.labels('hit').inc()
+                return
+            PROM_CACHE.labels('miss').inc()
+            temp = '%s.%d-%d.tmp' % (path, os.getpid(), threading.get_ident())
+            try:
+                download(temp)
+                os.rename(temp, path)
+            except BaseException:
+                if os.path.exists(temp):
+                    os.remove(temp)
+                raise
+        logger.info("Added package to cache: %s, %d bytes",
+                    os.path.basename(path), os.stat(path).st_size)
+
+    def _evict(self):
+        with _flock(os.path.join(self.directory, '.lock'), fcntl.LOCK_EX):
+            entries = []
+            total = 0
+            for name in os.listdir(self.directory):
+                if name.startswith('.') or name.endswith(('.lock', '.tmp')):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+                total += stat.st_size
+
+            # Remove least recently used first
+            entries.sort()
+            for mtime, size, name in entries:
+                if total <= self.max_bytes:
+                    break
+                path = os.path.join(self.directory, name)
+                fd = os.open(path, os.O_RDONLY)
+                try:
+                    try:
+                        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        # In use
+                        continue
+                    logger.info("Removing package from cache: %s", name)
+                    os.remove(path)
+                    total -= size
+                finally:
+                    os.close(fd)
+            PROM_CACHE_SIZE.set(total)
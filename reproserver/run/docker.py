@@ -1,15 +1,23 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
 from datetime import datetime
-from hashlib import sha256
 import logging
 import os
-import shutil
 from sqlalchemy.orm import joinedload
 import subprocess
+import tarfile
 import tempfile
+import threading
+import time
 
 from .. import database
+from ..runlogs import delete_log
 from ..utils import shell_escape
-from .base import BaseRunner, run_cmd_and_log
+from .base import BaseRunner, RunLogWriter
+from .builds import BuildCoordinator
+from .cache import PackageCache
+from .dockerapi import DockerClient, DockerError
 
 
 logger = logging.getLogger(__name__)
@@ -18,6 +26,25 @@ logger = logging.getLogger(__name__)
 # IP as understood by Docker daemon, not this container
 DOCKER_REGISTRY = os.environ.get('REGISTRY', 'localhost:5000')
 
+# Number of images pre-built concurrently after upload, 0 to disable
+PREBUILD_WORKERS = int(os.environ.get('PREBUILD_WORKERS', '2'), 10)
+# Number of pre-builds that can be waiting, more are dropped
+PREBUILD_QUEUE_SIZE = int(os.environ.get('PREBUILD_QUEUE_SIZE', '20'), 10)
+
+# Number of input files downloaded at the same time for a run
+INPUT_DOWNLOAD_WORKERS = int(
+    os.environ.get('INPUT_DOWNLOAD_WORKERS', '4'),
+    10,
+)
+# Input files up to this size are kept in memory until added to the archive
+INPUT_SPOOL_SIZE = 8 * 1024 ** 2
+
+# Number of output files uploaded at the same time for a run
+OUTPUT_UPLOAD_WORKERS = int(
+    os.environ.get('OUTPUT_UPLOAD_WORKERS', '4'),
+    10,
+)
+
 
 class DockerRunner(BaseRunner):
     """Docker runner implementation.
@@ -34,6 +61,333 @@ class DockerRunner(BaseRunner):
             '0.0.0.0',  # Accept connections to proxy from everywhere
         )
 
+    def __init__(self, **kwargs):
+        super(DockerRunner, self).__init__(**kwargs)
+        self.docker = DockerClient.from_environ()
+        self.package_cache = PackageCache.from_environ()
+        self._known_images = set()
+        self._known_images_lock = threading.Lock()
+        self.build_coordinator = BuildCoordinator(self.DBSession)
+        self._prebuild_executor = None
+        self._prebuild_slots = threading.BoundedSemaphore(PREBUILD_QUEUE_SIZE)
+
+    def prebuild(self, experiment_hash):
+        if PREBUILD_WORKERS <= 0:
+            return None
+        if not self._prebuild_slots.acquire(blocking=False):
+            logger.warning("Pre-build queue is full, not building %s",
+                           experiment_hash)
+            return None
+        if self._prebuild_executor is None:
+            self._prebuild_executor = ThreadPoolExecutor(
+                PREBUILD_WORKERS,
+                thread_name_prefix='prebuild',
+            )
+        loop = asyncio.get_event_loop()
+
+        async def prebuild():
+            try:
+                await self._run_db(
+                    self._set_build_status, experiment_hash, 'queued',
+                )
+                await loop.run_in_executor(
+                    self._prebuild_executor,
+                    self._prebuild_sync, experiment_hash,
+                )
+            except Exception:
+                logger.exception("Error pre-building image for %s",
+                                 experiment_hash)
+            finally:
+                self._prebuild_slots.release()
+
+        return asyncio.ensure_future(prebuild())
+
+    def _prebuild_sync(self, experiment_hash):
+        logger.info("Pre-building image for %s", experiment_hash)
+        self._set_build_status(experiment_hash, 'building')
+        try:
+            push_process = self._get_image(experiment_hash)
+            if push_process is not None:
+                push_process.wait()
+                if push_process.returncode != 0:
+                    raise ValueError("Error: docker push returned %d" %
+                                     push_process.returncode)
+        except Exception:
+            logger.exception("Error pre-building image for %s",
+                             experiment_hash)
+            self._set_build_status(experiment_hash, 'error')
+        else:
+            logger.info("Pre-built image for %s", experiment_hash)
+            self._set_build_status(experiment_hash, 'built')
+
+    def _set_build_status(self, experiment_hash, status, expected=None):
+        """Set the build status of an experiment.
+
+        If `expected` is given, the status is only changed if it currently is
+        one of those values.
+        """
+        db = self.DBSession()
+        try:
+            query = (
+                db.query(database.Experiment)
+                .filter(database.Experiment.hash == experiment_hash)
+            )
+            if expected is not None:
+                query = query.filter(
+                    database.Experiment.build_status.in_(expected),
+                )
+            query.update({'build_status': status}, synchronize_session=False)
+            db.commit()
+        finally:
+            db.close()
+
+    @contextlib.contextmanager
+    def _get_package(self, experiment_hash, directory):
+        """Get the experiment file, from the local cache if possible.
+        """
+        def download(local_path):
+            logger.info("Downloading file...")
+            self.object_store.download_file(
+                'experiments', experiment_hash,
+                local_path,
+            )
+            logger.info("Got file, %d bytes", os.stat(local_path).st_size)
+
+        if self.package_cache is not None:
+            with self.package_cache.get(experiment_hash, download) as path:
+                yield path
+        else:
+            local_path = os.path.join(directory, 'experiment.rpz')
+            download(local_path)
+            yield local_path
+
+    def _image_name(self, experiment_hash):
+        return '%s/%s' % (
+            DOCKER_REGISTRY,
+            'rpuz_exp_%s' % experiment_hash,
+        )
+
+    def _get_image(self, experiment_hash):
+        """Make sure the image for an experiment is available locally.
+
+        Images are looked for in the local Docker daemon first, then pulled
+        from the registry, and built if all else fails. Images known to be
+        present are remembered, to skip those steps on the next run.
+
+        Only one build of a given image happens at a time; other runs wait
+        for it to be built (in this process) or pushed (in other processes).
+
+        Returns the `docker push` process if the image was built, or None.
+        """
+        fq_image_name = self._image_name(experiment_hash)
+        logger.info("Image name: %s", fq_image_name)
+        if self._image_present(fq_image_name):
+            logger.info("Image is present locally")
+            return None
+
+        # Only build once, concurrent runs of the same experiment wait here
+        with self.build_coordinator.local_lock(experiment_hash):
+            # It might have been built while we waited
+            if self._image_present(fq_image_name):
+                logger.info("Image was built by a concurrent run")
+                return None
+
+            release = self.build_coordinator.global_lock(experiment_hash)
+            try:
+                try:
+                    self.docker.image_pull(fq_image_name)
+                    pulled = True
+                except DockerError as e:
+                    logger.info("Couldn't get image from cache: %s", e)
+                    pulled = False
+                if pulled:
+                    push_process = None
+                else:
+                    logger.info("Building image")
+                    self._build_image(experiment_hash, fq_image_name)
+                    logger.info("Build over, pushing image")
+
+                    # Push image to Docker repository in the background
+                    push_process = subprocess.Popen(
+                        ['docker', 'push', fq_image_name],
+                    )
+            except BaseException:
+                release()
+                raise
+            self._add_known_image(fq_image_name)
+
+        if push_process is None:
+            logger.info("Pulled image from cache")
+            release()
+            return None
+
+        # Other processes waiting on the lock will pull the image, so only
+        # release it once it is pushed
+        def release_after_push():
+            try:
+                push_process.wait()
+            finally:
+                release()
+
+        threading.Thread(target=release_after_push, daemon=True).start()
+
+        return push_process
+
+    def _image_present(self, fq_image_name):
+        with self._known_images_lock:
+            if fq_image_name in self._known_images:
+                return True
+
+        try:
+            present = self.docker.image_inspect(fq_image_name) is not None
+        except (DockerError, OSError):
+            logger.exception("Error checking for image %s", fq_image_name)
+            return False
+        if present:
+            self._add_known_image(fq_image_name)
+        return present
+
+    def _build_image(self, experiment_hash, fq_image_name):
+        with contextlib.ExitStack() as stack:
+            directory = stack.enter_context(tempfile.TemporaryDirectory())
+            build_dir = os.path.join(directory, 'build_dir')
+
+            # Get experiment file
+            local_path = stack.enter_context(self._get_package(
+                experiment_hash,
+                directory,
+            ))
+
+            # Build image
+            ret = subprocess.call([
+                'reprounzip', '-v', 'docker', 'setup',
+                # `RUN --mount` doesn't work with userns-remap
+                '--dont-use-buildkit',
+                '--image-name', fq_image_name,
+                local_path, build_dir,
+            ])
+            if ret != 0:
+                raise ValueError("Error: Docker returned %d" % ret)
+
+    def _add_known_image(self, fq_image_name):
+        with self._known_images_lock:
+            self._known_images.add(fq_image_name)
+
+    def _forget_image(self, fq_image_name):
+        with self._known_images_lock:
+            self._known_images.discard(fq_image_name)
+
+    def _download_input(self, input_file):
+        fp = tempfile.SpooledTemporaryFile(INPUT_SPOOL_SIZE)
+        try:
+            self.object_store.download_fileobj('inputs', input_file.hash, fp)
+            fp.seek(0, 0)
+        except BaseException:
+            fp.close()
+            raise
+        logger.info("Downloaded input file: %s, %s, %d bytes",
+                    input_file.name, input_file.hash, input_file.size)
+        return fp
+
+    def _input_archive(self, inputs):
+        """Generate a tar archive of the input files, as chunks of bytes.
+
+        `inputs` is a list of (InputFile, path). Files are downloaded
+        concurrently, and added to the archive in order.
+        """
+        executor = ThreadPoolExecutor(
+            INPUT_DOWNLOAD_WORKERS,
+            thread_name_prefix='input',
+        )
+        futures = [
+            executor.submit(self._download_input, input_file)
+            for input_file, path in inputs
+        ]
+        try:
+            for (input_file, path), future in zip(inputs, futures):
+                with future.result() as fp:
+                    fp.seek(0, 2)
+                    size = fp.tell()
+                    fp.seek(0, 0)
+
+                    info = tarfile.TarInfo(path.lstrip('/'))
+                    info.size = size
+                    info.mode = 0o644
+                    info.mtime = time.time()
+                    yield info.tobuf(tarfile.PAX_FORMAT)
+
+                    chunk = fp.read(1024 * 1024)
+                    while chunk:
+                        yield chunk
+                        chunk = fp.read(1024 * 1024)
+                    if size % tarfile.BLOCKSIZE:
+                        yield tarfile.NUL * (
+                            tarfile.BLOCKSIZE - size % tarfile.BLOCKSIZE
+                        )
+
+            # End of archive
+            yield tarfile.NUL * (2 * tarfile.BLOCKSIZE)
+        finally:
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=True)
+            # Close the files that were downloaded but not used
+            for future in futures:
+                if future.done() and not future.cancelled():
+                    try:
+                        future.result().close()
+                    except Exception:
+                        pass
+
+    def _upload_output(self, container, path):
+        """Upload an output file from a container to the object store.
+
+        The file is streamed from the container and hashed as it is uploaded.
+        Returns the hash and size, or None if the path doesn't exist or is
+        not a file.
+        """
+        try:
+            response = self.docker.get_archive(container, path.path)
+        except DockerError as e:
+            logger.info("Can't get %s from container: %s", path.path, e)
+            return None
+        with response:
+            # The archive contains the file under its base name
+            with tarfile.open(fileobj=response, mode='r|') as tar:
+                member = tar.next()
+                if member is None or not member.isfile():
+                    return None
+                logger.info("Uploading output file %s, size: %d bytes",
+                            path.name, member.size)
+                filehash = self.object_store.upload_fileobj_hashed(
+                    'outputs',
+                    tar.extractfile(member),
+                    member.size,
+                )
+                return filehash, member.size
+
+    def _upload_outputs(self, container, paths):
+        """Upload the output files from a container, concurrently.
+
+        Returns a list of (Path, hash, size) for each file that was found.
+        """
+        results = []
+        with ThreadPoolExecutor(
+            OUTPUT_UPLOAD_WORKERS,
+            thread_name_prefix='output',
+        ) as executor:
+            futures = [
+                (path, executor.submit(self._upload_output, container, path))
+                for path in paths
+            ]
+            for path, future in futures:
+                result = future.result()
+                if result is None:
+                    results.append((path, None, None))
+                else:
+                    results.append((path,) + result)
+        return results
+
     def _docker_run(self, run_id, bind_host):
         """Pull or build an image, then run it.
 
@@ -62,52 +416,22 @@ class DockerRunner(BaseRunner):
             raise KeyError("Unknown run %r", run_id)
 
         # Get or build the Docker image
-        push_process = None
-        fq_image_name = '%s/%s' % (
-            DOCKER_REGISTRY,
-            'rpuz_exp_%s' % run.experiment.hash,
-        )
-        logger.info("Image name: %s", fq_image_name)
-        ret = subprocess.call(['docker', 'pull', fq_image_name])
-        if ret == 0:
-            logger.info("Pulled image from cache")
-        else:
-            logger.info("Couldn't get image from cache, building")
-            with tempfile.TemporaryDirectory() as directory:
-                # Get experiment file
-                logger.info("Downloading file...")
-                local_path = os.path.join(directory, 'experiment.rpz')
-                build_dir = os.path.join(directory, 'build_dir')
-                self.object_store.download_file(
-                    'experiments', run.experiment.hash,
-                    local_path,
-                )
-                logger.info("Got file, %d bytes", os.stat(local_path).st_size)
-
-                # Build image
-                ret = subprocess.call([
-                    'reprounzip', '-v', 'docker', 'setup',
-                    # `RUN --mount` doesn't work with userns-remap
-                    '--dont-use-buildkit',
-                    '--image-name', fq_image_name,
-                    local_path, build_dir,
-                ])
-                if ret != 0:
-                    raise ValueError("Error: Docker returned %d" % ret)
-            logger.info("Build over, pushing image")
-
-            # Push image to Docker repository in the background
-            push_process = subprocess.Popen(['docker', 'push', fq_image_name])
+        fq_image_name = self._image_name(run.experiment.hash)
+        push_process = self._get_image(run.experiment.hash)
+        run.experiment.build_status = 'built'
 
         # Remove previous info
-        run.log[:] = []
+        delete_log(db, run.id)
         run.output_files[:] = []
 
-        # Make build directory
-        directory = tempfile.mkdtemp('build_%s' % run.experiment_hash)
-
         container = None
 
+        # Log is written to the database in batches
+        log = RunLogWriter(
+            self.DBSession, self.object_store, run.id,
+            on_flush=self._notify,
+        )
+
         try:
             # Get list of parameters
             params = {}
@@ -159,52 +483,32 @@ class DockerRunner(BaseRunner):
                 container, fq_image_name,
             )
             # Turn parameters into a command-line
-            cmdline = [
-                'docker', 'create', '-i', '--name', container,
-            ]
-            for port in run.ports:
-                cmdline.extend([
-                    '-p', '{0}:{1}:{1}'.format(bind_host, port.port_number),
-                ])
-            cmdline.extend([
-                '--', fq_image_name,
-            ])
+            cmdline = []
             for k, v in sorted(params.items()):
                 if k.startswith('cmdline_'):
                     i = str(int(k[8:], 10))
                     cmdline.extend(['cmd', v, 'run', i])
             logger.info('$ %s', ' '.join(shell_escape(a) for a in cmdline))
-            subprocess.check_call(cmdline)
-
-            for input_file, path in inputs:
-                local_path = os.path.join(
-                    directory,
-                    'input_%s' % input_file.hash,
-                )
-
-                # Download file from S3
-                logger.info(
-                    "Downloading input file: %s, %s, %d bytes",
-                    input_file.name, input_file.hash, input_file.size,
+            try:
+                self.docker.container_create(
+                    container, fq_image_name, cmdline,
+                    ports=[port.port_number for port in run.ports],
+                    bind_host=bind_host,
                 )
-                self.object_store.download_file(
-                    'inputs', input_file.hash,
-                    local_path,
+            except DockerError:
+                # The image might have been removed from the daemon
+                self._forget_image(fq_image_name)
+                raise
+
+            # Put input files in container, as a single tar archive extracted
+            # at the root
+            if inputs:
+                logger.info("Copying input files to container")
+                self.docker.put_archive(
+                    container, '/',
+                    self._input_archive(inputs),
                 )
 
-                # Put file in container
-                logger.info("Copying file to container")
-                subprocess.check_call(
-                    [
-                        'docker', 'cp', '--',
-                        local_path,
-                        '%s:%s' % (container, path),
-                    ],
-                )
-
-                # Remove local file
-                os.remove(local_path)
-
             # Update status in database
             logger.info("Starting container")
             if run.started:
@@ -212,17 +516,15 @@ class DockerRunner(BaseRunner):
             else:
                 run.started = datetime.utcnow()
                 db.commit()
+                self._notify(run.id)
 
             # Start container using parameters
             try:
-                ret = run_cmd_and_log(
-                    db,
-                    run.id,
-                    ['docker', 'start', '-ai', '--', container],
-                    to_db=lambda l, run_id=run.id: (
-                        database.RunLogLine(run_id=run_id, line=l)
-                    ),
-                )
+                self.docker.container_start(container)
+                for line in self.docker.container_logs(container):
+                    logger.info("> %s", line)
+                    log.write(line)
+                ret = self.docker.container_wait(container)
             except IOError:
                 raise ValueError("Got IOError running experiment")
             if ret != 0:
@@ -231,74 +533,47 @@ class DockerRunner(BaseRunner):
             run.done = datetime.utcnow()
 
             # Get output files
-            for path in run.experiment.paths:
-                if path.is_output:
-                    local_path = os.path.join(
-                        directory,
-                        'output_%s' % path.name,
-                    )
-
-                    # Copy file out of container
-                    logger.info("Getting output file %s", path.name)
-                    ret = subprocess.call(
-                        [
-                            'docker', 'cp', '--',
-                            '%s:%s' % (container, path.path),
-                            local_path,
-                        ],
-                    )
-                    if ret != 0:
-                        logger.warning("Couldn't get output %s", path.name)
-                        db.add(database.RunLogLine(
-                            run_id=run.id,
-                            line="Couldn't get output %s" % path.name,
-                        ))
-                        continue
-
-                    with open(local_path, 'rb') as fp:
-                        # Hash it
-                        hasher = sha256()
-                        chunk = fp.read(4096)
-                        while chunk:
-                            hasher.update(chunk)
-                            chunk = fp.read(4096)
-                        filehash = hasher.hexdigest()
-
-                        # Rewind it
-                        filesize = fp.tell()
-                        fp.seek(0, 0)
-
-                        # Upload file to S3
-                        logger.info("Uploading file, size: %d bytes", filesize)
-                        self.object_store.upload_fileobj(
-                            'outputs', filehash,
-                            fp,
-                        )
-
-                    # Add OutputFile to database
-                    run.output_files.append(database.OutputFile(
-                        hash=filehash,
-                        name=path.name,
-                        size=filesize,
-                    ))
-
-                    # Remove local file
-                    os.remove(local_path)
-
+            outputs = self._upload_outputs(
+                container,
+                [path for path in run.experiment.paths if path.is_output],
+            )
+            for path, filehash, filesize in outputs:
+                if filehash is None:
+                    logger.warning("Couldn't get output %s", path.name)
+                    log.write("Couldn't get output %s" % path.name)
+                    continue
+
+                # Add OutputFile to database
+                run.output_files.append(database.OutputFile(
+                    hash=filehash,
+                    name=path.name,
+                    size=filesize,
+                ))
+
+            log.close()
+            run.success = True
             db.commit()
+            self._notify(run.id)
             logger.info("Done!")
         except Exception as e:
             logger.exception("Error processing run!")
             logger.warning("Got error: %s", str(e))
+            if not log.closed:
+                log.write(str(e))
+            log.close()
             run.done = datetime.utcnow()
-            db.add(database.RunLogLine(run_id=run.id, line=str(e)))
+            run.success = False
             db.commit()
+            self._notify(run.id)
         finally:
+            log.close()
             # Remove container if created
             if container is not None:
-                subprocess.call(['docker', 'rm', '-f', '--', container])
-            # Remove build directory
-            shutil.rmtree(directory)
+                try:
+                    self.docker.container_remove(container)
+                except Exception:
+                    logger.exception("Error removing container %s",
+                                     container)
 
         # Wait for push process to end
         if push_process:
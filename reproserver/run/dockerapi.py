@@ -0,0 +1,258 @@
+import http.client
+import json
+import logging
+import os
+import socket
+import struct
+import urllib.parse
+
+
+logger = logging.getLogger(__name__)
+
+
+class DockerError(Exception):
+    """Error returned by the Docker daemon.
+    """
+    def __init__(self, status, message):
+        super(DockerError, self).__init__(
+            "Docker returned %d: %s" % (status, message),
+        )
+        self.status = status
+        self.message = message
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=None):
+        super(_UnixHTTPConnection, self).__init__('localhost', timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socket_path)
+        except BaseException:
+            sock.close()
+            raise
+        self.sock = sock
+
+
+def _split_image_name(name):
+    # The tag is after the last colon, unless that's part of the registry
+    repo, sep, tag = name.rpartition(':')
+    if not sep or '/' in tag:
+        return name, 'latest'
+    return repo, tag
+
+
+class DockerClient(object):
+    """Client for the Docker Engine API.
+
+    This only implements what the runner needs. Each request uses a new
+    connection, so the client can be used from multiple threads.
+    """
+    API_VERSION = '1.41'
+
+    def __init__(self, base_url, timeout=60):
+        self.timeout = timeout
+        url = urllib.parse.urlparse(base_url)
+        if url.scheme == 'unix':
+            self.socket_path = url.path
+            self.host = None
+        elif url.scheme in ('tcp', 'http'):
+            self.socket_path = None
+            self.host = url.netloc
+        else:
+            raise ValueError("Unsupported Docker host %r" % base_url)
+
+    @classmethod
+    def from_environ(cls):
+        return cls(os.environ.get(
+            'DOCKER_HOST',
+            'unix:///var/run/docker.sock',
+        ))
+
+    def _connection(self, timeout):
+        if self.socket_path is not None:
+            return _UnixHTTPConnection(self.socket_path, timeout=timeout)
+        else:
+            return http.client.HTTPConnection(self.host, timeout=timeout)
+
+    def _request(self, method, path, params=None, body=None, headers=None,
+                 stream=False, timeout=-1):
+        if timeout == -1:
+            timeout = self.timeout
+        url = '/v%s%s' % (self.API_VERSION, path)
+        if params:
+            url += '?' + urllib.parse.urlencode(params)
+        headers = dict(headers or {})
+        # The response owns the connection, closing it closes the socket
+        headers['Connection'] = 'close'
+        # Other bodies (file objects, iterables) are sent with chunked encoding
+        if isinstance(body, dict):
+            body = json.dumps(body).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+
+        conn = self._connection(timeout)
+        try:
+            conn.request(method, url, body=body, headers=headers)
+            response = conn.getresponse()
+        except BaseException:
+            conn.close()
+            raise
+        if response.status >= 400:
+            try:
+                data = response.read()
+            finally:
+                response.close()
+                conn.close()
+            try:
+                message = json.loads(data.decode('utf-8'))['message']
+            except (ValueError, KeyError, TypeError):
+                message = data.decode('utf-8', 'replace')
+            raise DockerError(response.status, message)
+        if stream:
+            return response
+        try:
+            data = response.read()
+        finally:
+            response.close()
+            conn.close()
+        content_type = response.getheader('Content-Type', '')
+        if content_type.startswith('application/json') and data:
+            return json.loads(data.decode('utf-8'))
+        return data
+
+    def ping(self):
+        """Check that the daemon is available.
+        """
+        try:
+            self._request('GET', '/_ping', timeout=10)
+        except (DockerError, OSError):
+            return False
+        return True
+
+    def image_inspect(self, name):
+        """Get information about an image, or None if it doesn't exist.
+        """
+        try:
+            return self._request(
+                'GET',
+                '/images/%s/json' % urllib.parse.quote(name, safe='/:'),
+            )
+        except DockerError as e:
+            if e.status == 404:
+                return None
+            raise
+
+    def image_pull(self, name):
+        """Pull an image from its registry.
+        """
+        repo, tag = _split_image_name(name)
+        response = self._request(
+            'POST', '/images/create',
+            params={'fromImage': repo, 'tag': tag},
+            stream=True, timeout=None,
+        )
+        with response:
+            # Errors are reported in the progress stream
+            for line in response:
+                line = line.strip()
+                if not line:
+                    continue
+                progress = json.loads(line.decode('utf-8'))
+                if 'error' in progress:
+                    raise DockerError(500, progress['error'])
+
+    def container_create(self, name, image, cmd, ports=(), bind_host=None):
+        """Create a container, returns its ID.
+        """
+        config = {
+            'Image': image,
+            'Cmd': list(cmd),
+            'ExposedPorts': {'%d/tcp' % port: {} for port in ports},
+            'HostConfig': {
+                'PortBindings': {
+                    '%d/tcp' % port: [
+                        {'HostIp': bind_host or '', 'HostPort': str(port)},
+                    ]
+                    for port in ports
+                },
+            },
+        }
+        return self._request(
+            'POST', '/containers/create',
+            params={'name': name},
+            body=config,
+        )['Id']
+
+    def container_start(self, container):
+        self._request('POST', '/containers/%s/start' % container)
+
+    def container_logs(self, container, follow=True):
+        """Read the output of a container, as lines.
+
+        If `follow` is True, this keeps going until the container exits.
+        """
+        response = self._request(
+            'GET', '/containers/%s/logs' % container,
+            params={'follow': int(follow), 'stdout': 1, 'stderr': 1},
+            stream=True, timeout=None,
+        )
+        with response:
+            # The stream is multiplexed: each frame has an 8-byte header with
+            # the stream type and length
+            buf = b''
+            while True:
+                header = response.read(8)
+                if len(header) < 8:
+                    break
+                length, = struct.unpack('>xxxxL', header)
+                buf += response.read(length)
+                *lines, buf = buf.split(b'\n')
+                for line in lines:
+                    yield line.decode('utf-8', 'replace').rstrip()
+            if buf:
+                yield buf.decode('utf-8', 'replace').rstrip()
+
+    def container_wait(self, container):
+        """Wait for a container to exit, returns its exit status.
+        """
+        return self._request(
+            'POST', '/containers/%s/wait' % container,
+            timeout=None,
+        )['StatusCode']
+
+    def container_remove(self, container, force=True):
+        try:
+            self._request(
+                'DELETE', '/containers/%s' % container,
+                params={'force': int(force)},
+            )
+        except DockerError as e:
+            if e.status != 404:
+                raise
+
+    def put_archive(self, container, path, data):
+        """Extract a tar archive in a container.
+
+        `data` can be bytes, a file object, or an iterable of bytes.
+        """
+        self._request(
+            'PUT', '/containers/%s/archive' % container,
+            params={'path': path},
+            headers={'Content-Type': 'application/x-tar'},
+            body=data,
+            timeout=None,
+        )
+
+    def get_archive(self, container, path):
+        """Get a path from a container, as a stream of a tar archive.
+
+        The caller should close the returned response.
+        """
+        return self._request(
+            'GET', '/containers/%s/archive' % container,
+            params={'path': path},
+            stream=True, timeout=None,
+        )
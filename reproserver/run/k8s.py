@@ -1,26 +1,170 @@
 import asyncio
-from datetime import datetime
+from datetime import datetime, timezone
 import kubernetes.client as k8s
 import kubernetes.config
 import kubernetes.watch
 import logging
 import os
+import socket
 from sqlalchemy.orm import joinedload
-import subprocess
 import sys
+import threading
 import time
+import uuid
 import yaml
 
 from .. import database
 from ..objectstore import get_object_store
 from ..proxy import ProxyHandler
 from .base import PROM_RUNS
-from .docker import DockerRunner
+from .docker import PREBUILD_WORKERS, DockerRunner
+from .dockerapi import DockerClient
 
 
 logger = logging.getLogger(__name__)
 
 
+# Seconds to keep the pod of a finished run, before deleting it
+POD_CLEANUP_DELAY = 60
+
+# Seconds after which the watch request is made again
+WATCH_TIMEOUT = 300
+
+# Number of idle runner pods kept ready to take runs, 0 to disable
+K8S_WARM_PODS = int(os.environ.get('K8S_WARM_PODS', '0'), 10)
+# Seconds to wait for an idle pod to take a run, before creating a new pod
+WARM_POD_CLAIM_TIMEOUT = 10
+# Seconds between checks for offered runs in idle pods
+WARM_POD_POLL_INTERVAL = 1.0
+# Seconds between checks of the number of idle pods
+WARM_POOL_INTERVAL = 30
+# Seconds after which an idle pod that is still not running is replaced
+WARM_POD_START_TIMEOUT = 300
+
+# Value of Run.runner_lease while the run is offered to idle pods
+LEASE_POOL = 'pool'
+
+
+def _pod_terminated(pod):
+    status = pod.status
+    return bool(
+        status and status.container_statuses and
+        any(c.state.terminated for c in status.container_statuses)
+    )
+
+
+class PodInformer(object):
+    """Follows the pods matching a selector, with a single list and watch.
+
+    A thread lists the pods then watches them, relisting after errors. Events
+    are handled on the event loop, which is where `wait_terminated()` should
+    be called.
+    """
+    def __init__(self, namespace, label_selector, loop=None):
+        self.namespace = namespace
+        self.label_selector = label_selector
+        self.loop = loop or asyncio.get_event_loop()
+        self.synced = False
+        self._pods = {}
+        self._waiters = {}
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run,
+                name='pod-informer',
+                daemon=True,
+            )
+            self._thread.start()
+
+    def pods(self):
+        """Get the current state of all the pods.
+        """
+        return list(self._pods.values())
+
+    def wait_terminated(self, name):
+        """Wait until one of the containers of a pod has terminated.
+
+        Returns a future for the pod, or None if it was deleted or doesn't
+        exist.
+        """
+        future = self.loop.create_future()
+        pod = self._pods.get(name)
+        if pod is not None and _pod_terminated(pod):
+            future.set_result(pod)
+        else:
+            self._waiters.setdefault(name, []).append(
+                (time.monotonic(), future),
+            )
+        return future
+
+    def _resolve(self, name, pod):
+        for _, future in self._waiters.pop(name, []):
+            if not future.done():
+                future.set_result(pod)
+
+    def _run(self):
+        client = k8s.CoreV1Api()
+        while True:
+            try:
+                listed = time.monotonic()
+                pods = client.list_namespaced_pod(
+                    namespace=self.namespace,
+                    label_selector=self.label_selector,
+                )
+                self.loop.call_soon_threadsafe(
+                    self._reset, pods.items, listed,
+                )
+                w = kubernetes.watch.Watch()
+                for event in w.stream(
+                    client.list_namespaced_pod,
+                    namespace=self.namespace,
+                    label_selector=self.label_selector,
+                    resource_version=pods.metadata.resource_version,
+                    timeout_seconds=WATCH_TIMEOUT,
+                ):
+                    self.loop.call_soon_threadsafe(
+                        self._event, event['type'], event['object'],
+                    )
+            except Exception:
+                logger.exception("Error watching pods, listing again")
+                time.sleep(5)
+
+    def _reset(self, pods, listed):
+        self.synced = True
+        old_pods, self._pods = self._pods, {}
+        for pod in pods:
+            self._update(old_pods.get(pod.metadata.name), pod)
+        # Pods that are gone, unless they were created after the list
+        for name, waiters in list(self._waiters.items()):
+            if name not in self._pods and waiters[0][0] < listed:
+                logger.warning("Pod %s is gone", name)
+                self._resolve(name, None)
+
+    def _event(self, event_type, pod):
+        name = pod.metadata.name
+        if event_type == 'DELETED':
+            self._pods.pop(name, None)
+            if name in self._waiters:
+                logger.warning("Pod %s was deleted", name)
+            self._resolve(name, None)
+        else:
+            self._update(self._pods.get(name), pod)
+
+    def _update(self, old_pod, pod):
+        name = pod.metadata.name
+        self._pods[name] = pod
+        if (
+            (old_pod is None or not old_pod.status.start_time) and
+            pod.status.start_time
+        ):
+            logger.info("Pod %s started: %s",
+                        name, pod.status.start_time.isoformat())
+        if _pod_terminated(pod):
+            self._resolve(name, pod)
+
+
 class InternalProxyHandler(ProxyHandler):
     def select_destination(self):
         # Authentication
@@ -60,35 +204,63 @@ class K8sRunner(DockerRunner):
 
         kubernetes.config.load_incluster_config()
 
-        # Find existing run pods
-        client = k8s.CoreV1Api()
+        # Follow the run pods and idle pods, all runs share this single watch
         with open(os.path.join(self.config_dir, 'runner.namespace')) as fp:
             namespace = fp.read().strip()
+        self.informer = PodInformer(namespace, 'app in (run,run-pool)')
+        self.informer.start()
+        self._pool_pending = set()
+        # Runs being offered, and idle pods that took a run but haven't been
+        # relabeled yet
+        self._pool_offers = 0
+        self._pool_claimed = set()
+        if K8S_WARM_PODS > 0:
+            asyncio.get_event_loop().call_later(1, self._maintain_pool)
+
+        # Find existing run pods
+        client = k8s.CoreV1Api()
         pods = client.list_namespaced_pod(
             namespace=namespace,
             label_selector='app=run',
         )
         PROM_RUNS.set(0)
+        db = self.DBSession()
         for pod in pods.items:
             run_id = int(pod.metadata.labels['run'], 10)
             logger.info("Attaching to run pod for %d", run_id)
-            future = asyncio.get_event_loop().run_in_executor(
-                None,
-                self._watch_pod,
-                client, namespace, run_id,
+            future = asyncio.ensure_future(
+                self._watch_pod(run_id, pod.metadata.name),
             )
             future.add_done_callback(self._run_callback(run_id))
             PROM_RUNS.inc()
 
+            # Count it against the concurrency limits
+            run = db.query(database.Run).get(run_id)
+            self.scheduler.attach(
+                run_id,
+                run.experiment_hash if run is not None else None,
+                future,
+            )
+        db.close()
+
     def _pod_name(self, run_id):
         return 'run-{0}'.format(run_id)
 
-    @staticmethod
-    def _run_in_pod(run_id):
-        """Entry point in the runner pod.
+    def _build_pod_name(self, experiment_hash):
+        return 'build-{0}'.format(experiment_hash[:40])
 
-        This function is called on the runner pod that is scheduled by
-        K8sRunner, and will run the rest of the logic.
+    def _load_config(self):
+        """Load the namespace and pod spec from configmap volume.
+        """
+        with open(os.path.join(self.config_dir, 'runner.pod_spec')) as fp:
+            pod_spec = yaml.safe_load(fp)
+        with open(os.path.join(self.config_dir, 'runner.namespace')) as fp:
+            namespace = fp.read().strip()
+        return namespace, pod_spec
+
+    @staticmethod
+    def _setup_pod():
+        """Set up logging and wait for Docker in a pod, returns a runner.
         """
         logging.root.handlers.clear()
         logging.basicConfig(
@@ -97,13 +269,9 @@ class K8sRunner(DockerRunner):
         )
 
         # Wait for Docker to be available
+        docker = DockerClient.from_environ()
         for _ in range(30):
-            ret = subprocess.call(
-                ['docker', 'info'],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-            )
-            if ret == 0:
+            if docker.ping():
                 break
             time.sleep(2)
         else:
@@ -113,13 +281,83 @@ class K8sRunner(DockerRunner):
         # Get a runner from environment
         DBSession = database.connect()
         object_store = get_object_store()
-        runner = DockerRunner(
+        return DockerRunner(
             DBSession=DBSession,
             object_store=object_store,
         )
 
-        # Load run information
+    @staticmethod
+    def _build_in_pod(experiment_hash):
+        """Entry point in the build pod.
+
+        This is called on the pod scheduled by K8sRunner.prebuild(), it
+        builds and pushes the image.
+        """
+        runner = K8sRunner._setup_pod()
+        runner._prebuild_sync(experiment_hash)
+
+    @staticmethod
+    def _run_in_pod(run_id):
+        """Entry point in the runner pod.
+
+        This function is called on the runner pod that is scheduled by
+        K8sRunner, and will run the rest of the logic.
+        """
+        runner = K8sRunner._setup_pod()
+        K8sRunner._execute_in_pod(runner, run_id)
+
+    @staticmethod
+    def _warm_pod():
+        """Entry point in the idle runner pods.
+
+        Once Docker is up, this waits for a run to be offered to the pool,
+        claims it, and runs it like `_run_in_pod()`.
+        """
+        runner = K8sRunner._setup_pod()
+        # The hostname is the pod's name
+        name = socket.gethostname()
+        logger.info("Pod %s waiting for a run", name)
+        while True:
+            run_id = K8sRunner._claim_run(runner.DBSession, name)
+            if run_id is not None:
+                break
+            time.sleep(WARM_POD_POLL_INTERVAL)
+        logger.info("Pod %s took run %d", name, run_id)
+        K8sRunner._execute_in_pod(runner, run_id)
+
+    @staticmethod
+    def _claim_run(DBSession, name):
+        """Claim one of the runs offered to the pool, returns its ID or None.
+        """
         db = DBSession()
+        try:
+            offered = (
+                db.query(database.Run.id)
+                .filter(database.Run.runner_lease == LEASE_POOL)
+                .order_by(database.Run.priority.desc(), database.Run.id)
+                .limit(10)
+            ).all()
+            for run_id, in offered:
+                # Other pods are trying to claim it too
+                claimed = (
+                    db.query(database.Run)
+                    .filter(database.Run.id == run_id)
+                    .filter(database.Run.runner_lease == LEASE_POOL)
+                ).update(
+                    {database.Run.runner_lease: name},
+                    synchronize_session=False,
+                )
+                db.commit()
+                if claimed:
+                    return run_id
+            return None
+        finally:
+            db.close()
+
+    @staticmethod
+    def _execute_in_pod(runner, run_id):
+        # Load run information
+        db = runner.DBSession()
         run = (
             db.query(database.Run)
             .options(joinedload(database.Run.ports))
@@ -151,20 +389,224 @@ class K8sRunner(DockerRunner):
         else:
             logger.info("Kubernetes runner pod complete")
 
-    def run_sync(self, run_id):
+    def _start_run(self, run_id):
         # This does not run the experiment, it schedules a runner pod by
         # talking to the Kubernetes API. That pod will run the experiment and
-        # update the database directly
+        # update the database directly. Waiting for the pod doesn't use a
+        # thread, the informer notifies us
+        future = asyncio.ensure_future(self._run_pod(run_id))
+        future.add_done_callback(self._run_callback(run_id))
+        PROM_RUNS.inc()
+        return future
+
+    async def _run_pod(self, run_id):
+        loop = asyncio.get_event_loop()
+        name = None
+        if K8S_WARM_PODS > 0:
+            name = await self._offer_to_pool(run_id)
+        if name is None:
+            name = self._pod_name(run_id)
+            await loop.run_in_executor(None, self._create_pod, run_id)
+        else:
+            logger.info("Run %d taken by idle pod %s", run_id, name)
+            await loop.run_in_executor(None, self._adopt_pod, run_id, name)
+            self._maintain_pool(reschedule=False)
+        await self._watch_pod(run_id, name)
+
+    def _idle_pods(self):
+        return [
+            pod for pod in self.informer.pods()
+            if pod.metadata.labels.get('app') == 'run-pool'
+        ]
+
+    def _available_idle_pods(self):
+        """Count the idle pods that are ready and haven't taken a run.
+        """
+        return sum(
+            1 for pod in self._idle_pods()
+            if pod.status.phase == 'Running' and
+            not _pod_terminated(pod) and
+            pod.metadata.deletion_timestamp is None and
+            pod.metadata.name not in self._pool_claimed
+        )
 
-        kubernetes.config.load_incluster_config()
+    async def _offer_to_pool(self, run_id):
+        """Offer a run to the idle pods.
 
+        Returns the name of the pod that took it, or None if none did in time.
+        Runs are only offered while there are more available idle pods than
+        runs already on offer, otherwise they would just wait.
+        """
+        if self._pool_offers >= self._available_idle_pods():
+            return None
+
+        self._pool_offers += 1
+        try:
+            name = await self._wait_for_claim(run_id)
+        finally:
+            self._pool_offers -= 1
+        if name is not None:
+            self._pool_claimed.add(name)
+        return name
+
+    async def _wait_for_claim(self, run_id):
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(
+            None,
+            self._set_lease, run_id, LEASE_POOL, None,
+        )
+        deadline = loop.time() + WARM_POD_CLAIM_TIMEOUT
+        while loop.time() < deadline:
+            await asyncio.sleep(0.5)
+            lease = await loop.run_in_executor(None, self._get_lease, run_id)
+            if lease != LEASE_POOL:
+                return lease
+
+        # Take it back, unless a pod claimed it just now
         name = self._pod_name(run_id)
+        if await loop.run_in_executor(
+            None,
+            self._set_lease, run_id, name, LEASE_POOL,
+        ):
+            return None
+        return await loop.run_in_executor(None, self._get_lease, run_id)
 
-        # Load configuration from configmap volume
-        with open(os.path.join(self.config_dir, 'runner.pod_spec')) as fp:
-            pod_spec = yaml.safe_load(fp)
-        with open(os.path.join(self.config_dir, 'runner.namespace')) as fp:
-            namespace = fp.read().strip()
+    def _set_lease(self, run_id, lease, expected):
+        db = self.DBSession()
+        try:
+            updated = (
+                db.query(database.Run)
+                .filter(database.Run.id == run_id)
+                .filter(database.Run.runner_lease.is_(None)
+                        if expected is None
+                        else database.Run.runner_lease == expected)
+            ).update(
+                {database.Run.runner_lease: lease},
+                synchronize_session=False,
+            )
+            db.commit()
+            return updated
+        finally:
+            db.close()
+
+    def _get_lease(self, run_id):
+        db = self.DBSession()
+        try:
+            return (
+                db.query(database.Run.runner_lease)
+                .filter(database.Run.id == run_id)
+            ).scalar()
+        finally:
+            db.close()
+
+    def _maintain_pool(self, reschedule=True):
+        """Create idle pods to keep `K8S_WARM_PODS` of them.
+        """
+        loop = asyncio.get_event_loop()
+        if reschedule:
+            loop.call_later(WARM_POOL_INTERVAL, self._maintain_pool)
+        if not self.informer.synced:
+            return
+
+        alive = set()
+        now = datetime.now(timezone.utc)
+        for pod in self._idle_pods():
+            name = pod.metadata.name
+            created = pod.metadata.creation_timestamp
+            if _pod_terminated(pod):
+                # Idle pods exit only on errors
+                logger.warning("Idle pod %s exited", name)
+                loop.run_in_executor(None, self._delete_idle_pod, name)
+            elif (
+                pod.status.phase != 'Running' and
+                created is not None and
+                (now - created).total_seconds() > WARM_POD_START_TIMEOUT
+            ):
+                # Stuck, e.g. unschedulable or can't pull its image
+                logger.warning("Idle pod %s didn't start (%s), replacing",
+                               name, pod.status.phase)
+                loop.run_in_executor(None, self._delete_idle_pod, name)
+            else:
+                alive.add(name)
+        self._pool_pending -= alive
+        # Claimed pods are no longer idle once they have been relabeled
+        self._pool_claimed &= {pod.metadata.name for pod in self._idle_pods()}
+
+        for _ in range(
+            K8S_WARM_PODS - len(alive) - len(self._pool_pending)
+        ):
+            name = 'run-pool-%s' % uuid.uuid4().hex[:12]
+            self._pool_pending.add(name)
+            future = loop.run_in_executor(
+                None,
+                self._create_idle_pod, name,
+            )
+            future.add_done_callback(self._idle_pod_callback(name))
+
+    def _idle_pod_callback(self, name):
+        def callback(future):
+            try:
+                future.result()
+            except Exception:
+                logger.exception("Error creating idle pod %s", name)
+                self._pool_pending.discard(name)
+
+        return callback
+
+    def _create_idle_pod(self, name):
+        namespace, pod_spec = self._load_config()
+        for container in pod_spec['containers']:
+            if container['name'] == 'runner':
+                container['args'] = [
+                    'python3', '-c',
+                    'from reproserver.run.k8s import K8sRunner; '
+                    'K8sRunner._warm_pod()',
+                ]
+        pod = k8s.V1Pod(
+            api_version='v1',
+            kind='Pod',
+            metadata=k8s.V1ObjectMeta(
+                name=name,
+                labels={
+                    'app': 'run-pool',
+                },
+            ),
+            spec=pod_spec,
+        )
+        k8s.CoreV1Api().create_namespaced_pod(
+            namespace=namespace,
+            body=pod,
+        )
+        logger.info("Idle pod created: %s", name)
+
+    def _delete_idle_pod(self, name):
+        try:
+            k8s.CoreV1Api().delete_namespaced_pod(
+                name=name,
+                namespace=self.informer.namespace,
+            )
+        except k8s.rest.ApiException as e:
+            if e.status != 404:
+                logger.exception("Error deleting pod %s", name)
+
+    def _adopt_pod(self, run_id, name):
+        """Label a pod that took a run like the pods created for runs.
+        """
+        client = k8s.CoreV1Api()
+        client.patch_namespaced_pod(
+            name=name,
+            namespace=self.informer.namespace,
+            body={'metadata': {'labels': {
+                'app': 'run',
+                'run': str(run_id),
+            }}},
+        )
+        self._create_service(client, self.informer.namespace, run_id)
+
+    def _create_pod(self, run_id):
+        name = self._pod_name(run_id)
+
+        namespace, pod_spec = self._load_config()
 
         # Make required changes
         for container in pod_spec['containers']:
@@ -191,7 +633,12 @@ class K8sRunner(DockerRunner):
         )
         logger.info("Pod created: %s", name)
 
-        # Create a service for proxy connections
+        self._create_service(client, namespace, run_id)
+
+    def _create_service(self, client, namespace, run_id):
+        """Create a service for proxy connections.
+        """
+        name = self._pod_name(run_id)
         svc = k8s.V1Service(
             api_version='v1',
             kind='Service',
@@ -221,81 +668,246 @@ class K8sRunner(DockerRunner):
         )
         logger.info("Service created: %s", name)
 
-        self._watch_pod(client, namespace, run_id)
+    def prebuild(self, experiment_hash):
+        if PREBUILD_WORKERS <= 0:
+            return None
+        loop = asyncio.get_event_loop()
+
+        async def prebuild():
+            try:
+                await self._run_db(
+                    self._set_build_status, experiment_hash, 'queued',
+                )
+                await loop.run_in_executor(
+                    None,
+                    self._prebuild_pod, experiment_hash,
+                )
+            except Exception:
+                logger.exception("Error pre-building image for %s",
+                                 experiment_hash)
+
+        return asyncio.ensure_future(prebuild())
+
+    def _prebuild_pod(self, experiment_hash):
+        # Schedules a pod to build the image, waits for it, and deletes it
+        name = self._build_pod_name(experiment_hash)
+        namespace, pod_spec = self._load_config()
+        client = k8s.CoreV1Api()
+        try:
+            for container in pod_spec['containers']:
+                if container['name'] == 'runner':
+                    container['args'] = [
+                        'python3', '-c',
+                        'import sys; '
+                        'from reproserver.run.k8s import K8sRunner; '
+                        'K8sRunner._build_in_pod(sys.argv[1])',
+                        experiment_hash,
+                    ]
+            pod = k8s.V1Pod(
+                api_version='v1',
+                kind='Pod',
+                metadata=k8s.V1ObjectMeta(
+                    name=name,
+                    labels={
+                        'app': 'build',
+                    },
+                ),
+                spec=pod_spec,
+            )
+            try:
+                client.create_namespaced_pod(
+                    namespace=namespace,
+                    body=pod,
+                )
+            except k8s.rest.ApiException as e:
+                if e.status != 409:
+                    raise
+                # Another process started this build, follow it too
+                logger.info("Build pod already exists: %s", name)
+            else:
+                logger.info("Build pod created: %s", name)
+
+                # Limit the number of concurrent builds
+                if not self._build_slot_available(client, namespace, name):
+                    logger.warning("Too many builds already, not building %s",
+                                   experiment_hash)
+                    self._set_build_status(
+                        experiment_hash, None,
+                        expected=('queued',),
+                    )
+                    return
+
+            success = self._wait_for_pod(
+                client, namespace, name,
+                'metadata.name={0}'.format(name),
+                field_selector=True,
+            )
+            if not success:
+                logger.warning("Build of %s failed", experiment_hash)
+                # The build pod sets the status itself if it gets that far
+                self._set_build_status(
+                    experiment_hash, 'error',
+                    expected=('queued', 'building'),
+                )
+        except Exception:
+            logger.exception("Error pre-building image for %s",
+                             experiment_hash)
+            # Allow another attempt
+            self._set_build_status(
+                experiment_hash, None,
+                expected=('queued', 'building'),
+            )
+        finally:
+            try:
+                client.delete_namespaced_pod(
+                    name=name,
+                    namespace=namespace,
+                )
+            except k8s.rest.ApiException as e:
+                if e.status != 404:
+                    logger.exception("Error deleting pod %s", name)
+
+    def _build_slot_available(self, client, namespace, name):
+        """Check whether the new build pod `name` may run.
+
+        This is checked after creating the pod, so that processes creating
+        build pods at the same time agree on which go ahead: the oldest ones.
+        """
+        pods = client.list_namespaced_pod(
+            namespace=namespace,
+            label_selector='app=build',
+        ).items
+        pods = sorted(
+            (
+                pod for pod in pods
+                if pod.metadata.deletion_timestamp is None
+            ),
+            key=lambda pod: (
+                pod.metadata.creation_timestamp,
+                pod.metadata.name,
+            ),
+        )
+        return name in [pod.metadata.name for pod in pods[:PREBUILD_WORKERS]]
 
-    def _watch_pod(self, client, namespace, run_id):
-        name = self._pod_name(run_id)
+    async def _watch_pod(self, run_id, name):
+        """Wait for the pod of a run, and schedule its deletion.
+        """
+        loop = asyncio.get_event_loop()
 
-        w = kubernetes.watch.Watch()
-        f, kwargs = client.list_namespaced_pod, dict(
-            namespace=namespace,
-            label_selector='app=run,run={0}'.format(run_id),
+        pod = await self.informer.wait_terminated(name)
+        if pod is None:
+            success = False
+        else:
+            success = await loop.run_in_executor(
+                None,
+                self._check_pod,
+                k8s.CoreV1Api(), self.informer.namespace, pod,
+            )
+
+        if not success:
+            logger.warning("Run %d failed", run_id)
+            await loop.run_in_executor(None, self._set_run_failed, run_id)
+        self._notify(run_id)
+
+        # Delete the pod and service later, without holding up the run
+        loop.call_later(
+            POD_CLEANUP_DELAY,
+            lambda: loop.run_in_executor(
+                None,
+                self._delete_pod, run_id, name,
+            ),
         )
+
+    def _set_run_failed(self, run_id):
+        db = self.DBSession()
+        try:
+            run = db.query(database.Run).get(run_id)
+            if run is None:
+                logger.warning("Run not in database, can't set status")
+            else:
+                run.done = datetime.utcnow()
+                run.success = False
+                db.commit()
+        finally:
+            db.close()
+
+    def _delete_pod(self, run_id, name):
+        client = k8s.CoreV1Api()
+        try:
+            client.delete_namespaced_pod(
+                name=name,
+                namespace=self.informer.namespace,
+            )
+            client.delete_namespaced_service(
+                name=self._pod_name(run_id),
+                namespace=self.informer.namespace,
+            )
+        except k8s.rest.ApiException as e:
+            if e.status != 404:
+                logger.exception("Error deleting pod %s", name)
+
+    def _wait_for_pod(self, client, namespace, name, selector,
+                      field_selector=False):
+        """Watch a pod until one of its containers terminates.
+
+        Returns True if the runner container succeeded.
+        """
+        w = kubernetes.watch.Watch()
+        f, kwargs = client.list_namespaced_pod, dict(namespace=namespace)
+        if field_selector:
+            kwargs['field_selector'] = selector
+        else:
+            kwargs['label_selector'] = selector
         started = None
         success = False
         for event in w.stream(f, **kwargs):
             if event['type'] == 'DELETED':
                 w.stop()
-                logger.warning("Run pod was deleted")
+                logger.warning("Pod %s was deleted", name)
                 continue
             status = event['object'].status
             if not started and status.start_time:
                 started = status.start_time
-                logger.info("Run pod started: %s", started.isoformat())
-            if (
-                status.container_statuses and
-                any(c.state.terminated for c in status.container_statuses)
-            ):
+                logger.info("Pod %s started: %s", name, started.isoformat())
+            if _pod_terminated(event['object']):
                 w.stop()
+                success = self._check_pod(client, namespace, event['object'])
+        return success
 
-                # Check the status of all containers
-                for container in status.container_statuses:
-                    terminated = container.state.terminated
-                    if terminated:
-                        exit_code = terminated.exit_code
-                        if container.name == 'runner' and exit_code == 0:
-                            logger.info("Run pod succeeded")
-                            success = True
-                        elif exit_code is not None:
-                            # Log any container that exited, including runner
-                            # if status is not zero
-                            log = client.read_namespaced_pod_log(
-                                name,
-                                namespace,
-                                container=container.name,
-                                tail_lines=300,
-                            )
-                            log = '\n'.join(
-                                '    %s' % line
-                                for line in log.splitlines()
-                            )
-                            logger.info(
-                                "Container %s exited with %d\n%s",
-                                container.name,
-                                exit_code,
-                                log,
-                            )
-
-        if not success:
-            logger.warning("Run %d failed", run_id)
-            db = self.DBSession()
-            run = db.query(database.Run).get(run_id)
-            if run is None:
-                logger.warning("Run not in database, can't set status")
-            else:
-                run.done = datetime.utcnow()
-                db.commit()
+    def _check_pod(self, client, namespace, pod):
+        """Check the status of all containers of a terminated pod.
 
-        # Delete the pod and service
-        time.sleep(60)
-        client.delete_namespaced_pod(
-            name=name,
-            namespace=namespace,
-        )
-        client.delete_namespaced_service(
-            name=name,
-            namespace=namespace,
-        )
+        Returns True if the runner container succeeded.
+        """
+        name = pod.metadata.name
+        success = False
+        for container in pod.status.container_statuses:
+            terminated = container.state.terminated
+            if terminated:
+                exit_code = terminated.exit_code
+                if container.name == 'runner' and exit_code == 0:
+                    logger.info("Pod %s succeeded", name)
+                    success = True
+                elif exit_code is not None:
+                    # Log any container that exited, including runner if
+                    # status is not zero
+                    log = client.read_namespaced_pod_log(
+                        name,
+                        namespace,
+                        container=container.name,
+                        tail_lines=300,
+                    )
+                    log = '\n'.join(
+                        '    %s' % line
+                        for line in log.splitlines()
+                    )
+                    logger.info(
+                        "Container %s exited with %d\n%s",
+                        container.name,
+                        exit_code,
+                        log,
+                    )
+        return success
 
 
 Runner = K8sRunner
@@ -0,0 +1,132 @@
+from datetime import datetime
+from hashlib import sha256
+import json
+import logging
+import os
+import prometheus_client
+from sqlalchemy.orm import joinedload
+
+from .. import database
+
+
+logger = logging.getLogger(__name__)
+
+
+PROM_REUSED = prometheus_client.Counter(
+    'run_results_reuse_total',
+    "Lookups of previous results for new runs",
+    ['result'],
+)
+PROM_REUSED.labels('hit').inc(0)
+PROM_REUSED.labels('miss').inc(0)
+
+
+# Whether results of identical runs are reused, unless the experiment says
+# otherwise (Experiment.reuse_runs)
+REUSE_RUNS = os.environ.get('REUSE_RUNS', '').lower() in (
+    'y', 'yes', 'true', 'on', '1',
+)
+
+
+def run_cache_key(run):
+    """Compute the key identifying runs that should give the same results.
+
+    This is computed from the experiment, the values of all the parameters
+    (including defaults), and the input files.
+    """
+    params = {param.name: param.default for param in run.experiment.parameters}
+    for param in run.parameter_values:
+        params[param.name] = param.value
+    inputs = sorted(
+        (input_file.name, input_file.hash)
+        for input_file in run.input_files
+    )
+    key = json.dumps(
+        {
+            'experiment': run.experiment_hash,
+            'parameters': sorted(params.items()),
+            'inputs': inputs,
+        },
+        sort_keys=True,
+    )
+    return sha256(key.encode('utf-8')).hexdigest()
+
+
+def reuse_results(db, run_id):
+    """Complete a new run with the results of an identical previous one.
+
+    The cache key is recorded on the run so it can be reused later. If a
+    previous successful run has the same key, its log and output files are
+    linked to this run, which is marked as done, and True is returned.
+    """
+    exp = joinedload(database.Run.experiment)
+    run = (
+        db.query(database.Run)
+        .options(joinedload(database.Run.parameter_values),
+                 joinedload(database.Run.input_files),
+                 joinedload(database.Run.ports),
+                 exp.joinedload(database.Experiment.parameters))
+    ).get(run_id)
+    if run is None:
+        return False
+    reuse = run.experiment.reuse_runs
+    if reuse is None:
+        reuse = REUSE_RUNS
+    if not reuse:
+        return False
+    # Runs exposing ports are interactive
+    if run.ports:
+        return False
+
+    run.cache_key = run_cache_key(run)
+    db.commit()
+
+    previous = (
+        db.query(database.Run)
+        .options(joinedload(database.Run.log_chunks),
+                 joinedload(database.Run.output_files))
+        .filter(database.Run.cache_key == run.cache_key)
+        .filter(database.Run.success.is_(True))
+        .filter(database.Run.reused_run_id.is_(None))
+        .order_by(database.Run.done.desc())
+    ).first()
+    if previous is None:
+        PROM_REUSED.labels('miss').inc()
+        return False
+
+    # Claim the run, so the scheduler doesn't start it
+    now = datetime.utcnow()
+    claimed = (
+        db.query(database.Run)
+        .filter(database.Run.id == run.id)
+        .filter(database.Run.dispatched.is_(None))
+    ).update(
+        {database.Run.dispatched: now},
+        synchronize_session=False,
+    )
+    if not claimed:
+        db.rollback()
+        return False
+
+    logger.info("Reusing results of run %d for run %d", previous.id, run.id)
+    PROM_REUSED.labels('hit').inc()
+
+    # Log chunks and output files are never modified, they can be shared
+    for chunk in previous.log_chunks:
+        db.add(database.RunLogChunk(
+            run_id=run.id,
+            first_line=chunk.first_line,
+            nb_lines=chunk.nb_lines,
+            object_name=chunk.object_name,
+        ))
+    for output_file in previous.output_files:
+        run.output_files.append(database.OutputFile(
+            hash=output_file.hash,
+            name=output_file.name,
+            size=output_file.size,
+        ))
+    run.reused_run_id = previous.id
+    run.started = run.done = now
+    run.success = True
+    db.commit()
+    return True
@@ -0,0 +1,303 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import logging
+import os
+import prometheus_client
+
+from .. import database
+
+
+logger = logging.getLogger(__name__)
+
+
+PROM_QUEUE_DEPTH = prometheus_client.Gauge(
+    'run_queue_depth',
+    "Runs waiting to be started",
+)
+PROM_QUEUE_WAIT = prometheus_client.Histogram(
+    'run_queue_wait_seconds',
+    "Time runs spent in the queue before being started",
+    buckets=[1.0, 5.0, 15.0, 60.0, 300.0, 900.0, 3600.0, float('inf')],
+)
+PROM_QUEUE_REJECTED = prometheus_client.Counter(
+    'run_queue_rejected_total',
+    "Runs that were refused because the queue was full",
+)
+
+
+# Maximum number of runs happening at the same time, 0 for no limit
+MAX_RUNS = int(os.environ.get('MAX_RUNS', '4'), 10)
+# Maximum number of runs of the same experiment happening at the same time,
+# 0 for no limit
+MAX_RUNS_PER_EXPERIMENT = int(
+    os.environ.get('MAX_RUNS_PER_EXPERIMENT', '2'),
+    10,
+)
+# Maximum number of runs waiting, more are refused; 0 for no limit
+MAX_QUEUED_RUNS = int(os.environ.get('MAX_QUEUED_RUNS', '200'), 10)
+
+
+class RunScheduler(object):
+    """Starts queued runs, while limiting the number of concurrent runs.
+
+    The queue is the 'runs' table: runs that have not been dispatched yet are
+    waiting, and are started in order of priority, then submission.
+    Dispatching a run is an atomic update, so a run is never started twice.
+
+    Runs survive restarts: when the scheduler starts, runs that were
+    dispatched but are not running anymore (not passed to `attach()`) are
+    put back in the queue if they hadn't started, or marked as failed. This
+    means a single process should dispatch the runs of a database.
+
+    `start(run_id)` is called to start a run, it should return a future. The
+    queries run on `db_executor` (the loop's default executor if None).
+    """
+    def __init__(self, DBSession, start,
+                 max_runs=MAX_RUNS,
+                 max_runs_per_experiment=MAX_RUNS_PER_EXPERIMENT,
+                 max_queued=MAX_QUEUED_RUNS,
+                 interval=30.0,
+                 db_executor=None):
+        self.DBSession = DBSession
+        self.start_run = start
+        self.db_executor = db_executor
+        self.max_runs = max_runs
+        self.max_runs_per_experiment = max_runs_per_experiment
+        self.max_queued = max_queued
+        self.interval = interval
+        self.executor = ThreadPoolExecutor(
+            max_runs if max_runs > 0 else None,
+            thread_name_prefix='run',
+        )
+        self._running = {}
+        self._wakeup = None
+        self._task = None
+
+    def start(self):
+        """Start dispatching runs from the queue.
+        """
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.ensure_future(self._dispatch_loop())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def queue_full(self, db):
+        """Check whether new runs should be refused.
+        """
+        if self.max_queued <= 0:
+            return False
+        depth = self._pending(db).count()
+        PROM_QUEUE_DEPTH.set(depth)
+        if depth >= self.max_queued:
+            PROM_QUEUE_REJECTED.inc()
+            return True
+        return False
+
+    def submit(self, run_id):
+        """Signal that a run was added to the queue.
+        """
+        logger.info("Run %d queued", run_id)
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def attach(self, run_id, experiment_hash, future):
+        """Account for a run that was started outside of the scheduler.
+
+        This is used to count runs that were already happening on startup.
+        """
+        db = self.DBSession()
+        try:
+            (
+                db.query(database.Run)
+                .filter(database.Run.id == run_id)
+                .filter(database.Run.dispatched.is_(None))
+            ).update(
+                {database.Run.dispatched: datetime.utcnow()},
+                synchronize_session=False,
+            )
+            db.commit()
+        finally:
+            db.close()
+        self._track(run_id, experiment_hash, future)
+
+    def _track(self, run_id, experiment_hash, future):
+        self._running[run_id] = experiment_hash
+
+        def done(future):
+            self._running.pop(run_id, None)
+            if self._wakeup is not None:
+                self._wakeup.set()
+
+        future.add_done_callback(done)
+
+    @staticmethod
+    def _pending(db):
+        return (
+            db.query(database.Run)
+            .filter(database.Run.dispatched.is_(None))
+            .filter(database.Run.started.is_(None))
+            .filter(database.Run.done.is_(None))
+        )
+
+    async def _dispatch_loop(self):
+        try:
+            await asyncio.get_event_loop().run_in_executor(
+                self.db_executor,
+                self._recover, set(self._running),
+            )
+        except Exception:
+            logger.exception("Error recovering dispatched runs")
+        while True:
+            self._wakeup.clear()
+            try:
+                await self._dispatch()
+            except Exception:
+                logger.exception("Error dispatching runs")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _dispatch(self):
+        loop = asyncio.get_event_loop()
+
+        per_experiment = {}
+        for experiment_hash in self._running.values():
+            per_experiment[experiment_hash] = (
+                per_experiment.get(experiment_hash, 0) + 1
+            )
+        claimed = await loop.run_in_executor(
+            self.db_executor,
+            self._claim, len(self._running), per_experiment,
+        )
+
+        for run_id, experiment_hash in claimed:
+            logger.info("Starting run %d", run_id)
+            try:
+                future = self.start_run(run_id)
+            except Exception:
+                logger.exception("Couldn't start run %d", run_id)
+                await loop.run_in_executor(
+                    self.db_executor,
+                    self.set_failed, run_id,
+                )
+                continue
+            self._track(run_id, experiment_hash, future)
+
+    def _at_capacity(self, nb_running):
+        return self.max_runs > 0 and nb_running >= self.max_runs
+
+    def _claim(self, nb_running, per_experiment):
+        """Mark the next runs as dispatched, within the limits.
+
+        `nb_running` and `per_experiment` count the runs currently happening.
+        Returns a list of (run_id, experiment_hash).
+        """
+        claimed = []
+        db = self.DBSession()
+        try:
+            PROM_QUEUE_DEPTH.set(self._pending(db).count())
+            if self._at_capacity(nb_running):
+                return claimed
+
+            pending = (
+                self._pending(db)
+                .with_entities(
+                    database.Run.id,
+                    database.Run.experiment_hash,
+                    database.Run.submitted,
+                )
+                .order_by(database.Run.priority.desc(), database.Run.id)
+                .limit(max(100, self.max_runs * 10))
+            ).all()
+            for run_id, experiment_hash, submitted in pending:
+                if self._at_capacity(nb_running):
+                    break
+                running = per_experiment.get(experiment_hash, 0)
+                if (
+                    self.max_runs_per_experiment > 0 and
+                    running >= self.max_runs_per_experiment
+                ):
+                    continue
+
+                # Claim the run, another process might have done it already
+                now = datetime.utcnow()
+                updated = (
+                    db.query(database.Run)
+                    .filter(database.Run.id == run_id)
+                    .filter(database.Run.dispatched.is_(None))
+                ).update(
+                    {database.Run.dispatched: now},
+                    synchronize_session=False,
+                )
+                db.commit()
+                if not updated:
+                    continue
+
+                PROM_QUEUE_WAIT.observe((now - submitted).total_seconds())
+                per_experiment[experiment_hash] = running + 1
+                nb_running += 1
+                claimed.append((run_id, experiment_hash))
+        finally:
+            db.close()
+        return claimed
+
+    def _recover(self, running):
+        """Handle the runs that were dispatched but are not running.
+
+        Those were lost in a restart. Runs that hadn't started go back to
+        the queue, the others are marked as failed.
+        """
+        db = self.DBSession()
+        try:
+            lost = (
+                db.query(database.Run.id, database.Run.started)
+                .filter(database.Run.dispatched.isnot(None))
+                .filter(database.Run.done.is_(None))
+            ).all()
+            for run_id, started in lost:
+                if run_id in running:
+                    continue
+                if started is None:
+                    logger.warning("Run %d was dispatched but didn't start, "
+                                   "queuing it again", run_id)
+                    (
+                        db.query(database.Run)
+                        .filter(database.Run.id == run_id)
+                        .filter(database.Run.started.is_(None))
+                    ).update(
+                        {database.Run.dispatched: None},
+                        synchronize_session=False,
+                    )
+                    db.commit()
+                else:
+                    logger.warning("Run %d was interrupted, marking it as "
+                                   "failed", run_id)
+                    self.set_failed(run_id)
+        finally:
+            db.close()
+
+    def set_failed(self, run_id):
+        """Mark a run as failed, unless it is already done.
+        """
+        db = self.DBSession()
+        try:
+            (
+                db.query(database.Run)
+                .filter(database.Run.id == run_id)
+                .filter(database.Run.done.is_(None))
+            ).update(
+                {
+                    database.Run.done: datetime.utcnow(),
+                    database.Run.success: False,
+                },
+                synchronize_session=False,
+            )
+            db.commit()
+        finally:
+            db.close()
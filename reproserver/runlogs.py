@@ -0,0 +1,168 @@
+import asyncio
+import gzip
+import logging
+from sqlalchemy import func, inspect, text
+
+from . import database
+
+
+logger = logging.getLogger(__name__)
+
+
+def encode_chunk(lines):
+    return gzip.compress(
+        ''.join(line + '\n' for line in lines).encode('utf-8'),
+    )
+
+
+def decode_chunk(data):
+    # Not splitlines(), which also splits on '\r' and other characters
+    lines = gzip.decompress(data).decode('utf-8').split('\n')
+    # Every line is terminated, so this leaves an empty string at the end
+    if lines[-1] == '':
+        lines.pop()
+    return lines
+
+
+def write_log_chunk(db, object_store, run_id, first_line, lines):
+    """Store lines of a run log as a new chunk.
+
+    The compressed lines go to the 'logs' bucket, and the index entry is
+    added to the session (but not committed).
+    """
+    object_name = '%d/%010d' % (run_id, first_line)
+    object_store.upload_bytes('logs', object_name, encode_chunk(lines))
+    chunk = database.RunLogChunk(
+        run_id=run_id,
+        first_line=first_line,
+        nb_lines=len(lines),
+        object_name=object_name,
+    )
+    db.add(chunk)
+    return chunk
+
+
+def get_log_length(db, run_id):
+    """Get the number of lines in a run log.
+    """
+    return (
+        db.query(func.max(database.RunLogChunk.first_line +
+                          database.RunLogChunk.nb_lines))
+        .filter(database.RunLogChunk.run_id == run_id)
+    ).scalar() or 0
+
+
+def get_log_chunks(db, run_id, from_line=0, to_line=None):
+    """Get the index entries for the chunks covering a range of lines.
+    """
+    # Find the chunk containing from_line, so that both bounds are on the
+    # (run_id, first_line) index
+    first_chunk = (
+        db.query(func.max(database.RunLogChunk.first_line))
+        .filter(database.RunLogChunk.run_id == run_id)
+        .filter(database.RunLogChunk.first_line <= from_line)
+    ).scalar_subquery()
+    query = (
+        db.query(database.RunLogChunk)
+        .filter(database.RunLogChunk.run_id == run_id)
+        .filter(database.RunLogChunk.first_line >=
+                func.coalesce(first_chunk, 0))
+        .filter(database.RunLogChunk.first_line +
+                database.RunLogChunk.nb_lines > from_line)
+    )
+    if to_line is not None:
+        query = query.filter(database.RunLogChunk.first_line < to_line)
+    return query.order_by(database.RunLogChunk.first_line).all()
+
+
+async def get_log(db, object_store, run_id, from_line=0, to_line=None,
+                  db_executor=None):
+    """Read lines `from_line` to `to_line` (excluded) of a run log.
+
+    If `db_executor` is given, the index is read on it instead of the loop.
+    """
+    if from_line < 0:
+        raise ValueError("Negative line number %d" % from_line)
+    if db_executor is not None:
+        chunks = await asyncio.get_event_loop().run_in_executor(
+            db_executor,
+            get_log_chunks, db, run_id, from_line, to_line,
+        )
+    else:
+        chunks = get_log_chunks(db, run_id, from_line, to_line)
+    if not chunks:
+        return []
+    datas = await object_store.download_many_async(
+        'logs',
+        [chunk.object_name for chunk in chunks],
+    )
+    lines = []
+    for data in datas:
+        lines.extend(decode_chunk(data))
+    start = from_line - chunks[0].first_line
+    if start < 0:
+        # Missing chunk, can happen if a write failed
+        logger.warning("Run %d is missing log lines %d-%d",
+                       run_id, from_line, chunks[0].first_line - 1)
+        start = 0
+    if to_line is not None:
+        return lines[start:to_line - chunks[0].first_line]
+    else:
+        return lines[start:]
+
+
+def delete_log(db, run_id):
+    """Remove the log of a run, so it can be written again.
+
+    This only removes the index entries, which are the source of truth.
+    """
+    (
+        db.query(database.RunLogChunk)
+        .filter(database.RunLogChunk.run_id == run_id)
+    ).delete()
+
+
+def migrate_log_lines(DBSession, object_store, chunk_lines=500):
+    """Move the logs stored line by line by older versions to chunks.
+
+    Those are in the 'run_logs' table, which is dropped once it is empty.
+    """
+    db = DBSession()
+    try:
+        if not inspect(db.get_bind()).has_table('run_logs'):
+            return
+        run_ids = [
+            row[0] for row in db.execute(text(
+                'SELECT DISTINCT run_id FROM run_logs '
+                'WHERE run_id IS NOT NULL',
+            ))
+        ]
+        logger.warning("Moving the logs of %d runs to the object store",
+                       len(run_ids))
+        for run_id in run_ids:
+            lines = []
+            for row in db.execute(
+                text('SELECT line FROM run_logs WHERE run_id = :run_id '
+                     'ORDER BY id'),
+                {'run_id': run_id},
+            ):
+                lines.extend(row[0].split('\n'))
+            nb_rows = db.execute(
+                text('DELETE FROM run_logs WHERE run_id = :run_id'),
+                {'run_id': run_id},
+            ).rowcount
+            if nb_rows == 0:
+                # Moved concurrently by another process
+                db.rollback()
+                continue
+            for first_line in range(0, len(lines), chunk_lines):
+                write_log_chunk(
+                    db, object_store, run_id, first_line,
+                    lines[first_line:first_line + chunk_lines],
+                )
+            db.commit()
+        db.execute(text('DROP TABLE IF EXISTS run_logs'))
+        db.commit()
+        logger.info("Logs moved")
+    finally:
+        db.close()
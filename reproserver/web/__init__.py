@@ -15,9 +15,16 @@ def make_app(debug=False, xsrf_cookies=True):
             URLSpec('/reproduce/([^/]+)', views.ReproduceLocal,
                     name='reproduce_local'),
             URLSpec('/run/([^/]+)', views.StartRun, name='start_run'),
+            URLSpec('/run/([^/]+)/batch', views.StartBatch,
+                    name='start_batch'),
+            URLSpec('/batch/([^/]+)', views.BatchResults, name='batch'),
+            URLSpec('/batch/([^/]+)/json', views.BatchResultsJson,
+                    name='batch_json'),
             URLSpec('/results/([^/]+)', views.Results, name='results'),
             URLSpec('/results/([^/]+)/json', views.ResultsJson,
                     name='results_json'),
+            URLSpec('/results/([^/]+)/stream', views.ResultsStream,
+                    name='results_stream'),
             URLSpec('/about', views.About, name='about'),
             URLSpec('/data', views.Data, name='data'),
             URLSpec('/health', views.Health, name='health'),
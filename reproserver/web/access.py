@@ -0,0 +1,117 @@
+import asyncio
+from datetime import datetime, timedelta
+import logging
+import os
+import prometheus_client
+
+from .. import database
+
+
+logger = logging.getLogger(__name__)
+
+
+PROM_ACCESS_UPDATES = prometheus_client.Counter(
+    'experiment_access_updates_total',
+    "Experiments whose last access time was written to the database",
+)
+
+
+# Seconds between writes of the access times
+ACCESS_FLUSH_INTERVAL = int(
+    os.environ.get('ACCESS_FLUSH_INTERVAL', '60'),
+    10,
+)
+# Seconds for which an access time is recent enough not to be updated
+ACCESS_UPDATE_THRESHOLD = int(
+    os.environ.get('ACCESS_UPDATE_THRESHOLD', '600'),
+    10,
+)
+
+
+class AccessTracker(object):
+    """Records accesses to experiments, and writes them in bulk.
+
+    Setting `Experiment.last_access` on every page view would lock the
+    experiment's row each time. Instead, accessed experiments are collected
+    in memory and updated with a single query every `interval` seconds. Rows
+    that were updated less than `threshold` seconds ago are not updated.
+    """
+    def __init__(self, DBSession, interval=ACCESS_FLUSH_INTERVAL,
+                 threshold=ACCESS_UPDATE_THRESHOLD, executor=None):
+        self.DBSession = DBSession
+        self.interval = interval
+        self.threshold = timedelta(seconds=threshold)
+        self.executor = executor
+        self._touched = set()
+        self._recent = {}
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._flush_loop())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def touch(self, experiment_hash):
+        """Record an access to an experiment.
+        """
+        self._touched.add(experiment_hash)
+
+    def _take(self, now):
+        # Forget the experiments that were updated long enough ago
+        cutoff = now - self.threshold
+        self._recent = {
+            experiment_hash: updated
+            for experiment_hash, updated in self._recent.items()
+            if updated > cutoff
+        }
+
+        touched = self._touched - self._recent.keys()
+        self._touched = set()
+        for experiment_hash in touched:
+            self._recent[experiment_hash] = now
+        return touched
+
+    def _update(self, experiment_hashes, now):
+        db = self.DBSession()
+        try:
+            updated = (
+                db.query(database.Experiment)
+                .filter(database.Experiment.hash.in_(experiment_hashes))
+                .filter(database.Experiment.last_access < now - self.threshold)
+            ).update(
+                {database.Experiment.last_access: now},
+                synchronize_session=False,
+            )
+            db.commit()
+        finally:
+            db.close()
+        PROM_ACCESS_UPDATES.inc(updated)
+        return updated
+
+    def flush(self):
+        """Write the recorded accesses to the database.
+        """
+        now = datetime.utcnow()
+        touched = self._take(now)
+        if touched:
+            self._update(sorted(touched), now)
+
+    async def _flush_loop(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                # Take the set on the loop, write it on the executor
+                now = datetime.utcnow()
+                touched = self._take(now)
+                if touched:
+                    await loop.run_in_executor(
+                        self.executor,
+                        self._update, sorted(touched), now,
+                    )
+            except Exception:
+                logger.exception("Error updating experiment access times")
@@ -1,3 +1,5 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 import importlib
 import jinja2
 import json
@@ -10,19 +12,43 @@ import tornado.web
 from .. import __version__
 from .. import database
 from ..objectstore import get_object_store
+from ..runlogs import migrate_log_lines
+from .access import AccessTracker
+from .logstream import RunLogHub
 
 
 logger = logging.getLogger(__name__)
 
 
+# Number of threads running the web handlers' database queries
+DB_WORKERS = int(os.environ.get('DB_WORKERS', '8'), 10)
+
+
 class Application(tornado.web.Application):
     def __init__(self, handlers, **kwargs):
         super(Application, self).__init__(handlers, **kwargs)
 
         self.DBSession = database.connect()
+        # Queries block, so they run on a thread pool instead of the loop
+        self.db_executor = ThreadPoolExecutor(
+            DB_WORKERS,
+            thread_name_prefix='db',
+        )
 
         self.object_store = get_object_store()
         self.object_store.create_buckets()
+        migrate_log_lines(self.DBSession, self.object_store)
+
+        self.log_hub = RunLogHub(
+            self.DBSession, self.object_store,
+            db_executor=self.db_executor,
+        )
+
+        self.access_tracker = AccessTracker(
+            self.DBSession,
+            executor=self.db_executor,
+        )
+        self.access_tracker.start()
 
         if 'RUNNER_TYPE' not in os.environ:
             raise RuntimeError("RUNNER_TYPE is not set")
@@ -35,7 +61,10 @@ class Application(tornado.web.Application):
         self.runner = Runner(
             DBSession=self.DBSession,
             object_store=self.object_store,
+            run_updated=self.log_hub.notify,
+            db_executor=self.db_executor,
         )
+        self.runner.start()
 
     def log_request(self, handler):
         if handler.request.path == '/health':
@@ -53,11 +82,39 @@ class BaseHandler(tornado.web.RequestHandler):
         else:
             return self.reverse_url('reproduce_local', upload.short_id)
 
+    def prebuild(self, experiment):
+        """Have the runner build the image of a new experiment.
+        """
+        if experiment.build_status is None:
+            self.application.runner.prebuild(experiment.hash)
+
+    def run_db(self, func, *args):
+        """Run a function using the database, on the database thread pool.
+
+        The function is called with the handler's session and `args`.
+        Everything needed afterwards should be loaded by that function, since
+        accessing unloaded attributes would run queries on the event loop.
+        """
+        return asyncio.get_event_loop().run_in_executor(
+            self.application.db_executor,
+            func, self.db, *args,
+        )
+
+    async def load_output_paths(self, experiment_hash):
+        """Load the paths of an experiment's output files, for `output_link`.
+        """
+        self._output_paths[experiment_hash] = dict(await self.run_db(
+            lambda db: (
+                db.query(database.Path.name, database.Path.path)
+                .filter(database.Path.experiment_hash == experiment_hash)
+                .filter(database.Path.is_output)
+            ).all()
+        ))
+
     def output_link(self, output_file):
-        path = self.db.query(database.Path).filter(
-            database.Path.experiment_hash == output_file.run.experiment_hash,
-            database.Path.name == output_file.name,
-        ).one().path
+        path = self._output_paths[output_file.run.experiment_hash][
+            output_file.name
+        ]
         mime = mimetypes.guess_type(path)[0]
         return self.application.object_store.presigned_serve_url(
             'outputs', output_file.hash,
@@ -101,11 +158,14 @@ class BaseHandler(tornado.web.RequestHandler):
 
     def __init__(self, application, request, **kwargs):
         super(BaseHandler, self).__init__(application, request, **kwargs)
-        self.db = application.DBSession()
+        # Objects are used after the commit, it shouldn't expire them since
+        # reloading them would happen on the event loop
+        self.db = application.DBSession(expire_on_commit=False)
+        self._output_paths = {}
 
     def on_finish(self):
         super(BaseHandler, self).on_finish()
-        self.db.close()
+        self.application.db_executor.submit(self.db.close)
 
     def set_default_headers(self):
         self.set_header('Server', 'ReproServer/%s' % __version__)
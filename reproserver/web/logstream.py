@@ -0,0 +1,186 @@
+import asyncio
+import logging
+import prometheus_client
+
+from .. import database
+from ..runlogs import get_log
+
+
+logger = logging.getLogger(__name__)
+
+
+PROM_LOG_SUBSCRIBERS = prometheus_client.Gauge(
+    'log_stream_subscribers',
+    "Clients subscribed to run log streams",
+)
+PROM_LOG_WATCHES = prometheus_client.Gauge(
+    'log_stream_watches',
+    "Runs being watched for log stream subscribers",
+)
+
+
+class Subscription(object):
+    """A subscriber to the updates of a run.
+
+    Events are either ``('status', started, done)`` or
+    ``('log', first_line, lines)``. `None` is sent when the subscription is
+    closed. Log events might overlap, lines before `position` should be
+    skipped.
+    """
+    def __init__(self, hub, run_id, from_line):
+        self.hub = hub
+        self.run_id = run_id
+        self.position = from_line
+        self.queue = asyncio.Queue()
+        self.backlog = None
+
+    async def get(self):
+        if self.backlog is not None:
+            backlog, self.backlog = self.backlog, None
+            return await backlog
+        return await self.queue.get()
+
+    def close(self):
+        self.hub.unsubscribe(self)
+
+
+class _RunWatch(object):
+    def __init__(self, run_id, next_line):
+        self.run_id = run_id
+        self.next_line = next_line
+        self.started = None
+        self.done = None
+        self.subscribers = set()
+        self.wakeup = asyncio.Event()
+
+    def publish(self, event):
+        for subscriber in self.subscribers:
+            subscriber.queue.put_nowait(event)
+
+
+class RunLogHub(object):
+    """Fans out log lines and status changes of runs to subscribers.
+
+    Each run that has subscribers is watched by a single task, which reads
+    new lines from the log store and sends them to all the subscribers. That
+    task polls every `interval` seconds, or sooner if runners in this
+    process call `notify()`. If `db_executor` is given, queries run on it
+    instead of the event loop.
+    """
+    def __init__(self, DBSession, object_store, interval=2.0,
+                 db_executor=None):
+        self.DBSession = DBSession
+        self.object_store = object_store
+        self.interval = interval
+        self.db_executor = db_executor
+        self.loop = asyncio.get_event_loop()
+        self._watches = {}
+
+    def subscribe(self, run_id, from_line=0):
+        """Subscribe to a run's updates, starting at line `from_line`.
+
+        Lines before `from_line` and the current status are sent first.
+        """
+        if from_line < 0:
+            raise ValueError("Negative line number %d" % from_line)
+        subscription = Subscription(self, run_id, from_line)
+        watch = self._watches.get(run_id)
+        if watch is None:
+            watch = self._watches[run_id] = _RunWatch(run_id, from_line)
+            PROM_LOG_WATCHES.inc()
+            asyncio.ensure_future(self._watch(watch))
+        elif watch.next_line > from_line:
+            # Catch up on the lines that the watch already went past
+            subscription.backlog = asyncio.ensure_future(self._catch_up(
+                subscription.run_id, from_line, watch.next_line,
+            ))
+        if watch.started is not None:
+            subscription.queue.put_nowait(
+                ('status', watch.started, watch.done),
+            )
+        watch.subscribers.add(subscription)
+        PROM_LOG_SUBSCRIBERS.inc()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        watch = self._watches.get(subscription.run_id)
+        if watch is not None and subscription in watch.subscribers:
+            watch.subscribers.discard(subscription)
+            PROM_LOG_SUBSCRIBERS.dec()
+            subscription.queue.put_nowait(None)
+            watch.wakeup.set()
+
+    def notify(self, run_id):
+        """Signal that a run has been updated.
+
+        This can be called from any thread.
+        """
+        self.loop.call_soon_threadsafe(self._notify, run_id)
+
+    def _notify(self, run_id):
+        watch = self._watches.get(run_id)
+        if watch is not None:
+            watch.wakeup.set()
+
+    async def _catch_up(self, run_id, from_line, to_line):
+        db = self.DBSession()
+        try:
+            lines = await get_log(
+                db, self.object_store,
+                run_id, from_line, to_line,
+                db_executor=self.db_executor,
+            )
+        finally:
+            db.close()
+        return 'log', from_line, lines
+
+    async def _watch(self, watch):
+        try:
+            while watch.subscribers:
+                watch.wakeup.clear()
+                try:
+                    await self._poll(watch)
+                except Exception:
+                    logger.exception("Error polling run %d", watch.run_id)
+                if watch.done:
+                    break
+                try:
+                    await asyncio.wait_for(watch.wakeup.wait(), self.interval)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            del self._watches[watch.run_id]
+            PROM_LOG_WATCHES.dec()
+            for subscription in watch.subscribers:
+                subscription.queue.put_nowait(None)
+            PROM_LOG_SUBSCRIBERS.dec(len(watch.subscribers))
+
+    async def _poll(self, watch):
+        db = self.DBSession()
+        try:
+            # Read the status first, log lines are all written before 'done'
+            row = await self.loop.run_in_executor(
+                self.db_executor,
+                lambda: (
+                    db.query(database.Run.started, database.Run.done)
+                    .filter(database.Run.id == watch.run_id)
+                ).one_or_none(),
+            )
+            if row is None:
+                started = done = True
+            else:
+                started, done = bool(row.started), bool(row.done)
+            lines = await get_log(
+                db, self.object_store,
+                watch.run_id, watch.next_line,
+                db_executor=self.db_executor,
+            )
+        finally:
+            db.close()
+
+        if lines:
+            watch.publish(('log', watch.next_line, lines))
+            watch.next_line += len(lines)
+        if (started, done) != (watch.started, watch.done):
+            watch.started, watch.done = started, done
+            watch.publish(('status', started, done))
@@ -0,0 +1,204 @@
+from email.message import Message
+from hashlib import sha256
+import logging
+import tempfile
+from tornado.httputil import HTTPHeaders
+
+
+logger = logging.getLogger(__name__)
+
+
+class MultipartError(ValueError):
+    """The request body is not valid multipart/form-data.
+    """
+
+
+class UploadedFile(object):
+    """A file from a multipart body, spooled to disk.
+
+    The SHA-256 of the content is computed as it is written.
+    """
+    def __init__(self, name, filename, content_type):
+        self.name = name
+        self.filename = filename
+        self.content_type = content_type
+        self.file = tempfile.NamedTemporaryFile('w+b', prefix='upload_')
+        self.size = 0
+        self._hasher = sha256()
+        self.hash = None
+
+    def write(self, data):
+        self.file.write(data)
+        self._hasher.update(data)
+        self.size += len(data)
+
+    def finish(self):
+        self.file.flush()
+        self.hash = self._hasher.hexdigest()
+
+    def close(self):
+        self.file.close()
+
+    def __repr__(self):
+        return "<UploadedFile name=%r, filename=%r, size=%d>" % (
+            self.name, self.filename, self.size)
+
+
+_PREAMBLE, _HEADERS, _BODY, _AFTER_DELIMITER, _END = range(5)
+
+
+class MultipartParser(object):
+    """Incremental parser for multipart/form-data bodies.
+
+    Data is fed in chunks as it is received. Form fields are kept in memory
+    (up to `max_field_size` each and `max_fields_size` in total), while files
+    are spooled to temporary files, so memory use doesn't depend on the size
+    of the upload. At most `max_parts` fields and files are accepted.
+    """
+    def __init__(self, boundary, max_field_size=65536, max_header_size=16384,
+                 max_fields_size=1048576, max_parts=1000):
+        if isinstance(boundary, str):
+            boundary = boundary.encode('latin1')
+        self._delimiter = b'--' + boundary
+        self._body_delimiter = b'\r\n' + self._delimiter
+        self.max_field_size = max_field_size
+        self.max_header_size = max_header_size
+        self.max_fields_size = max_fields_size
+        self.max_parts = max_parts
+        self._nb_parts = 0
+        self._fields_size = 0
+        self._buffer = bytearray()
+        self._state = _PREAMBLE
+        self._part_name = None
+        self._part_file = None
+        self._part_data = None
+        self.fields = {}
+        self.files = {}
+
+    @classmethod
+    def from_content_type(cls, content_type, **kwargs):
+        """Build a parser from the value of a Content-Type header.
+        """
+        msg = Message()
+        msg['Content-Type'] = content_type
+        if msg.get_content_type() != 'multipart/form-data':
+            raise MultipartError("Not multipart/form-data")
+        boundary = msg.get_param('boundary')
+        if not boundary:
+            raise MultipartError("Missing multipart boundary")
+        return cls(boundary, **kwargs)
+
+    def feed(self, data):
+        self._buffer.extend(data)
+        while self._step():
+            pass
+
+    def finish(self):
+        """Indicate the end of the body, checks that it was complete.
+        """
+        if self._state != _END:
+            raise MultipartError("Truncated multipart body")
+
+    def close(self):
+        """Remove the temporary files.
+        """
+        if self._part_file is not None:
+            self._part_file.close()
+        for files in self.files.values():
+            for uploaded_file in files:
+                uploaded_file.close()
+
+    def _step(self):
+        buf = self._buffer
+        if self._state == _PREAMBLE:
+            idx = buf.find(self._delimiter)
+            if idx == -1:
+                # Keep enough to find the delimiter on next call
+                del buf[:max(0, len(buf) - len(self._delimiter))]
+                return False
+            del buf[:idx + len(self._delimiter)]
+            self._state = _AFTER_DELIMITER
+            return True
+        elif self._state == _AFTER_DELIMITER:
+            if len(buf) < 2:
+                return False
+            if buf[:2] == b'--':
+                self._state = _END
+            elif buf[:2] == b'\r\n':
+                self._state = _HEADERS
+            else:
+                raise MultipartError("Invalid data after boundary")
+            del buf[:2]
+            return True
+        elif self._state == _HEADERS:
+            idx = buf.find(b'\r\n\r\n')
+            if idx == -1:
+                if len(buf) > self.max_header_size:
+                    raise MultipartError("Part headers too long")
+                return False
+            headers = bytes(buf[:idx + 2]).decode('utf-8')
+            del buf[:idx + 4]
+            self._start_part(HTTPHeaders.parse(headers))
+            self._state = _BODY
+            return True
+        elif self._state == _BODY:
+            idx = buf.find(self._body_delimiter)
+            if idx == -1:
+                # Emit what can't be the start of a delimiter
+                keep = len(self._body_delimiter) - 1
+                if len(buf) > keep:
+                    self._part_write(bytes(buf[:-keep]))
+                    del buf[:-keep]
+                return False
+            self._part_write(bytes(buf[:idx]))
+            del buf[:idx + len(self._body_delimiter)]
+            self._end_part()
+            self._state = _AFTER_DELIMITER
+            return True
+        else:  # _END
+            buf.clear()
+            return False
+
+    def _start_part(self, headers):
+        msg = Message()
+        msg['Content-Disposition'] = headers.get('Content-Disposition', '')
+        if msg.get_content_disposition() != 'form-data':
+            raise MultipartError("Invalid Content-Disposition")
+        name = msg.get_param('name', header='content-disposition')
+        if not name:
+            raise MultipartError("Part is missing a name")
+        self._nb_parts += 1
+        if self._nb_parts > self.max_parts:
+            raise MultipartError("Too many parts")
+        self._part_name = name
+        filename = msg.get_filename()
+        if filename:
+            self._part_file = UploadedFile(
+                name, filename,
+                headers.get('Content-Type', 'application/octet-stream'),
+            )
+        else:
+            self._part_data = bytearray()
+
+    def _part_write(self, data):
+        if self._part_file is not None:
+            self._part_file.write(data)
+        else:
+            self._part_data.extend(data)
+            self._fields_size += len(data)
+            if len(self._part_data) > self.max_field_size:
+                raise MultipartError("Field %s too long" % self._part_name)
+            if self._fields_size > self.max_fields_size:
+                raise MultipartError("Form fields too long")
+
+    def _end_part(self):
+        if self._part_file is not None:
+            self._part_file.finish()
+            logger.info("Received file %r, %d bytes",
+                        self._part_file.filename, self._part_file.size)
+            self.files.setdefault(self._part_name, []).append(self._part_file)
+        else:
+            self.fields.setdefault(self._part_name, []).append(
+                bytes(self._part_data),
+            )
+        self._part_name = self._part_file = self._part_data = None
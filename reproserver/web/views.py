@@ -1,17 +1,22 @@
-from datetime import datetime
-from hashlib import sha256
+import asyncio
+import itertools
+import json
 import logging
 import os
 import prometheus_client
-from sqlalchemy.orm import joinedload
-import tempfile
+from sqlalchemy.orm import joinedload, selectinload
+from tornado import httputil
+from tornado.iostream import StreamClosedError
+import tornado.web
 
 from .. import database
 from ..repositories import RepositoryError, get_experiment_from_repository, \
     get_repository_name, get_repository_page_url, parse_repository_url
 from .. import rpz_metadata
+from ..runlogs import get_log, get_log_length
 from ..utils import secure_filename
 from .base import BaseHandler
+from .multipart import MultipartError, MultipartParser
 
 
 logger = logging.getLogger(__name__)
@@ -24,6 +29,32 @@ PROM_PAGE = prometheus_client.Counter(
 )
 
 
+# Maximum size of a form with files, e.g. an uploaded package
+MAX_UPLOAD_SIZE = int(
+    os.environ.get('MAX_UPLOAD_SIZE', str(50 * 1024 ** 3)),
+    10,
+)
+
+# Maximum size of a form submission that is not multipart (no file), and of
+# the fields of a multipart one
+MAX_FORM_SIZE = 1024 ** 2
+
+# Maximum number of fields and files in a multipart form
+MAX_FORM_PARTS = 1000
+
+# Number of log lines shown on the results page
+MAX_RESULTS_LOG_LINES = 5000
+
+# Maximum number of log lines returned by each request to the JSON endpoint
+MAX_JSON_LOG_LINES = 5000
+
+# Maximum number of runs in a batch
+MAX_BATCH_RUNS = int(os.environ.get('MAX_BATCH_RUNS', '100'), 10)
+
+# Priority of runs in a batch, lower than single runs so they are not delayed
+BATCH_PRIORITY = -1
+
+
 class Index(BaseHandler):
     """Landing page from which a user can select an experiment to upload.
     """
@@ -38,7 +69,105 @@ class Index(BaseHandler):
         return self.finish()
 
 
-class Upload(BaseHandler):
+@tornado.web.stream_request_body
+class StreamedFormHandler(BaseHandler):
+    """Base class for handlers receiving forms with files.
+
+    The request body is parsed as it is received, files are written to
+    temporary files and hashed on the fly rather than being held in memory.
+    Subclasses call `parse_body()` before accessing the form.
+    """
+    def initialize(self):
+        self.multipart = None
+        self.multipart_error = None
+        self.body = None
+        self.body_parsed = False
+
+    def check_xsrf_cookie(self):
+        # This is called by Tornado before the body is received. The token is
+        # usually a form field, so the actual check happens once the form has
+        # been parsed, but requests that can't pass are rejected right away
+        if (
+            self.body_parsed or
+            self.request.headers.get('X-Xsrftoken') or
+            self.request.headers.get('X-Csrftoken')
+        ):
+            super(StreamedFormHandler, self).check_xsrf_cookie()
+        elif not self.get_cookie('_xsrf'):
+            raise tornado.web.HTTPError(403, "'_xsrf' cookie missing")
+
+    def prepare(self):
+        content_type = self.request.headers.get('Content-Type', '')
+        try:
+            self.multipart = MultipartParser.from_content_type(
+                content_type,
+                max_field_size=MAX_FORM_SIZE,
+                max_fields_size=MAX_FORM_SIZE,
+                max_parts=MAX_FORM_PARTS,
+            )
+        except MultipartError:
+            # Not a file upload, e.g. only a URL; that's small enough
+            self.body = bytearray()
+            self.request.connection.set_max_body_size(MAX_FORM_SIZE)
+        else:
+            self.request.connection.set_max_body_size(MAX_UPLOAD_SIZE)
+
+    def data_received(self, chunk):
+        if self.multipart is not None:
+            # Errors are reported from post(), raising here would drop the
+            # connection instead of sending a response
+            if self.multipart_error is None:
+                try:
+                    self.multipart.feed(chunk)
+                except MultipartError as e:
+                    self.multipart_error = e
+        else:
+            self.body.extend(chunk)
+
+    def parse_body(self):
+        if self.multipart is not None:
+            try:
+                if self.multipart_error is not None:
+                    raise self.multipart_error
+                self.multipart.finish()
+            except MultipartError as e:
+                raise tornado.web.HTTPError(400, str(e))
+            arguments = self.multipart.fields
+        else:
+            arguments = {}
+            httputil.parse_body_arguments(
+                self.request.headers.get('Content-Type', ''),
+                bytes(self.body),
+                arguments, {},
+                self.request.headers,
+            )
+        for name, values in arguments.items():
+            self.request.body_arguments.setdefault(name, []).extend(values)
+            self.request.arguments.setdefault(name, []).extend(values)
+        self.body_parsed = True
+        if self.settings.get('xsrf_cookies'):
+            self.check_xsrf_cookie()
+
+    @property
+    def uploaded_files(self):
+        """The files from the form, as lists of `UploadedFile` by name.
+        """
+        if self.multipart is None:
+            return {}
+        return self.multipart.files
+
+    def on_finish(self):
+        super(StreamedFormHandler, self).on_finish()
+        if self.multipart is not None:
+            self.multipart.close()
+
+    def on_connection_close(self):
+        super(StreamedFormHandler, self).on_connection_close()
+        if self.multipart is not None:
+            self.multipart.close()
+
+
+class Upload(StreamedFormHandler):
     """Target of the landing page.
 
     An experiment has been provided, store it and extract metadata.
@@ -48,6 +177,8 @@ class Upload(BaseHandler):
     async def post(self):
         PROM_PAGE.labels('upload').inc()
 
+        self.parse_body()
+
         # If a URL was provided, and no file
         if self.get_body_argument('rpz_url', None):
             # Redirect to reproduce_repo view
@@ -64,55 +195,53 @@ class Upload(BaseHandler):
                     repo, repo_path,
                 ))
 
-        # Get uploaded file
-        # FIXME: Don't hold the file in memory!
+        # Get uploaded file, already written to disk and hashed
         try:
-            uploaded_file = self.request.files['rpz_file'][0]
+            uploaded_file = self.uploaded_files['rpz_file'][0]
         except (KeyError, IndexError):
             return self.render('setup_badfile.html', message="Missing file")
         assert uploaded_file.filename
         logger.info("Incoming file: %r", uploaded_file.filename)
         filename = secure_filename(uploaded_file.filename)
 
-        # Hash it
-        hasher = sha256(uploaded_file.body)
-        filehash = hasher.hexdigest()
+        filehash = uploaded_file.hash
         logger.info("Computed hash: %s", filehash)
 
         # Check for existence of experiment
-        experiment = self.db.query(database.Experiment).get(filehash)
+        experiment = await self.run_db(
+            lambda db: db.query(database.Experiment).get(filehash),
+        )
         if experiment:
-            experiment.last_access = datetime.utcnow()
+            self.application.access_tracker.touch(experiment.hash)
             logger.info("File exists in storage")
         else:
-            # Write it to disk
-            with tempfile.NamedTemporaryFile('w+b', suffix='.rpz') as tfile:
-                tfile.write(uploaded_file.body)
-
-                # Insert it in database
-                try:
-                    experiment = rpz_metadata.make_experiment(
-                        filehash,
-                        tfile.name,
-                    )
-                except rpz_metadata.InvalidPackage as e:
-                    return self.render('setup_badfile.html', message=str(e))
-                self.db.add(experiment)
-
-                # Insert it on S3
-                await self.application.object_store.upload_file_async(
-                    'experiments',
+            # Insert it in database
+            try:
+                experiment = rpz_metadata.make_experiment(
                     filehash,
-                    tfile.name,
+                    uploaded_file.file.name,
                 )
-                logger.info("Inserted file in storage")
+            except rpz_metadata.InvalidPackage as e:
+                return self.render('setup_badfile.html', message=str(e))
+            self.db.add(experiment)
+
+            # Insert it on S3
+            await self.application.object_store.upload_file_async(
+                'experiments',
+                filehash,
+                uploaded_file.file.name,
+            )
+            logger.info("Inserted file in storage")
 
         # Insert Upload in database
         upload = database.Upload(experiment=experiment,
                                  filename=filename,
                                  submitted_ip=self.request.remote_ip)
         self.db.add(upload)
-        self.db.commit()
+        await self.run_db(lambda db: db.commit())
+
+        # Start building the image in the background
+        self.prebuild(experiment)
 
         # Encode ID for permanent URL
         upload_short_id = upload.short_id
@@ -125,21 +254,26 @@ class Upload(BaseHandler):
 
 
 class BaseReproduce(BaseHandler):
-    def reproduce(self, upload, repo_name=None, repo_url=None):
+    async def reproduce(self, upload, repo_name=None, repo_url=None):
         experiment = upload.experiment
         filename = upload.filename
         experiment_url = self.url_for_upload(upload)
 
-        input_files = (
-            self.db.query(database.Path)
-            .filter(database.Path.experiment_hash ==
-                    experiment.hash)
-            .filter(database.Path.is_input)).all()
+        def load(db):
+            input_files = (
+                db.query(database.Path)
+                .filter(database.Path.experiment_hash ==
+                        experiment.hash)
+                .filter(database.Path.is_input)).all()
+            return experiment.parameters, input_files
+
+        params, input_files = await self.run_db(load)
         return self.render(
             'setup.html',
             filename=filename,
             built=True, error=False,
-            params=experiment.parameters,
+            build_status=experiment.build_status,
+            params=params,
             input_files=input_files,
             upload_short_id=upload.short_id,
             experiment_url=experiment_url,
@@ -157,12 +291,12 @@ class ReproduceRepo(BaseReproduce):
 
         # Check the database for an experiment already stored matching the URI
         repository_key = '%s/%s' % (repo, repo_path)
-        upload = (
-            self.db.query(database.Upload)
+        upload = await self.run_db(lambda db: (
+            db.query(database.Upload)
             .options(joinedload(database.Upload.experiment))
             .filter(database.Upload.repository_key == repository_key)
             .order_by(database.Upload.id.desc())
-        ).first()
+        ).first())
         if upload is None:
             try:
                 upload = await get_experiment_from_repository(
@@ -176,22 +310,22 @@ class ReproduceRepo(BaseReproduce):
             except rpz_metadata.InvalidPackage as e:
                 self.set_status(404)
                 return self.render('setup_badfile.html', message=str(e))
-        else:
-            upload.last_access = datetime.utcnow()
 
-        # Also updates last access
-        upload.experiment.last_access = datetime.utcnow()
-        self.db.commit()
+        # Update last access
+        self.application.access_tracker.touch(upload.experiment_hash)
+
+        # Start building the image in the background
+        self.prebuild(upload.experiment)
 
         repo_name = get_repository_name(repo)
         repo_url = await get_repository_page_url(repo, repo_path)
-        return self.reproduce(upload, repo_name, repo_url)
+        return await self.reproduce(upload, repo_name, repo_url)
 
 
 class ReproduceLocal(BaseReproduce):
     PROM_PAGE.labels('reproduce_local').inc(0)
 
-    def get(self, upload_short_id):
+    async def get(self, upload_short_id):
         """Ask for run parameters.
         """
         PROM_PAGE.labels('reproduce_local').inc()
@@ -204,69 +338,65 @@ class ReproduceLocal(BaseReproduce):
             return self.render('setup_notfound.html')
 
         # Look up the experiment in database
-        upload = (
-            self.db.query(database.Upload)
+        upload = await self.run_db(lambda db: (
+            db.query(database.Upload)
             .options(joinedload(database.Upload.experiment))
             .get(upload_id)
-        )
+        ))
         if upload is None:
             self.set_status(404)
             return self.render('setup_notfound.html')
 
-        # Also updates last access
-        upload.last_access = datetime.utcnow()
-        upload.experiment.last_access = datetime.utcnow()
-        self.db.commit()
-
-        return self.reproduce(upload)
-
+        # Update last access
+        self.application.access_tracker.touch(upload.experiment_hash)
 
-class StartRun(BaseHandler):
-    PROM_PAGE.labels('start_run').inc(0)
+        return await self.reproduce(upload)
 
-    async def post(self, upload_short_id):
-        """Gets the run parameters POSTed to from /reproduce.
 
-        Triggers the run and redirects to the results page.
+class BaseStartRun(StreamedFormHandler):
+    async def get_upload(self, upload_short_id):
+        """Look up the upload and update its last access, or return None.
         """
-        PROM_PAGE.labels('start_run').inc()
-
         # Decode info from URL
         try:
             upload_id = database.Upload.decode_id(upload_short_id)
         except ValueError:
-            self.set_status(404)
-            return self.render('setup_notfound.html')
+            return None
 
         # Look up the experiment in database
-        upload = (
-            self.db.query(database.Upload)
-            .options(joinedload(database.Upload.experiment))
-            .get(upload_id)
-        )
+        def load(db):
+            upload = (
+                db.query(database.Upload)
+                .options(joinedload(database.Upload.experiment)
+                         .joinedload(database.Experiment.parameters))
+                .get(upload_id)
+            )
+            if upload is None:
+                return None, False
+            return upload, self.application.runner.scheduler.queue_full(db)
+
+        upload, queue_full = await self.run_db(load)
         if upload is None:
-            self.set_status(404)
-            return self.render('setup_notfound.html')
-        experiment = upload.experiment
+            return None
+
+        # Refuse new runs if too many are waiting
+        if queue_full:
+            raise tornado.web.HTTPError(
+                503,
+                "Too many runs are waiting, try again later",
+            )
 
         # Update last access
-        upload.last_access = datetime.utcnow()
-        upload.experiment.last_access = datetime.utcnow()
+        self.application.access_tracker.touch(upload.experiment_hash)
 
-        # New run entry
-        run = database.Run(experiment_hash=experiment.hash,
-                           upload_id=upload_id)
-        self.db.add(run)
+        return upload
 
-        # Get list of parameters
-        params = set()
-        params_unset = set()
-        for param in experiment.parameters:
-            if not param.optional:
-                params_unset.add(param.name)
-            params.add(param.name)
+    def get_parameter_values(self, experiment):
+        """Get the values for each parameter from the form, as lists.
+        """
+        params = set(param.name for param in experiment.parameters)
 
-        # Get run parameters
+        values = {}
         for k, v in self.request.body_arguments.items():
             if k.startswith('param_'):
                 if not v:
@@ -274,72 +404,128 @@ class StartRun(BaseHandler):
                 name = k[6:]
                 if name not in params:
                     raise ValueError("Unknown parameter %s" % k)
-                v = v[-1].decode('utf-8')
-                run.parameter_values.append(
-                    database.ParameterValue(name=name, value=v)
-                )
-                params_unset.discard(name)
+                values[name] = [e.decode('utf-8') for e in v]
+        return values
 
+    def check_parameters(self, experiment, values):
+        params_unset = set(
+            param.name for param in experiment.parameters
+            if not param.optional
+        )
+        params_unset.difference_update(values)
         if params_unset:
             raise ValueError("Missing value for parameters: %s" %
                              ", ".join(params_unset))
 
+    async def get_input_files(self, experiment, multiple=False):
+        """Store the input files from the form.
+
+        Returns lists of `InputFile` attributes for each input. Unless
+        `multiple` is True, only one file can be given for each input.
+        """
         # Get list of input files
-        input_files = set(
+        input_files = set(await self.run_db(lambda db: [
             p.name for p in (
-                self.db.query(database.Path)
+                db.query(database.Path)
                 .filter(database.Path.experiment_hash == experiment.hash)
                 .filter(database.Path.is_input)
-            ).all())
-
-        # Get input files
-        for k, uploaded_file in self.request.files.items():
-            if not uploaded_file:
+            ).all()
+        ]))
+
+        # Get input files, already written to disk and hashed
+        inputs = {}
+        to_upload = {}
+        for k, uploaded_files in self.uploaded_files.items():
+            if not uploaded_files:
                 continue
-            uploaded_file = uploaded_file[0]
 
             if not k.startswith('inputfile_') or k[10:] not in input_files:
                 raise ValueError("Unknown input file %s" % k)
 
             name = k[10:]
-            logger.info("Incoming input file: %s", name)
-
-            # Hash file
-            hasher = sha256(uploaded_file.body)
-            inputfilehash = hasher.hexdigest()
-            logger.info("Computed hash: %s", inputfilehash)
-
-            # Insert it into S3
-            await self.application.object_store.upload_bytes_async(
-                'inputs',
-                inputfilehash,
-                uploaded_file.body,
-            )
-            logger.info("Inserted file in storage")
+            if len(uploaded_files) > 1 and not multiple:
+                raise ValueError("Multiple files for input %s" % name)
+            inputs[name] = []
+            for uploaded_file in uploaded_files:
+                logger.info("Incoming input file: %s", name)
+                logger.info("Computed hash: %s", uploaded_file.hash)
+
+                to_upload[uploaded_file.hash] = uploaded_file.file.name
+                inputs[name].append(dict(
+                    hash=uploaded_file.hash, name=name,
+                    size=uploaded_file.size,
+                ))
 
-            # Insert it in database
-            input_file = database.InputFile(
-                hash=inputfilehash, name=name,
-                size=len(uploaded_file.body),
+        # Insert them into S3
+        if to_upload:
+            object_store = self.application.object_store
+            uploaded = sum(await asyncio.gather(*[
+                object_store.upload_file_once_async(
+                    'inputs', inputfilehash, filename,
+                )
+                for inputfilehash, filename in sorted(to_upload.items())
+            ]))
+            logger.info(
+                "Inserted %d files in storage, %d were already present",
+                uploaded, len(to_upload) - uploaded,
             )
-            run.input_files.append(input_file)
+        return inputs
 
-        # Get ports to expose
-        for port_str in self.get_body_argument('ports', '').split():
-            port_str = port_str.strip()
-            if port_str:
-                try:
-                    port = int(port_str)
-                    if not (1 <= port <= 65535):
-                        raise ValueError
-                except (ValueError, OverflowError):
-                    raise ValueError("Invalid port number %r" % port_str)
-                run.ports.append(database.RunPort(
-                    port_number=port,
-                ))
+
+class StartRun(BaseStartRun):
+    PROM_PAGE.labels('start_run').inc(0)
+
+    async def post(self, upload_short_id):
+        """Gets the run parameters POSTed to from /reproduce.
+
+        Triggers the run and redirects to the results page.
+        """
+        PROM_PAGE.labels('start_run').inc()
+
+        self.parse_body()
+        upload = await self.get_upload(upload_short_id)
+        if upload is None:
+            self.set_status(404)
+            return self.render('setup_notfound.html')
+        experiment = upload.experiment
+
+        # New run entry
+        run = database.Run(experiment_hash=experiment.hash,
+                           upload_id=upload.id)
+        self.db.add(run)
+
+        try:
+            # Get run parameters
+            values = self.get_parameter_values(experiment)
+            self.check_parameters(experiment, values)
+            for name, v in values.items():
+                run.parameter_values.append(
+                    database.ParameterValue(name=name, value=v[-1])
+                )
+
+            # Get ports to expose
+            for port_str in self.get_body_argument('ports', '').split():
+                port_str = port_str.strip()
+                if port_str:
+                    try:
+                        port = int(port_str)
+                        if not (1 <= port <= 65535):
+                            raise ValueError
+                    except (ValueError, OverflowError):
+                        raise ValueError("Invalid port number %r" % port_str)
+                    run.ports.append(database.RunPort(
+                        port_number=port,
+                    ))
+
+            # Get input files
+            inputs = await self.get_input_files(experiment)
+        except ValueError as e:
+            raise tornado.web.HTTPError(400, str(e))
+        for files in inputs.values():
+            run.input_files.append(database.InputFile(**files[0]))
 
         # Trigger run
-        self.db.commit()
+        await self.run_db(lambda db: db.commit())
         self.application.runner.run(run.id)
 
         # Redirect to results page
@@ -349,10 +535,212 @@ class StartRun(BaseHandler):
         )
 
 
+class StartBatch(BaseStartRun):
+    PROM_PAGE.labels('start_batch').inc(0)
+
+    async def post(self, upload_short_id):
+        """Start a batch of runs, for example a parameter sweep.
+
+        Each `param_<name>` and `inputfile_<name>` field can be given multiple
+        times, a run is created for each combination of the values. Sets of
+        parameters can also be given as a JSON list in `parameter_sets`.
+
+        Responds with the list of runs if JSON is requested, otherwise
+        redirects to the batch page.
+        """
+        PROM_PAGE.labels('start_batch').inc()
+
+        self.parse_body()
+        upload = await self.get_upload(upload_short_id)
+        if upload is None:
+            if self.is_json_requested():
+                return self.send_error_json(404, "Not found")
+            self.set_status(404)
+            return self.render('setup_notfound.html')
+        experiment = upload.experiment
+
+        # Get the parameter sets
+        params = set(param.name for param in experiment.parameters)
+        try:
+            parameter_sets = json.loads(
+                self.get_body_argument('parameter_sets', '[{}]'),
+            )
+        except json.JSONDecodeError:
+            raise tornado.web.HTTPError(400, "Invalid parameter_sets")
+        if (
+            not isinstance(parameter_sets, list) or
+            not all(isinstance(s, dict) for s in parameter_sets)
+        ):
+            raise tornado.web.HTTPError(400, "Invalid parameter_sets")
+        for parameter_set in parameter_sets:
+            for name, value in parameter_set.items():
+                if name not in params or not isinstance(value, str):
+                    raise tornado.web.HTTPError(
+                        400,
+                        "Invalid parameter %s" % name,
+                    )
+
+        # Combine them with the values from the form
+        try:
+            grid = sorted(self.get_parameter_values(experiment).items())
+            run_params = []
+            for parameter_set in parameter_sets or [{}]:
+                for combination in itertools.product(*[v for k, v in grid]):
+                    values = dict(zip([k for k, v in grid], combination))
+                    values.update(parameter_set)
+                    self.check_parameters(experiment, values)
+                    run_params.append(values)
+        except ValueError as e:
+            raise tornado.web.HTTPError(400, str(e))
+
+        # Check the number of runs before storing input files
+        nb_inputs = 1
+        for files in self.uploaded_files.values():
+            nb_inputs *= max(1, len(files))
+        if len(run_params) * nb_inputs > MAX_BATCH_RUNS:
+            raise tornado.web.HTTPError(
+                400,
+                "Too many runs in batch (maximum %d)" % MAX_BATCH_RUNS,
+            )
+
+        # Get the combinations of input files
+        try:
+            inputs = await self.get_input_files(experiment, multiple=True)
+        except ValueError as e:
+            raise tornado.web.HTTPError(400, str(e))
+        inputs = sorted(inputs.items())
+        run_inputs = list(itertools.product(*[v for k, v in inputs]))
+
+        # Create the runs
+        batch = database.Batch(experiment_hash=experiment.hash,
+                               upload_id=upload.id)
+        self.db.add(batch)
+        for values in run_params:
+            for files in run_inputs:
+                run = database.Run(experiment_hash=experiment.hash,
+                                   upload_id=upload.id,
+                                   priority=BATCH_PRIORITY)
+                for name, value in sorted(values.items()):
+                    run.parameter_values.append(
+                        database.ParameterValue(name=name, value=value)
+                    )
+                for input_file in files:
+                    run.input_files.append(database.InputFile(**input_file))
+                batch.runs.append(run)
+        await self.run_db(lambda db: db.commit())
+        logger.info("Created batch %d with %d runs",
+                    batch.id, len(batch.runs))
+
+        # The image is acquired once, before the runs start
+        self.prebuild(experiment)
+        for run in batch.runs:
+            self.application.runner.run(run.id)
+
+        if self.is_json_requested():
+            self.set_status(201)
+            return self.send_json({
+                'id': batch.short_id,
+                'url': self.reverse_url('batch', batch.short_id),
+                'runs': [run.short_id for run in batch.runs],
+            })
+        else:
+            return self.redirect(
+                self.reverse_url('batch', batch.short_id),
+                status=302,
+            )
+
+
+class BaseBatchResults(BaseHandler):
+    async def get_batch(self, batch_short_id):
+        """Look up a batch and its runs, or return None.
+        """
+        try:
+            batch_id = database.Batch.decode_id(batch_short_id)
+        except ValueError:
+            return None
+
+        return await self.run_db(lambda db: (
+            db.query(database.Batch)
+            .options(joinedload(database.Batch.upload),
+                     joinedload(database.Batch.runs)
+                     .joinedload(database.Run.parameter_values),
+                     joinedload(database.Batch.runs)
+                     .joinedload(database.Run.input_files))
+        ).get(batch_id))
+
+    def get_progress(self, batch):
+        """Summarize the status of the runs in a batch.
+        """
+        progress = {
+            'total': len(batch.runs),
+            'queued': 0,
+            'running': 0,
+            'succeeded': 0,
+            'failed': 0,
+        }
+        runs = []
+        for run in sorted(batch.runs, key=lambda r: r.id):
+            if run.done:
+                status = 'succeeded' if run.success else 'failed'
+            elif run.started:
+                status = 'running'
+            else:
+                status = 'queued'
+            progress[status] += 1
+            runs.append({
+                'id': run.short_id,
+                'url': self.reverse_url('results', run.short_id),
+                'status': status,
+                'parameters': {
+                    param.name: param.value
+                    for param in run.parameter_values
+                },
+                'inputs': {
+                    input_file.name: input_file.hash
+                    for input_file in run.input_files
+                },
+            })
+        progress['done'] = (
+            progress['succeeded'] + progress['failed'] == progress['total']
+        )
+        progress['runs'] = runs
+        return progress
+
+
+class BatchResults(BaseBatchResults):
+    PROM_PAGE.labels('batch').inc(0)
+
+    async def get(self, batch_short_id):
+        """Shows the progress of a batch of runs.
+        """
+        PROM_PAGE.labels('batch').inc()
+
+        batch = await self.get_batch(batch_short_id)
+        if batch is None:
+            self.set_status(404)
+            return self.render('results_notfound.html')
+
+        return self.render(
+            'batch.html',
+            batch=batch,
+            progress=self.get_progress(batch),
+            experiment_url=self.url_for_upload(batch.upload),
+        )
+
+
+class BatchResultsJson(BaseBatchResults):
+    async def get(self, batch_short_id):
+        batch = await self.get_batch(batch_short_id)
+        if batch is None:
+            return self.send_error_json(404, "Not found")
+
+        return self.send_json(self.get_progress(batch))
+
+
 class Results(BaseHandler):
     PROM_PAGE.labels('results').inc(0)
 
-    def get(self, run_short_id):
+    async def get(self, run_short_id):
         """Shows the results of a run, whether it's done or in progress.
         """
         PROM_PAGE.labels('results').inc()
@@ -365,20 +753,19 @@ class Results(BaseHandler):
             return self.render('results_notfound.html')
 
         # Look up the run in the database
-        run = (
-            self.db.query(database.Run)
+        run = await self.run_db(lambda db: (
+            db.query(database.Run)
             .options(joinedload(database.Run.experiment),
                      joinedload(database.Run.upload),
-                     joinedload(database.Run.parameter_values),
-                     joinedload(database.Run.input_files),
-                     joinedload(database.Run.output_files))
-        ).get(run_id)
+                     joinedload(database.Run.output_files),
+                     joinedload(database.Run.ports))
+        ).get(run_id))
         if run is None:
             self.set_status(404)
             return self.render('results_notfound.html')
         # Update last access
-        run.experiment.last_access = datetime.utcnow()
-        self.db.commit()
+        self.application.access_tracker.touch(run.experiment_hash)
+        await self.load_output_paths(run.experiment_hash)
 
         def get_port_url(port_number):
             tpl = os.environ.get(
@@ -390,10 +777,20 @@ class Results(BaseHandler):
                 port=port_number,
             )
 
+        # Only show the end of the log
+        log_length = await self.run_db(get_log_length, run.id)
+        log_start = max(0, log_length - MAX_RESULTS_LOG_LINES)
+        log = await get_log(
+            self.db, self.application.object_store,
+            run.id, log_start,
+            db_executor=self.application.db_executor,
+        )
+
         return self.render(
             'results.html',
             run=run,
-            log=run.get_log(0),
+            log=log,
+            log_start=log_start,
             started=bool(run.started),
             done=bool(run.done),
             experiment_url=self.url_for_upload(run.upload),
@@ -402,33 +799,122 @@ class Results(BaseHandler):
 
 
 class ResultsJson(BaseHandler):
-    def get(self, run_short_id):
+    async def get(self, run_short_id):
         # Decode info from URL
         try:
             run_id = database.Run.decode_id(run_short_id)
         except ValueError:
             return self.send_error_json(404, "Not found")
 
-        # Look up the run in the database
-        run = (
-            self.db.query(database.Run)
-            .options(joinedload(database.Run.experiment),
-                     joinedload(database.Run.upload),
-                     joinedload(database.Run.parameter_values),
-                     joinedload(database.Run.input_files),
-                     joinedload(database.Run.output_files))
-        ).get(run_id)
+        # Look up the run's status in the database
+        run = await self.run_db(lambda db: (
+            db.query(database.Run.started, database.Run.done)
+            .filter(database.Run.id == run_id)
+        ).one_or_none())
         if run is None:
             return self.send_error_json(404, "Not found")
 
-        log_from = int(self.get_query_argument('log_from', '0'), 10)
+        # Get the log lines after the cursor
+        try:
+            log_from = int(self.get_query_argument('log_from', '0'), 10)
+            limit = int(self.get_query_argument(
+                'limit', str(MAX_JSON_LOG_LINES),
+            ), 10)
+        except ValueError:
+            return self.send_error_json(400, "Invalid cursor")
+        if log_from < 0:
+            return self.send_error_json(400, "Invalid cursor")
+        limit = max(0, min(limit, MAX_JSON_LOG_LINES))
+        log = await get_log(
+            self.db, self.application.object_store,
+            run_id, log_from, log_from + limit,
+            db_executor=self.application.db_executor,
+        )
         return self.send_json({
             'started': bool(run.started),
             'done': bool(run.done),
-            'log': run.get_log(log_from),
+            'log': log,
+            'cursor': log_from + len(log),
         })
 
 
+class ResultsStream(BaseHandler):
+    """Pushes log lines and status changes of a run, as Server-Sent Events.
+    """
+    def initialize(self):
+        self.subscription = None
+
+    async def get(self, run_short_id):
+        # Decode info from URL
+        try:
+            run_id = database.Run.decode_id(run_short_id)
+        except ValueError:
+            return self.send_error_json(404, "Not found")
+
+        # Check that the run exists
+        run = await self.run_db(lambda db: (
+            db.query(database.Run.id)
+            .filter(database.Run.id == run_id)
+        ).one_or_none())
+        if run is None:
+            return self.send_error_json(404, "Not found")
+        await self.run_db(lambda db: db.close())
+
+        # Reconnecting clients tell us which line they got to
+        log_from = self.request.headers.get('Last-Event-ID')
+        if log_from is None:
+            log_from = self.get_query_argument('log_from', '0')
+        try:
+            log_from = int(log_from, 10)
+        except ValueError:
+            raise tornado.web.HTTPError(400, "Invalid cursor")
+        if log_from < 0:
+            raise tornado.web.HTTPError(400, "Invalid cursor")
+
+        self.set_header('Content-Type', 'text/event-stream; charset=utf-8')
+        self.set_header('Cache-Control', 'no-cache')
+        self.set_header('X-Accel-Buffering', 'no')
+        self.subscription = self.application.log_hub.subscribe(
+            run_id, log_from,
+        )
+        try:
+            while True:
+                event = await self.subscription.get()
+                if event is None:
+                    break
+                elif event[0] == 'status':
+                    self.write_event('status', {
+                        'started': event[1],
+                        'done': event[2],
+                    })
+                else:
+                    first_line, lines = event[1:]
+                    lines = lines[self.subscription.position - first_line:]
+                    if not lines:
+                        continue
+                    self.subscription.position += len(lines)
+                    self.write_event(
+                        'log', {'log': lines},
+                        id=self.subscription.position,
+                    )
+                await self.flush()
+        except StreamClosedError:
+            pass
+        finally:
+            self.subscription.close()
+        return self.finish()
+
+    def write_event(self, event, obj, id=None):
+        if id is not None:
+            self.write('id: %d\n' % id)
+        self.write('event: %s\ndata: %s\n\n' % (event, json.dumps(obj)))
+
+    def on_connection_close(self):
+        super(ResultsStream, self).on_connection_close()
+        if self.subscription is not None:
+            self.subscription.close()
+
+
 class About(BaseHandler):
     PROM_PAGE.labels('about').inc(0)
 
@@ -442,11 +928,28 @@ class Data(BaseHandler):
     """
     PROM_PAGE.labels('about').inc(0)
 
-    def get(self):
+    async def get(self):
         PROM_PAGE.labels('data').inc()
+
+        def load(db):
+            return (
+                db.query(database.Experiment)
+                .options(
+                    selectinload(database.Experiment.uploads),
+                    selectinload(database.Experiment.parameters),
+                    selectinload(database.Experiment.paths),
+                    selectinload(database.Experiment.runs)
+                    .selectinload(database.Run.parameter_values),
+                    selectinload(database.Experiment.runs)
+                    .selectinload(database.Run.input_files),
+                    selectinload(database.Experiment.runs)
+                    .selectinload(database.Run.output_files),
+                )
+            ).all()
+
         return self.render(
             'data.html',
-            experiments=self.db.query(database.Experiment).all(),
+            experiments=await self.run_db(load),
         )
 
 
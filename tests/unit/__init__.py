@@ -0,0 +1,23 @@
+import os
+import tempfile
+
+from reproserver import database
+
+
+def make_database(testcase, experiments=('a' * 64,)):
+    """Set up a SQLite database in a temporary directory, for a test.
+
+    An experiment is added for each hash in `experiments`. Returns the
+    sessionmaker; everything is removed when the test ends.
+    """
+    tmp = tempfile.TemporaryDirectory()
+    testcase.addCleanup(tmp.cleanup)
+    DBSession = database.connect(
+        'sqlite:///' + os.path.join(tmp.name, 'db.sqlite3'),
+    )
+    db = DBSession()
+    for experiment_hash in experiments:
+        db.add(database.Experiment(hash=experiment_hash, info='{}'))
+    db.commit()
+    db.close()
+    return DBSession
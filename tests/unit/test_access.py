@@ -0,0 +1,58 @@
+from datetime import datetime, timedelta
+import unittest
+
+from reproserver import database
+from reproserver.web.access import AccessTracker
+
+from . import make_database
+
+
+class TestAccessTracker(unittest.TestCase):
+    def setUp(self):
+        self.DBSession = make_database(
+            self, experiments=['a' * 64, 'b' * 64, 'c' * 64],
+        )
+        self.old = datetime.utcnow() - timedelta(days=2)
+        self.recent = datetime.utcnow() - timedelta(seconds=30)
+        db = self.DBSession()
+        for experiment in db.query(database.Experiment):
+            if experiment.hash == 'b' * 64:
+                experiment.last_access = self.recent
+            else:
+                experiment.last_access = self.old
+        db.commit()
+        db.close()
+
+    def get_last_access(self):
+        db = self.DBSession()
+        try:
+            return {
+                experiment_hash[0]: last_access
+                for experiment_hash, last_access in db.query(
+                    database.Experiment.hash,
+                    database.Experiment.last_access,
+                )
+            }
+        finally:
+            db.close()
+
+    def test_flush(self):
+        tracker = AccessTracker(self.DBSession, threshold=600)
+        tracker.touch('a' * 64)
+        tracker.touch('a' * 64)
+        tracker.touch('b' * 64)
+        tracker.flush()
+
+        last_access = self.get_last_access()
+        # Updated
+        self.assertGreater(last_access['a'], self.recent)
+        # Recent enough, not updated
+        self.assertEqual(last_access['b'], self.recent)
+        # Not accessed
+        self.assertEqual(last_access['c'], self.old)
+
+        # Not written again until the threshold
+        first = last_access['a']
+        tracker.touch('a' * 64)
+        self.assertEqual(tracker._take(datetime.utcnow()), set())
+        self.assertEqual(self.get_last_access()['a'], first)
@@ -0,0 +1,49 @@
+import threading
+import time
+import unittest
+
+from reproserver.run.builds import BuildCoordinator
+
+from . import make_database
+
+
+class TestBuildCoordinator(unittest.TestCase):
+    def test_local_lock(self):
+        coordinator = BuildCoordinator()
+        events = []
+
+        def build(key, name):
+            with coordinator.local_lock(key):
+                events.append('start %s' % name)
+                time.sleep(0.1)
+                events.append('end %s' % name)
+
+        threads = [
+            threading.Thread(target=build, args=('aaa', 'first')),
+            threading.Thread(target=build, args=('aaa', 'second')),
+        ]
+        for thread in threads:
+            thread.start()
+            time.sleep(0.01)
+        # Different key doesn't wait
+        build('bbb', 'other')
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(
+            events,
+            [
+                'start first', 'start other', 'end first',
+                'start second', 'end other', 'end second',
+            ],
+        )
+        self.assertEqual(coordinator._locks, {})
+        # No database, no global lock
+        coordinator.global_lock('aaa')()
+
+    def test_global_lock_sqlite(self):
+        coordinator = BuildCoordinator(make_database(self))
+        # No advisory locks, does nothing
+        coordinator.global_lock('aaa')()
+        coordinator.global_lock('aaa')()
+        self.assertIs(coordinator._lock_engine, False)
@@ -0,0 +1,114 @@
+import prometheus_client
+from sqlalchemy import create_engine, text
+from sqlalchemy.pool import NullPool, QueuePool
+import unittest
+from unittest import mock
+
+from reproserver import database
+
+from . import make_database
+
+
+class TestEngineOptions(unittest.TestCase):
+    def test_defaults(self):
+        self.assertEqual(
+            database._engine_options({}),
+            dict(
+                connect_args={'connect_timeout': 10},
+                pool_size=5,
+                max_overflow=10,
+                pool_timeout=30,
+                pool_recycle=1800,
+                pool_pre_ping=True,
+            ),
+        )
+
+    def test_environ(self):
+        self.assertEqual(
+            database._engine_options({
+                'DB_POOL_SIZE': '20',
+                'DB_MAX_OVERFLOW': '0',
+                'DB_POOL_TIMEOUT': '5',
+                'DB_POOL_RECYCLE': '-1',
+                'DB_POOL_PRE_PING': 'Off',
+                'DB_STATEMENT_TIMEOUT': '60000',
+            }),
+            dict(
+                connect_args={
+                    'connect_timeout': 10,
+                    'options': '-c statement_timeout=60000',
+                },
+                pool_size=20,
+                max_overflow=0,
+                pool_timeout=5,
+                pool_recycle=-1,
+                pool_pre_ping=False,
+            ),
+        )
+
+
+class TestPoolMetrics(unittest.TestCase):
+    def get_sample(self, name):
+        return prometheus_client.REGISTRY.get_sample_value(name)
+
+    def test_queue_pool(self):
+        engine = create_engine(
+            'sqlite://',
+            poolclass=QueuePool, pool_size=2, max_overflow=1,
+        )
+        self.addCleanup(engine.dispose)
+        database._export_pool_metrics(engine)
+        self.assertEqual(self.get_sample('db_pool_size'), 2)
+        self.assertEqual(self.get_sample('db_pool_checked_out'), 0)
+
+        invalidated = self.get_sample('db_pool_invalidated_total')
+        conns = [engine.connect() for _ in range(3)]
+        self.assertEqual(self.get_sample('db_pool_checked_out'), 3)
+        self.assertEqual(self.get_sample('db_pool_overflow'), 1)
+        conns[0].invalidate()
+        self.assertEqual(
+            self.get_sample('db_pool_invalidated_total'),
+            invalidated + 1,
+        )
+        for conn in conns:
+            conn.close()
+        self.assertEqual(self.get_sample('db_pool_checked_out'), 0)
+
+    def test_other_pool(self):
+        engine = create_engine('sqlite://', poolclass=NullPool)
+        with mock.patch.object(database, 'PROM_POOL_SIZE') as size:
+            database._export_pool_metrics(engine)
+        size.set_function.assert_not_called()
+
+
+class TestDispose(unittest.TestCase):
+    def test_dispose(self):
+        DBSession = make_database(self)
+        db = DBSession()
+        engine = db.get_bind()
+        db.execute(text('SELECT 1'))
+        db.close()
+        with mock.patch.object(engine, 'dispose') as dispose:
+            database.dispose(DBSession)
+        dispose.assert_called_once_with()
+
+
+class TestUpgrade(unittest.TestCase):
+    def test_backfill(self):
+        DBSession = make_database(self)
+        db = DBSession()
+        db.add(database.Run(experiment_hash='a' * 64))
+        db.commit()
+        engine = db.get_bind()
+        db.close()
+
+        # Database from before the queue
+        with engine.begin() as conn:
+            conn.execute(text('ALTER TABLE runs DROP COLUMN dispatched'))
+        database._add_missing_columns(engine)
+
+        # The old run is not pending
+        db = DBSession()
+        run = db.query(database.Run).one()
+        self.assertEqual(run.dispatched, run.submitted)
+        db.close()
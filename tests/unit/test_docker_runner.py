@@ -0,0 +1,204 @@
+from hashlib import sha256
+import io
+import os
+import tarfile
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from reproserver import database
+from reproserver.run.docker import DockerRunner
+from reproserver.run.dockerapi import DockerClient, DockerError
+
+from .test_dockerapi import FakeDockerDaemon
+
+
+class FakeObjectStore(object):
+    def __init__(self, objects):
+        self.objects = objects
+        self.downloads = []
+
+    def download_fileobj(self, bucket, objectname, fileobj):
+        self.downloads.append((bucket, objectname))
+        if objectname == 'slow':
+            time.sleep(0.1)
+        fileobj.write(self.objects[(bucket, objectname)])
+
+    def upload_fileobj_hashed(self, bucket, fileobj, size):
+        data = fileobj.read()
+        assert len(data) == size
+        filehash = sha256(data).hexdigest()
+        self.objects[(bucket, filehash)] = data
+        return filehash
+
+
+class FakeDockerClient(object):
+    def __init__(self, local=(), registry=()):
+        self.local = set(local)
+        self.registry = set(registry)
+        self.calls = []
+
+    def image_inspect(self, name):
+        self.calls.append(('inspect', name))
+        if name in self.local:
+            return {'Id': 'sha256:1234'}
+        return None
+
+    def image_pull(self, name):
+        self.calls.append(('pull', name))
+        if name not in self.registry:
+            raise DockerError(404, "manifest unknown")
+        self.local.add(name)
+
+
+class TestGetImage(unittest.TestCase):
+    def setUp(self):
+        self.runner = DockerRunner(DBSession=None, object_store=None)
+        self.image = self.runner._image_name('a' * 64)
+        build_image = mock.patch.object(self.runner, '_build_image')
+        self.build_image = build_image.start()
+        self.addCleanup(build_image.stop)
+        popen = mock.patch('reproserver.run.docker.subprocess.Popen')
+        self.popen = popen.start()
+        self.addCleanup(popen.stop)
+
+    def test_local(self):
+        self.runner.docker = FakeDockerClient(local=[self.image])
+        self.assertIsNone(self.runner._get_image('a' * 64))
+        self.assertEqual(self.runner.docker.calls, [('inspect', self.image)])
+
+        # Known now, Docker is not asked again
+        self.assertIsNone(self.runner._get_image('a' * 64))
+        self.assertEqual(len(self.runner.docker.calls), 1)
+        self.build_image.assert_not_called()
+
+    def test_pull(self):
+        self.runner.docker = FakeDockerClient(registry=[self.image])
+        self.assertIsNone(self.runner._get_image('a' * 64))
+        self.assertEqual(
+            self.runner.docker.calls,
+            [
+                ('inspect', self.image),
+                ('inspect', self.image),
+                ('pull', self.image),
+            ],
+        )
+        self.build_image.assert_not_called()
+        self.popen.assert_not_called()
+
+        self.assertIsNone(self.runner._get_image('a' * 64))
+        self.assertEqual(len(self.runner.docker.calls), 3)
+
+    def test_build(self):
+        self.runner.docker = FakeDockerClient()
+        self.assertIs(
+            self.runner._get_image('a' * 64),
+            self.popen.return_value,
+        )
+        self.assertEqual(
+            self.runner.docker.calls,
+            [
+                ('inspect', self.image),
+                ('inspect', self.image),
+                ('pull', self.image),
+            ],
+        )
+        self.build_image.assert_called_once_with('a' * 64, self.image)
+        self.popen.assert_called_once_with(['docker', 'push', self.image])
+
+        # Built once, the next run uses it
+        self.assertIsNone(self.runner._get_image('a' * 64))
+        self.assertEqual(self.build_image.call_count, 1)
+
+    def test_build_error(self):
+        self.runner.docker = FakeDockerClient()
+        self.build_image.side_effect = ValueError("build failed")
+        with self.assertRaises(ValueError):
+            self.runner._get_image('a' * 64)
+        self.popen.assert_not_called()
+
+        # Not remembered as present, the next run tries again
+        self.build_image.side_effect = None
+        self.runner._get_image('a' * 64)
+        self.assertEqual(self.build_image.call_count, 2)
+
+
+class TestDockerRunner(unittest.TestCase):
+    def test_input_archive(self):
+        object_store = FakeObjectStore({
+            ('inputs', 'slow'): b'first file',
+            ('inputs', 'bbbb'): b'x' * 1000,
+            ('inputs', 'cccc'): b'',
+        })
+        runner = DockerRunner(DBSession=None, object_store=object_store)
+        inputs = [
+            (database.InputFile(name='one', hash='slow', size=10),
+             '/data/one.txt'),
+            (database.InputFile(name='two', hash='bbbb', size=1000),
+             '/data/sub/two.bin'),
+            (database.InputFile(name='three', hash='cccc', size=0),
+             '/three'),
+        ]
+        archive = b''.join(runner._input_archive(inputs))
+        self.assertEqual(len(archive) % tarfile.BLOCKSIZE, 0)
+
+        # Downloads happen concurrently, in any order
+        self.assertEqual(
+            sorted(object_store.downloads),
+            [('inputs', 'bbbb'), ('inputs', 'cccc'), ('inputs', 'slow')],
+        )
+
+        # Files are in the archive in order
+        with tarfile.open(fileobj=io.BytesIO(archive), mode='r') as tar:
+            self.assertEqual(
+                [
+                    (member.name, tar.extractfile(member).read())
+                    for member in tar
+                ],
+                [
+                    ('data/one.txt', b'first file'),
+                    ('data/sub/two.bin', b'x' * 1000),
+                    ('three', b''),
+                ],
+            )
+
+    def test_outputs(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        daemon = FakeDockerDaemon(os.path.join(tmp.name, 'docker.sock'))
+        thread = threading.Thread(target=daemon.serve_forever)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(daemon.server_close)
+        self.addCleanup(daemon.shutdown)
+
+        object_store = FakeObjectStore({})
+        runner = DockerRunner(DBSession=None, object_store=object_store)
+        runner.docker = DockerClient(
+            'unix://' + os.path.join(tmp.name, 'docker.sock'),
+        )
+        daemon.containers['run_1'] = {}
+        daemon.files['run_1'] = {
+            '/data/out.txt': b'result',
+            '/data/big.bin': b'y' * 100000,
+        }
+        paths = [
+            database.Path(name='out', path='/data/out.txt'),
+            database.Path(name='missing', path='/data/missing.txt'),
+            database.Path(name='big', path='/data/big.bin'),
+        ]
+        outputs = runner._upload_outputs('run_1', paths)
+        self.assertEqual(
+            [(path.name, filehash, size) for path, filehash, size in outputs],
+            [
+                ('out', sha256(b'result').hexdigest(), 6),
+                ('missing', None, None),
+                ('big', sha256(b'y' * 100000).hexdigest(), 100000),
+            ],
+        )
+        self.assertEqual(
+            object_store.objects[('outputs', outputs[0][1])],
+            b'result',
+        )
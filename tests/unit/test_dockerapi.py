@@ -0,0 +1,211 @@
+from http.server import BaseHTTPRequestHandler
+import io
+import json
+import os
+import socketserver
+import struct
+import tarfile
+import tempfile
+import threading
+import unittest
+import urllib.parse
+
+from reproserver.run.dockerapi import DockerClient, DockerError
+
+
+class FakeDockerHandler(BaseHTTPRequestHandler):
+    """Implements the few Docker Engine API calls used by the runner.
+    """
+    def log_message(self, format, *args):
+        pass
+
+    def send_data(self, status, data, content_type='application/json'):
+        if not isinstance(data, bytes):
+            data = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_body(self):
+        if self.headers.get('Transfer-Encoding') == 'chunked':
+            body = b''
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                body += self.rfile.read(size)
+                self.rfile.readline()
+                if size == 0:
+                    return body
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def route(self, method):
+        url = urllib.parse.urlparse(self.path)
+        self.query = dict(urllib.parse.parse_qsl(url.query))
+        parts = url.path.split('/')[2:]
+        daemon = self.server
+        if parts == ['_ping']:
+            return self.send_data(200, b'OK', 'text/plain')
+        elif parts[0] == 'images' and parts[-1] == 'json':
+            name = '/'.join(parts[1:-1])
+            if name in daemon.images:
+                return self.send_data(200, {'Id': name})
+            return self.send_data(404, {'message': "No such image"})
+        elif parts == ['images', 'create']:
+            name = '%s:%s' % (self.query['fromImage'], self.query['tag'])
+            if name in daemon.registry:
+                daemon.images.add(name)
+                progress = {'status': "Downloaded"}
+            else:
+                progress = {'error': "manifest unknown"}
+            return self.send_data(200, json.dumps(progress).encode() + b'\n')
+        elif parts == ['containers', 'create']:
+            config = json.loads(self.read_body().decode('utf-8'))
+            if config['Image'] not in daemon.images:
+                return self.send_data(404, {'message': "No such image"})
+            daemon.containers[self.query['name']] = config
+            daemon.files[self.query['name']] = {}
+            return self.send_data(201, {'Id': self.query['name']})
+        container = parts[1]
+        if container not in daemon.containers:
+            return self.send_data(404, {'message': "No such container"})
+        files = daemon.files[container]
+        if method == 'DELETE':
+            del daemon.containers[container]
+            return self.send_data(204, b'')
+        elif parts[2] == 'start':
+            return self.send_data(204, b'')
+        elif parts[2] == 'wait':
+            return self.send_data(200, {'StatusCode': 0})
+        elif parts[2] == 'logs':
+            frames = b''
+            for stream, data in daemon.output:
+                frames += struct.pack('>BxxxL', stream, len(data)) + data
+            return self.send_data(200, frames, 'application/octet-stream')
+        elif parts[2] == 'archive' and method == 'PUT':
+            body = self.read_body()
+            with tarfile.open(fileobj=io.BytesIO(body), mode='r') as tar:
+                for member in tar:
+                    name = os.path.join(self.query['path'], member.name)
+                    files[name] = tar.extractfile(member).read()
+            return self.send_data(200, b'', 'text/plain')
+        elif parts[2] == 'archive' and method == 'GET':
+            if self.query['path'] not in files:
+                return self.send_data(404, {'message': "No such file"})
+            archive = io.BytesIO()
+            with tarfile.open(fileobj=archive, mode='w') as tar:
+                data = files[self.query['path']]
+                info = tarfile.TarInfo(os.path.basename(self.query['path']))
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+            return self.send_data(200, archive.getvalue(), 'application/x-tar')
+        self.send_data(404, {'message': "Not implemented"})
+
+    def do_GET(self):
+        self.route('GET')
+
+    def do_POST(self):
+        self.route('POST')
+
+    def do_PUT(self):
+        self.route('PUT')
+
+    def do_DELETE(self):
+        self.route('DELETE')
+
+
+class FakeDockerDaemon(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path):
+        super(FakeDockerDaemon, self).__init__(path, FakeDockerHandler)
+        self.registry = set()
+        self.images = set()
+        self.containers = {}
+        self.files = {}
+        self.output = []
+
+    def handle_error(self, request, client_address):
+        # Clients might close the connection without reading everything
+        pass
+
+
+class TestDockerClient(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        socket_path = os.path.join(self.tmp.name, 'docker.sock')
+        self.daemon = FakeDockerDaemon(socket_path)
+        self.thread = threading.Thread(target=self.daemon.serve_forever)
+        self.thread.start()
+        self.client = DockerClient('unix://' + socket_path)
+
+    def tearDown(self):
+        self.daemon.shutdown()
+        self.daemon.server_close()
+        self.thread.join()
+        self.tmp.cleanup()
+
+    def test_images(self):
+        self.assertTrue(self.client.ping())
+        self.daemon.registry.add('registry:5000/exp:latest')
+
+        self.assertIsNone(self.client.image_inspect('registry:5000/exp'))
+        self.client.image_pull('registry:5000/exp')
+        self.assertEqual(
+            self.client.image_inspect('registry:5000/exp:latest'),
+            {'Id': 'registry:5000/exp:latest'},
+        )
+        with self.assertRaises(DockerError):
+            self.client.image_pull('registry:5000/other')
+
+    def test_run(self):
+        self.daemon.images.add('exp:latest')
+        with self.assertRaises(DockerError) as cm:
+            self.client.container_create('run_1', 'other:latest', [])
+        self.assertEqual(cm.exception.status, 404)
+        self.client.container_create(
+            'run_1', 'exp:latest', ['cmd', 'ls', 'run', '1'],
+            ports=[8000], bind_host='127.0.0.1',
+        )
+        self.assertEqual(
+            self.daemon.containers['run_1']['HostConfig']['PortBindings'],
+            {'8000/tcp': [{'HostIp': '127.0.0.1', 'HostPort': '8000'}]},
+        )
+
+        # Copy a file in, from a file object
+        archive = io.BytesIO()
+        with tarfile.open(fileobj=archive, mode='w') as tar:
+            info = tarfile.TarInfo('input.txt')
+            info.size = 5
+            tar.addfile(info, io.BytesIO(b'hello'))
+        archive.seek(0, 0)
+        self.client.put_archive('run_1', '/data', archive)
+        self.assertEqual(
+            self.daemon.files['run_1'],
+            {'/data/input.txt': b'hello'},
+        )
+
+        # Lines are split across frames and streams
+        self.daemon.output = [
+            (1, b'first line\nsec'),
+            (2, b'ond line\n'),
+            (1, b'last'),
+        ]
+        self.client.container_start('run_1')
+        self.assertEqual(
+            list(self.client.container_logs('run_1')),
+            ['first line', 'second line', 'last'],
+        )
+        self.assertEqual(self.client.container_wait('run_1'), 0)
+
+        # Copy a file out
+        with self.client.get_archive('run_1', '/data/input.txt') as response:
+            with tarfile.open(fileobj=response, mode='r|') as tar:
+                member = tar.next()
+                self.assertEqual(member.name, 'input.txt')
+                self.assertEqual(tar.extractfile(member).read(), b'hello')
+        with self.assertRaises(DockerError):
+            self.client.get_archive('run_1', '/data/missing.txt')
+
+        self.client.container_remove('run_1')
+        self.client.container_remove('run_1')
+        self.assertEqual(self.daemon.containers, {})
@@ -0,0 +1,309 @@
+import asyncio
+from datetime import datetime, timezone
+import kubernetes.client as k8s
+from tornado.testing import AsyncTestCase, gen_test
+from types import SimpleNamespace
+import unittest
+from unittest import mock
+
+from reproserver import database
+from reproserver.run.k8s import LEASE_POOL, K8sRunner, PodInformer
+import reproserver.run.k8s
+
+from . import make_database
+
+
+def make_pod(name, terminated=None):
+    if terminated is None:
+        container_statuses = None
+    else:
+        container_statuses = [SimpleNamespace(
+            name='runner',
+            state=SimpleNamespace(terminated=SimpleNamespace(
+                exit_code=terminated,
+            )),
+        )]
+    return SimpleNamespace(
+        metadata=SimpleNamespace(name=name),
+        status=SimpleNamespace(
+            start_time=datetime(2020, 1, 1),
+            container_statuses=container_statuses,
+        ),
+    )
+
+
+class TestPodInformer(AsyncTestCase):
+    @gen_test
+    async def test_events(self):
+        informer = PodInformer('default', 'app=run')
+        informer._reset([make_pod('run-1'), make_pod('run-2', 0)], 0)
+
+        # Already terminated
+        pod = await informer.wait_terminated('run-2')
+        self.assertEqual(pod.metadata.name, 'run-2')
+
+        # Terminates later
+        run1 = informer.wait_terminated('run-1')
+        run3 = informer.wait_terminated('run-3')
+        await asyncio.sleep(0)
+        self.assertFalse(run1.done())
+        informer._event('MODIFIED', make_pod('run-1'))
+        self.assertFalse(run1.done())
+        informer._event('MODIFIED', make_pod('run-1', 1))
+        self.assertEqual((await run1).status.container_statuses[0].name,
+                         'runner')
+
+        # Listed before the wait started, not considered gone
+        informer._reset([], 0)
+        self.assertFalse(run3.done())
+        informer._event('ADDED', make_pod('run-3'))
+        informer._event('DELETED', make_pod('run-3'))
+        self.assertIsNone(await run3)
+
+        # Gone from a new list
+        run4 = informer.wait_terminated('run-4')
+        informer._reset([], float('inf'))
+        self.assertIsNone(await run4)
+
+
+class TestWarmPool(unittest.TestCase):
+    def test_claim(self):
+        DBSession = make_database(self)
+        db = DBSession()
+        runs = [
+            database.Run(experiment_hash='a' * 64, runner_lease=lease)
+            for lease in [None, LEASE_POOL, 'run-3', LEASE_POOL]
+        ]
+        runs[3].priority = 1
+        db.add_all(runs)
+        db.commit()
+        run_ids = [run.id for run in runs]
+        db.close()
+
+        # Offered runs are claimed once each, by priority
+        self.assertEqual(
+            K8sRunner._claim_run(DBSession, 'run-pool-1'),
+            run_ids[3],
+        )
+        self.assertEqual(
+            K8sRunner._claim_run(DBSession, 'run-pool-2'),
+            run_ids[1],
+        )
+        self.assertIsNone(K8sRunner._claim_run(DBSession, 'run-pool-3'))
+
+        db = DBSession()
+        self.assertEqual(
+            [
+                lease for lease, in db.query(database.Run.runner_lease)
+                .order_by(database.Run.id)
+            ],
+            [None, 'run-pool-2', 'run-3', 'run-pool-1'],
+        )
+        db.close()
+
+
+def make_idle_pod(name, phase='Running', created=None):
+    return SimpleNamespace(
+        metadata=SimpleNamespace(
+            name=name,
+            labels={'app': 'run-pool'},
+            creation_timestamp=created or datetime.now(timezone.utc),
+            deletion_timestamp=None,
+        ),
+        status=SimpleNamespace(
+            phase=phase,
+            start_time=None,
+            container_statuses=None,
+        ),
+    )
+
+
+class TestWarmPoolOffers(AsyncTestCase):
+    def setUp(self):
+        super(TestWarmPoolOffers, self).setUp()
+        self.DBSession = make_database(self)
+        self.runner = K8sRunner.__new__(K8sRunner)
+        self.runner.DBSession = self.DBSession
+        self.runner.informer = PodInformer('default', 'app=run-pool')
+        self.runner._pool_pending = set()
+        self.runner._pool_offers = 0
+        self.runner._pool_claimed = set()
+
+    def add_run(self):
+        db = self.DBSession()
+        run = database.Run(experiment_hash='a' * 64)
+        db.add(run)
+        db.commit()
+        run_id = run.id
+        db.close()
+        return run_id
+
+    @gen_test
+    async def test_offers(self):
+        self.runner.informer._reset(
+            [
+                make_idle_pod('run-pool-1'),
+                make_idle_pod('run-pool-2', 'Pending'),
+            ],
+            0,
+        )
+        first, second = self.add_run(), self.add_run()
+
+        offer = asyncio.ensure_future(self.runner._offer_to_pool(first))
+        await asyncio.sleep(0)
+        self.assertEqual(self.runner._pool_offers, 1)
+
+        # Only one pod is running, and it is already offered a run
+        self.assertIsNone(await self.runner._offer_to_pool(second))
+        self.assertIsNone(self.runner._get_lease(second))
+
+        # Idle pod takes it once it is offered
+        while self.runner._get_lease(first) != LEASE_POOL:
+            await asyncio.sleep(0.01)
+        self.assertEqual(
+            K8sRunner._claim_run(self.DBSession, 'run-pool-1'),
+            first,
+        )
+        self.assertEqual(await offer, 'run-pool-1')
+        self.assertEqual(self.runner._pool_offers, 0)
+
+        # The pod that took the run is not available, even if still labeled
+        self.assertIsNone(await self.runner._offer_to_pool(second))
+
+        # Relabeled
+        self.runner.informer._reset([make_idle_pod('run-pool-3')], 0)
+        with mock.patch.object(reproserver.run.k8s, 'K8S_WARM_PODS', 1):
+            self.runner._maintain_pool(reschedule=False)
+        self.assertEqual(self.runner._pool_claimed, set())
+        self.assertEqual(self.runner._available_idle_pods(), 1)
+
+    @gen_test
+    async def test_stuck(self):
+        old = datetime(2020, 1, 1, tzinfo=timezone.utc)
+        self.runner.informer._reset(
+            [
+                make_idle_pod('run-pool-1'),
+                make_idle_pod('run-pool-2', 'Pending'),
+                make_idle_pod('run-pool-3', 'Pending', old),
+                make_idle_pod('run-pool-4', 'Running', old),
+            ],
+            0,
+        )
+        deleted = asyncio.Event()
+        self.runner._delete_idle_pod = mock.Mock(
+            side_effect=lambda name: self.io_loop.add_callback(deleted.set),
+        )
+        self.runner._create_idle_pod = mock.Mock()
+        with mock.patch.object(reproserver.run.k8s, 'K8S_WARM_PODS', 4):
+            self.runner._maintain_pool(reschedule=False)
+        await deleted.wait()
+
+        # The pod that never started is replaced
+        self.runner._delete_idle_pod.assert_called_once_with('run-pool-3')
+        self.assertEqual(len(self.runner._pool_pending), 1)
+
+
+class FakeCoreV1Api(object):
+    def __init__(self, pods=(), create_error=None):
+        self.pods = {pod.metadata.name: pod for pod in pods}
+        self.create_error = create_error
+        self.deleted = []
+
+    def create_namespaced_pod(self, namespace, body):
+        if self.create_error is not None:
+            raise k8s.rest.ApiException(status=self.create_error)
+        self.pods[body.metadata.name] = SimpleNamespace(
+            metadata=SimpleNamespace(
+                name=body.metadata.name,
+                creation_timestamp=datetime(2020, 1, 2),
+                deletion_timestamp=None,
+            ),
+        )
+
+    def list_namespaced_pod(self, namespace, label_selector):
+        return SimpleNamespace(items=list(self.pods.values()))
+
+    def delete_namespaced_pod(self, name, namespace):
+        self.deleted.append(name)
+        if self.pods.pop(name, None) is None:
+            raise k8s.rest.ApiException(status=404)
+
+
+class TestPrebuild(unittest.TestCase):
+    def setUp(self):
+        self.DBSession = make_database(self)
+        db = self.DBSession()
+        db.query(database.Experiment).get('a' * 64).build_status = 'queued'
+        db.commit()
+        db.close()
+
+        self.runner = K8sRunner.__new__(K8sRunner)
+        self.runner.DBSession = self.DBSession
+        self.runner._load_config = lambda: (
+            'default',
+            {'containers': [{'name': 'runner'}]},
+        )
+        self.wait_for_pod = mock.patch.object(
+            self.runner, '_wait_for_pod', return_value=True,
+        ).start()
+        self.addCleanup(mock.patch.stopall)
+        mock.patch('reproserver.run.k8s.PREBUILD_WORKERS', 1).start()
+
+    def prebuild(self, client):
+        with mock.patch('kubernetes.client.CoreV1Api', return_value=client):
+            self.runner._prebuild_pod('a' * 64)
+
+    def get_status(self):
+        db = self.DBSession()
+        try:
+            return db.query(database.Experiment).get('a' * 64).build_status
+        finally:
+            db.close()
+
+    def test_built(self):
+        client = FakeCoreV1Api()
+        self.prebuild(client)
+        self.assertEqual(self.wait_for_pod.call_count, 1)
+        self.assertEqual(client.deleted, ['build-' + 'a' * 40])
+        # Set by the build pod, not here
+        self.assertEqual(self.get_status(), 'queued')
+
+    def test_failed(self):
+        client = FakeCoreV1Api()
+        self.wait_for_pod.return_value = False
+        self.prebuild(client)
+        self.assertEqual(self.get_status(), 'error')
+        self.assertEqual(client.pods, {})
+
+    def test_error(self):
+        client = FakeCoreV1Api()
+        self.wait_for_pod.side_effect = k8s.rest.ApiException(status=500)
+        self.prebuild(client)
+        # Can be tried again
+        self.assertIsNone(self.get_status())
+        self.assertEqual(client.pods, {})
+
+    def test_create_error(self):
+        client = FakeCoreV1Api(create_error=403)
+        self.prebuild(client)
+        self.assertIsNone(self.get_status())
+        self.wait_for_pod.assert_not_called()
+
+    def test_exists(self):
+        # Another process created it, it is followed and deleted too
+        client = FakeCoreV1Api(create_error=409)
+        self.prebuild(client)
+        self.assertEqual(self.wait_for_pod.call_count, 1)
+        self.assertEqual(client.deleted, ['build-' + 'a' * 40])
+
+    def test_too_many(self):
+        other = SimpleNamespace(metadata=SimpleNamespace(
+            name='build-other',
+            creation_timestamp=datetime(2020, 1, 1),
+            deletion_timestamp=None,
+        ))
+        client = FakeCoreV1Api(pods=[other])
+        self.prebuild(client)
+        self.wait_for_pod.assert_not_called()
+        self.assertEqual(list(client.pods), ['build-other'])
+        self.assertIsNone(self.get_status())
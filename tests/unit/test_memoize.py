@@ -0,0 +1,145 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import threading
+from tornado.testing import AsyncTestCase, gen_test
+import unittest
+from unittest import mock
+
+from reproserver import database
+from reproserver.run import memoize
+from reproserver.run.base import BaseRunner
+
+from . import make_database
+
+
+class ReuseTestMixin(object):
+    def setUp(self):
+        super(ReuseTestMixin, self).setUp()
+        self.DBSession = make_database(self)
+        db = self.DBSession()
+        db.add(database.Parameter(
+            experiment_hash='a' * 64,
+            name='cmdline_00001', description="Command line",
+            optional=True, default='python run.py',
+        ))
+        db.commit()
+        db.close()
+
+    def add_run(self, params={}, inputs={}):
+        db = self.DBSession()
+        run = database.Run(experiment_hash='a' * 64)
+        for name, value in params.items():
+            run.parameter_values.append(database.ParameterValue(
+                name=name, value=value,
+            ))
+        for name, filehash in inputs.items():
+            run.input_files.append(database.InputFile(
+                name=name, hash=filehash, size=4,
+            ))
+        db.add(run)
+        db.commit()
+        run_id = run.id
+        db.close()
+        return run_id
+
+    def reuse(self, run_id):
+        db = self.DBSession()
+        try:
+            return memoize.reuse_results(db, run_id)
+        finally:
+            db.close()
+
+    def finish(self, run_id, success):
+        db = self.DBSession()
+        run = db.query(database.Run).get(run_id)
+        run.dispatched = run.started = run.done = datetime.utcnow()
+        run.success = success
+        run.log_chunks.append(database.RunLogChunk(
+            first_line=0, nb_lines=3, object_name='%d/0000000000' % run_id,
+        ))
+        run.output_files.append(database.OutputFile(
+            name='out', hash='b' * 64, size=12,
+        ))
+        db.commit()
+        db.close()
+
+
+class TestReuseResults(ReuseTestMixin, unittest.TestCase):
+    @mock.patch.object(memoize, 'REUSE_RUNS', True)
+    def test_reuse(self):
+        first = self.add_run()
+        self.assertFalse(self.reuse(first))
+        self.finish(first, False)
+
+        # Previous run failed
+        second = self.add_run({'cmdline_00001': 'python run.py'})
+        self.assertFalse(self.reuse(second))
+        self.finish(second, True)
+
+        # Different inputs
+        self.assertFalse(self.reuse(self.add_run(inputs={'in': 'c' * 64})))
+        # Different parameters
+        self.assertFalse(self.reuse(self.add_run({'cmdline_00001': 'ls'})))
+
+        # Same as default parameters
+        third = self.add_run()
+        self.assertTrue(self.reuse(third))
+
+        db = self.DBSession()
+        run = db.query(database.Run).get(third)
+        self.assertEqual(run.reused_run_id, second)
+        self.assertTrue(run.done)
+        self.assertTrue(run.success)
+        self.assertEqual(
+            [(c.nb_lines, c.object_name) for c in run.log_chunks],
+            [(3, '%d/0000000000' % second)],
+        )
+        self.assertEqual(
+            [(f.name, f.hash) for f in run.output_files],
+            [('out', 'b' * 64)],
+        )
+
+        # Disabled for this experiment
+        run.experiment.reuse_runs = False
+        db.commit()
+        db.close()
+        self.assertFalse(self.reuse(self.add_run()))
+
+    def test_disabled(self):
+        first = self.add_run()
+        self.finish(first, True)
+        self.assertFalse(self.reuse(self.add_run()))
+
+
+class TestRunnerReuse(ReuseTestMixin, AsyncTestCase):
+    @mock.patch.object(memoize, 'REUSE_RUNS', True)
+    @gen_test
+    async def test_run(self):
+        db_executor = ThreadPoolExecutor(1)
+        self.addCleanup(db_executor.shutdown)
+        updated = []
+        runner = BaseRunner(
+            DBSession=self.DBSession, object_store=None,
+            run_updated=updated.append, db_executor=db_executor,
+        )
+        runner.scheduler.submit = mock.Mock()
+
+        first = self.add_run()
+        await runner.run(first)
+        runner.scheduler.submit.assert_called_once_with(first)
+        self.finish(first, True)
+
+        # The lookup happens on the executor, the run is not queued
+        second = self.add_run()
+        threads = []
+
+        def reuse_results(db, run_id):
+            threads.append(threading.current_thread())
+            return memoize.reuse_results(db, run_id)
+
+        with mock.patch('reproserver.run.base.reuse_results', reuse_results):
+            await runner.run(second)
+        self.assertEqual(runner.scheduler.submit.call_count, 1)
+        self.assertEqual(updated, [second])
+        self.assertEqual(len(threads), 1)
+        self.assertIsNot(threads[0], threading.current_thread())
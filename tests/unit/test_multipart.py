@@ -0,0 +1,113 @@
+from hashlib import sha256
+import unittest
+
+from reproserver.web.multipart import MultipartError, MultipartParser
+
+
+BODY = (
+    b'--xyzzy\r\n'
+    b'Content-Disposition: form-data; name="_xsrf"\r\n'
+    b'\r\n'
+    b'token\r\n'
+    b'--xyzzy\r\n'
+    b'Content-Disposition: form-data; name="rpz_file"; '
+    b'filename="experiment.rpz"\r\n'
+    b'Content-Type: application/octet-stream\r\n'
+    b'\r\n'
+    b'binary\r\n--xyzz data\r\n\r\n'
+    b'\r\n'
+    b'--xyzzy\r\n'
+    b'Content-Disposition: form-data; name="rpz_url"\r\n'
+    b'\r\n'
+    b'\r\n'
+    b'--xyzzy--\r\n'
+)
+
+FILE_CONTENT = b'binary\r\n--xyzz data\r\n\r\n'
+
+
+class TestMultipart(unittest.TestCase):
+    def check_parser(self, parser):
+        try:
+            parser.finish()
+            self.assertEqual(
+                parser.fields,
+                {'_xsrf': [b'token'], 'rpz_url': [b'']},
+            )
+            self.assertEqual(list(parser.files), ['rpz_file'])
+            uploaded_file, = parser.files['rpz_file']
+            self.assertEqual(uploaded_file.filename, 'experiment.rpz')
+            self.assertEqual(uploaded_file.size, len(FILE_CONTENT))
+            self.assertEqual(
+                uploaded_file.hash,
+                sha256(FILE_CONTENT).hexdigest(),
+            )
+            uploaded_file.file.seek(0, 0)
+            self.assertEqual(uploaded_file.file.read(), FILE_CONTENT)
+        finally:
+            parser.close()
+
+    def test_whole(self):
+        parser = MultipartParser.from_content_type(
+            'multipart/form-data; boundary=xyzzy',
+        )
+        parser.feed(BODY)
+        self.check_parser(parser)
+
+    def test_split(self):
+        for size in (1, 2, 3, 7, 13):
+            parser = MultipartParser.from_content_type(
+                'multipart/form-data; boundary="xyzzy"',
+            )
+            for i in range(0, len(BODY), size):
+                parser.feed(BODY[i:i + size])
+            self.check_parser(parser)
+
+    def test_errors(self):
+        with self.assertRaises(MultipartError):
+            MultipartParser.from_content_type(
+                'application/x-www-form-urlencoded',
+            )
+
+        parser = MultipartParser(b'xyzzy')
+        parser.feed(BODY[:-20])
+        with self.assertRaises(MultipartError):
+            parser.finish()
+        parser.close()
+
+        parser = MultipartParser(b'xyzzy', max_field_size=3)
+        with self.assertRaises(MultipartError):
+            parser.feed(BODY)
+        parser.close()
+
+    def test_limits(self):
+        # Fields are small enough on their own, but not together
+        body = b''.join(
+            b'--xyzzy\r\n'
+            b'Content-Disposition: form-data; name="field%d"\r\n'
+            b'\r\n'
+            b'%s\r\n' % (i, b'x' * 100)
+            for i in range(5)
+        ) + b'--xyzzy--\r\n'
+        parser = MultipartParser(b'xyzzy', max_field_size=100,
+                                 max_fields_size=450)
+        with self.assertRaises(MultipartError):
+            parser.feed(body)
+        parser.close()
+
+        parser = MultipartParser(b'xyzzy', max_field_size=100,
+                                 max_fields_size=500)
+        parser.feed(body)
+        parser.finish()
+        self.assertEqual(len(parser.fields), 5)
+        parser.close()
+
+        # Files count towards the number of parts
+        parser = MultipartParser(b'xyzzy', max_parts=2)
+        with self.assertRaises(MultipartError):
+            parser.feed(BODY)
+        parser.close()
+
+        parser = MultipartParser(b'xyzzy', max_parts=3)
+        parser.feed(BODY)
+        self.check_parser(parser)
@@ -0,0 +1,286 @@
+import botocore.exceptions
+from botocore.stub import ANY, Stubber
+from hashlib import sha256
+import io
+import os
+import unittest
+from unittest import mock
+
+from reproserver.objectstore import ObjectStore
+
+
+class TestMultipart(unittest.TestCase):
+    def setUp(self):
+        with mock.patch.dict(os.environ, S3_KEY='key', S3_SECRET='secret'):
+            self.store = ObjectStore(
+                'http://s3.example.org',
+                'http://s3.example.org',
+                'test-',
+            )
+        self.addCleanup(self.store.executor.shutdown)
+        self.stubber = Stubber(self.store.s3.meta.client)
+        self.stubber.activate()
+        self.addCleanup(self.stubber.deactivate)
+
+    def test_supported(self):
+        self.stubber.add_response(
+            'create_multipart_upload',
+            {'UploadId': 'abc'},
+            {'Bucket': 'test-inputs', 'Key': ANY},
+        )
+        self.stubber.add_response(
+            'abort_multipart_upload',
+            {},
+            {'Bucket': 'test-inputs', 'Key': ANY, 'UploadId': 'abc'},
+        )
+        self.assertTrue(self.store.supports_multipart('inputs'))
+        # Result is cached
+        self.assertTrue(self.store.supports_multipart('inputs'))
+        self.stubber.assert_no_pending_responses()
+
+    def test_unsupported(self):
+        self.stubber.add_client_error(
+            'create_multipart_upload',
+            service_error_code='NotImplemented',
+            http_status_code=501,
+        )
+        self.stubber.add_response(
+            'put_object',
+            {},
+            {'Bucket': 'test-inputs', 'Key': 'hash', 'Body': ANY},
+        )
+        self.store.upload_fileobj('inputs', 'hash', io.BytesIO(b'data'))
+        self.assertFalse(self.store.supports_multipart('inputs'))
+        self.stubber.assert_no_pending_responses()
+
+    @mock.patch('reproserver.objectstore.S3_MULTIPART', 'auto')
+    def test_upload_unsupported(self):
+        # Detection was wrong, uploading fails
+        self.store._multipart = True
+        self.stubber.add_client_error(
+            'put_object',
+            service_error_code='NotImplemented',
+            http_status_code=501,
+        )
+        self.stubber.add_response(
+            'put_object',
+            {},
+            {'Bucket': 'test-inputs', 'Key': 'hash', 'Body': ANY},
+        )
+        self.store.upload_fileobj('inputs', 'hash', io.BytesIO(b'data'))
+        self.assertFalse(self.store.supports_multipart('inputs'))
+        self.stubber.assert_no_pending_responses()
+
+    @mock.patch('reproserver.objectstore.S3_MULTIPART', 'auto')
+    def test_upload_error(self):
+        # Other errors are raised, multipart uploads stay enabled
+        self.store._multipart = True
+        self.stubber.add_client_error(
+            'put_object',
+            service_error_code='AccessDenied',
+            http_status_code=403,
+        )
+        with self.assertRaises(botocore.exceptions.ClientError):
+            self.store.upload_fileobj('inputs', 'hash', io.BytesIO(b'data'))
+        self.assertTrue(self.store.supports_multipart('inputs'))
+        self.stubber.assert_no_pending_responses()
+
+
+class TestKnownObjects(unittest.TestCase):
+    def setUp(self):
+        with mock.patch.dict(os.environ, S3_KEY='key', S3_SECRET='secret'):
+            self.store = ObjectStore(
+                'http://s3.example.org',
+                'http://s3.example.org',
+                'test-',
+            )
+        self.store._multipart = False
+        self.addCleanup(self.store.executor.shutdown)
+        self.stubber = Stubber(self.store.s3.meta.client)
+        self.stubber.activate()
+        self.addCleanup(self.stubber.deactivate)
+
+    def test_upload_once(self):
+        data = b'output data'
+        filehash = sha256(data).hexdigest()
+        self.stubber.add_client_error(
+            'head_object',
+            service_error_code='404',
+            http_status_code=404,
+            expected_params={'Bucket': 'test-outputs', 'Key': filehash},
+        )
+        self.stubber.add_response(
+            'put_object',
+            {},
+            {'Bucket': 'test-outputs', 'Key': filehash, 'Body': ANY},
+        )
+        self.assertEqual(
+            self.store.upload_fileobj_hashed(
+                'outputs', io.BytesIO(data), len(data),
+            ),
+            filehash,
+        )
+        self.stubber.assert_no_pending_responses()
+
+        # Known to exist, no request is made
+        self.assertEqual(
+            self.store.upload_fileobj_hashed(
+                'outputs', io.BytesIO(data), len(data),
+            ),
+            filehash,
+        )
+
+    def test_upload_existing(self):
+        self.stubber.add_response(
+            'head_object',
+            {},
+            {'Bucket': 'test-inputs', 'Key': 'aaaa'},
+        )
+        self.assertFalse(
+            self.store.upload_bytes_once('inputs', 'aaaa', b'data'),
+        )
+        self.assertTrue(self.store.has_object('inputs', 'aaaa'))
+        self.stubber.assert_no_pending_responses()
+
+
+class TestHashedStream(unittest.TestCase):
+    def setUp(self):
+        with mock.patch.dict(os.environ, S3_KEY='key', S3_SECRET='secret'):
+            self.store = ObjectStore(
+                'http://s3.example.org',
+                'http://s3.example.org',
+                'test-',
+            )
+        self.addCleanup(self.store.executor.shutdown)
+        self.stubber = Stubber(self.store.s3.meta.client)
+        self.stubber.activate()
+        self.addCleanup(self.stubber.deactivate)
+        self.stream_stubber = Stubber(self.store.s3_stream)
+        self.stream_stubber.activate()
+        self.addCleanup(self.stream_stubber.deactivate)
+
+        # The stubber doesn't send the body, read it like a request would
+        def send_body(params, **kwargs):
+            params['Body'].read()
+
+        self.store.s3_stream.meta.events.register(
+            'before-parameter-build.s3.PutObject', send_body,
+        )
+        # Streamed to a temporary object rather than read in memory
+        patcher = mock.patch('reproserver.objectstore.HASHED_BUFFER_SIZE', 4)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.data = b'large output data'
+        self.filehash = sha256(self.data).hexdigest()
+        self.stream_stubber.add_response(
+            'put_object',
+            {},
+            {
+                'Bucket': 'test-outputs', 'Key': ANY, 'Body': ANY,
+                'ContentLength': len(self.data),
+            },
+        )
+        self.stubber.add_client_error(
+            'head_object',
+            service_error_code='404',
+            http_status_code=404,
+            expected_params={'Bucket': 'test-outputs', 'Key': self.filehash},
+        )
+
+    def upload(self):
+        self.assertEqual(
+            self.store.upload_fileobj_hashed(
+                'outputs', io.BytesIO(self.data), len(self.data),
+            ),
+            self.filehash,
+        )
+        self.stubber.assert_no_pending_responses()
+        self.stream_stubber.assert_no_pending_responses()
+
+    def test_copy(self):
+        self.store._multipart = False
+        self.stubber.add_response(
+            'copy_object',
+            {},
+            {
+                'Bucket': 'test-outputs', 'Key': self.filehash,
+                'CopySource': {'Bucket': 'test-outputs', 'Key': ANY},
+            },
+        )
+        self.stubber.add_response(
+            'delete_object',
+            {},
+            {'Bucket': 'test-outputs', 'Key': ANY},
+        )
+        self.upload()
+
+    def test_managed_copy(self):
+        # Uses the managed copy, which copies large objects in parts
+        self.store._multipart = True
+        self.stubber.add_response(
+            'head_object',
+            {'ContentLength': len(self.data)},
+            {'Bucket': 'test-outputs', 'Key': ANY},
+        )
+        self.stubber.add_response(
+            'copy_object',
+            {},
+            {
+                'Bucket': 'test-outputs', 'Key': self.filehash,
+                'CopySource': {'Bucket': 'test-outputs', 'Key': ANY},
+            },
+        )
+        self.stubber.add_response(
+            'delete_object',
+            {},
+            {'Bucket': 'test-outputs', 'Key': ANY},
+        )
+        self.upload()
+
+
+class TestPresignedUrls(unittest.TestCase):
+    def setUp(self):
+        with mock.patch.dict(os.environ, S3_KEY='key', S3_SECRET='secret'):
+            self.store = ObjectStore(
+                'http://s3.example.org',
+                'http://s3.example.org',
+                'test-',
+            )
+        self.addCleanup(self.store.executor.shutdown)
+
+    def test_cache(self):
+        client = self.store.s3_client.meta.client
+        with mock.patch.object(client, 'generate_presigned_url',
+                               side_effect=['url1', 'url2', 'url3']) as gen, \
+                mock.patch('time.monotonic', return_value=1000.0):
+            self.assertEqual(
+                self.store.presigned_serve_url(
+                    'outputs', 'aaaa', 'out.txt', 'text/plain',
+                ),
+                'url1',
+            )
+            self.assertEqual(
+                self.store.presigned_serve_url(
+                    'outputs', 'aaaa', 'out.txt', 'text/plain',
+                ),
+                'url1',
+            )
+            self.assertEqual(
+                self.store.presigned_serve_url('outputs', 'aaaa', 'out.txt'),
+                'url2',
+            )
+            self.assertEqual(gen.call_count, 2)
+            self.assertEqual(
+                gen.call_args_list[0][1]['Params']['Bucket'],
+                'test-outputs',
+            )
+
+            # Generated again when it has less than half its lifetime left
+            with mock.patch('time.monotonic', return_value=3000.0):
+                self.assertEqual(
+                    self.store.presigned_serve_url(
+                        'outputs', 'aaaa', 'out.txt', 'text/plain',
+                    ),
+                    'url3',
+                )
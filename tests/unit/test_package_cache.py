@@ -0,0 +1,65 @@
+import os
+import tempfile
+import time
+import unittest
+
+from reproserver.run.cache import PackageCache
+
+
+class TestPackageCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache = PackageCache(self.tmp.name, 25)
+        self.downloads = []
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def downloader(self, content):
+        def download(path):
+            self.downloads.append(content)
+            with open(path, 'wb') as fp:
+                fp.write(content)
+
+        return download
+
+    def cached(self):
+        return sorted(
+            name for name in os.listdir(self.tmp.name)
+            if not name.startswith('.') and not name.endswith('.lock')
+        )
+
+    def test_cache(self):
+        with self.cache.get('aa', self.downloader(b'a' * 10)) as path:
+            with open(path, 'rb') as fp:
+                self.assertEqual(fp.read(), b'a' * 10)
+        with self.cache.get('aa', self.downloader(b'a' * 10)):
+            pass
+        self.assertEqual(self.downloads, [b'a' * 10])
+
+        time.sleep(0.01)
+        with self.cache.get('bb', self.downloader(b'b' * 10)):
+            pass
+        self.assertEqual(self.cached(), ['aa', 'bb'])
+
+        # Use 'aa' so that 'bb' is the least recently used
+        time.sleep(0.01)
+        with self.cache.get('aa', self.downloader(b'a' * 10)):
+            pass
+        time.sleep(0.01)
+        with self.cache.get('cc', self.downloader(b'c' * 10)):
+            pass
+        self.assertEqual(self.cached(), ['aa', 'cc'])
+        self.assertEqual(len(self.downloads), 3)
+
+    def test_in_use(self):
+        with self.cache.get('aa', self.downloader(b'a' * 20)) as path:
+            with self.cache.get('bb', self.downloader(b'b' * 20)):
+                # 'aa' is in use, so it can't be removed
+                self.assertEqual(self.cached(), ['aa', 'bb'])
+            self.assertTrue(os.path.exists(path))
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            with self.cache.get('../aa', self.downloader(b'')):
+                pass
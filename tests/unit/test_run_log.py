@@ -0,0 +1,187 @@
+import asyncio
+from datetime import datetime
+from sqlalchemy import inspect, text
+import time
+from tornado.testing import AsyncTestCase, gen_test
+import unittest
+
+from reproserver import database
+from reproserver.run.base import RunLogWriter
+from reproserver.runlogs import decode_chunk, encode_chunk, get_log, \
+    get_log_length, migrate_log_lines
+from reproserver.web.logstream import RunLogHub
+
+from . import make_database
+
+
+class FakeObjectStore(object):
+    def __init__(self):
+        self.objects = {}
+
+    def upload_bytes(self, bucket, objectname, bytestr):
+        self.objects[(bucket, objectname)] = bytestr
+
+    async def download_many_async(self, bucket, objectnames):
+        return [self.objects[(bucket, name)] for name in objectnames]
+
+
+class RunLogTestMixin(object):
+    def setUp(self):
+        super(RunLogTestMixin, self).setUp()
+        self.object_store = FakeObjectStore()
+        self.DBSession = make_database(self)
+        db = self.DBSession()
+        run = database.Run(experiment_hash='a' * 64)
+        db.add(run)
+        db.commit()
+        self.run_id = run.id
+        db.close()
+
+
+class TestChunks(unittest.TestCase):
+    def test_line_separators(self):
+        lines = ['a\rb', 'c\x0cd', '', 'e\u2028f']
+        self.assertEqual(decode_chunk(encode_chunk(lines)), lines)
+        self.assertEqual(decode_chunk(encode_chunk([])), [])
+
+
+class TestRunLogWriter(RunLogTestMixin, unittest.TestCase):
+    def get_lines(self, from_line=0, to_line=None):
+        db = self.DBSession()
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(get_log(
+                db, self.object_store, self.run_id, from_line, to_line,
+            ))
+        finally:
+            loop.close()
+            db.close()
+
+    def test_batches(self):
+        with RunLogWriter(self.DBSession, self.object_store, self.run_id,
+                          max_lines=3, max_delay=60) as log:
+            log.write('one')
+            log.write('two')
+            self.assertEqual(self.get_lines(), [])
+            log.write('three')
+            self.assertEqual(self.get_lines(), ['one', 'two', 'three'])
+            log('four')
+        self.assertEqual(self.get_lines(), ['one', 'two', 'three', 'four'])
+        self.assertEqual(len(self.object_store.objects), 2)
+
+        # Read ranges
+        self.assertEqual(self.get_lines(2), ['three', 'four'])
+        self.assertEqual(self.get_lines(3), ['four'])
+        self.assertEqual(self.get_lines(4), [])
+        self.assertEqual(self.get_lines(1, 2), ['two'])
+        self.assertEqual(self.get_lines(2, 4), ['three', 'four'])
+        with self.assertRaises(ValueError):
+            self.get_lines(-1)
+
+        db = self.DBSession()
+        self.assertEqual(get_log_length(db, self.run_id), 4)
+        db.close()
+
+    def test_progress_bar(self):
+        with RunLogWriter(self.DBSession, self.object_store, self.run_id,
+                          max_lines=2, max_delay=60) as log:
+            log.write('start')
+            log.write('10%\r50%\r100%')
+            log.write('end')
+        self.assertEqual(self.get_lines(1), ['10%\r50%\r100%', 'end'])
+        self.assertEqual(self.get_lines(2), ['end'])
+
+    def test_migrate(self):
+        db = self.DBSession()
+        db.execute(text(
+            'CREATE TABLE run_logs (id INTEGER PRIMARY KEY, run_id INTEGER, '
+            'timestamp DATETIME, line TEXT NOT NULL)',
+        ))
+        for i, line in enumerate(['one', 'two', 'three', 'four', 'five']):
+            db.execute(
+                text('INSERT INTO run_logs (id, run_id, timestamp, line) '
+                     'VALUES (:id, :run_id, :timestamp, :line)'),
+                {'id': i + 1, 'run_id': self.run_id,
+                 'timestamp': datetime.utcnow(), 'line': line},
+            )
+        db.commit()
+        db.close()
+
+        migrate_log_lines(self.DBSession, self.object_store, chunk_lines=2)
+        self.assertEqual(
+            self.get_lines(),
+            ['one', 'two', 'three', 'four', 'five'],
+        )
+        self.assertEqual(self.get_lines(3), ['four', 'five'])
+        self.assertEqual(len(self.object_store.objects), 3)
+        db = self.DBSession()
+        self.assertFalse(inspect(db.get_bind()).has_table('run_logs'))
+        db.close()
+
+        # Nothing to do the second time
+        migrate_log_lines(self.DBSession, self.object_store)
+
+    def test_delay(self):
+        with RunLogWriter(self.DBSession, self.object_store, self.run_id,
+                          max_lines=100, max_delay=0.1) as log:
+            log.write('one')
+            log.write('two')
+            for _ in range(50):
+                time.sleep(0.05)
+                if self.get_lines():
+                    break
+            self.assertEqual(self.get_lines(), ['one', 'two'])
+
+
+class TestRunLogHub(RunLogTestMixin, AsyncTestCase):
+    async def collect(self, subscription):
+        events = []
+        while True:
+            event = await subscription.get()
+            if event is None:
+                return events
+            events.append(event)
+
+    @gen_test
+    async def test_stream(self):
+        hub = RunLogHub(self.DBSession, self.object_store, interval=0.05)
+        writer = RunLogWriter(self.DBSession, self.object_store, self.run_id,
+                              max_lines=2, on_flush=hub.notify)
+        writer.write('one')
+        writer.write('two')
+
+        sub1 = hub.subscribe(self.run_id, 0)
+        sub2 = hub.subscribe(self.run_id, 1)
+        task1 = asyncio.ensure_future(self.collect(sub1))
+        task2 = asyncio.ensure_future(self.collect(sub2))
+        await asyncio.sleep(0.2)
+
+        # Late subscriber, has to catch up
+        sub3 = hub.subscribe(self.run_id, 0)
+        task3 = asyncio.ensure_future(self.collect(sub3))
+
+        writer.write('three')
+        writer.close()
+        db = self.DBSession()
+        db.query(database.Run).get(self.run_id).done = datetime.utcnow()
+        db.commit()
+        db.close()
+        hub.notify(self.run_id)
+
+        events1 = await task1
+        self.assertEqual(events1, [
+            ('log', 0, ['one', 'two']),
+            ('status', False, False),
+            ('log', 2, ['three']),
+            ('status', False, True),
+        ])
+        events2 = await task2
+        self.assertEqual(events2, events1)
+        events3 = await task3
+        self.assertEqual(events3, [
+            ('log', 0, ['one', 'two']),
+            ('status', False, False),
+            ('log', 2, ['three']),
+            ('status', False, True),
+        ])
+        self.assertEqual(hub._watches, {})
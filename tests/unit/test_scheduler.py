@@ -0,0 +1,193 @@
+import asyncio
+from datetime import datetime
+from tornado.testing import AsyncTestCase, gen_test
+
+from reproserver import database
+from reproserver.run.base import BaseRunner
+from reproserver.run.scheduler import RunScheduler
+
+from . import make_database
+
+
+class TestRunScheduler(AsyncTestCase):
+    def setUp(self):
+        super(TestRunScheduler, self).setUp()
+        self.DBSession = make_database(
+            self, experiments=['a' * 64, 'b' * 64],
+        )
+
+        self.started = {}
+        self.failing = set()
+        self.scheduler = RunScheduler(
+            self.DBSession, self.start_run,
+            max_runs=3, max_runs_per_experiment=2, max_queued=5,
+        )
+
+    def tearDown(self):
+        self.scheduler.stop()
+        super(TestRunScheduler, self).tearDown()
+
+    def start_run(self, run_id):
+        if run_id in self.failing:
+            raise RuntimeError("Can't start run")
+        future = asyncio.get_event_loop().create_future()
+        self.started[run_id] = future
+        return future
+
+    def add_run(self, experiment_hash, priority=0):
+        db = self.DBSession()
+        run = database.Run(experiment_hash=experiment_hash, priority=priority)
+        db.add(run)
+        db.commit()
+        run_id = run.id
+        db.close()
+        self.scheduler.submit(run_id)
+        return run_id
+
+    async def settle(self):
+        for _ in range(5):
+            await asyncio.sleep(0.01)
+
+    @gen_test
+    async def test_limits(self):
+        # Queued before the scheduler started, e.g. before a restart
+        a1 = self.add_run('a' * 64)
+        self.scheduler.start()
+        a2 = self.add_run('a' * 64)
+        a3 = self.add_run('a' * 64)
+        b1 = self.add_run('b' * 64)
+        b2 = self.add_run('b' * 64, priority=1)
+        await self.settle()
+
+        # Priority first, then in order; 2 runs of 'a' at most
+        self.assertEqual(sorted(self.started), sorted([b2, a1, a2]))
+
+        db = self.DBSession()
+        self.assertTrue(self.scheduler.queue_full(db) is False)
+        for _ in range(3):
+            self.add_run('b' * 64)
+        self.assertTrue(self.scheduler.queue_full(db))
+        db.close()
+
+        # Finishing a run of 'a' lets the next one start
+        self.started[a1].set_result(None)
+        await self.settle()
+        self.assertIn(a3, self.started)
+        self.assertNotIn(b1, self.started)
+
+        # Finishing a run of 'b' lets the next one start
+        self.started[b2].set_result(None)
+        await self.settle()
+        self.assertIn(b1, self.started)
+        self.assertEqual(len(self.started), 5)
+
+        # Runs are only dispatched once
+        db = self.DBSession()
+        dispatched = (
+            db.query(database.Run)
+            .filter(database.Run.dispatched.isnot(None))
+        ).count()
+        db.close()
+        self.assertEqual(dispatched, 5)
+
+    @gen_test
+    async def test_start_error(self):
+        self.scheduler.start()
+        a1 = self.add_run('a' * 64)
+        a2 = self.add_run('a' * 64)
+        self.failing.add(a2)
+        await self.settle()
+        self.assertEqual(sorted(self.started), [a1])
+
+        # The run that couldn't start is marked as failed
+        db = self.DBSession()
+        run = db.query(database.Run).get(a2)
+        self.assertIsNotNone(run.done)
+        self.assertIs(run.success, False)
+        self.assertIsNone(db.query(database.Run).get(a1).success)
+        db.close()
+
+    @gen_test
+    async def test_unlimited(self):
+        self.scheduler = RunScheduler(
+            self.DBSession, self.start_run,
+            max_runs=0, max_runs_per_experiment=0, max_queued=0,
+        )
+        self.addCleanup(self.scheduler.executor.shutdown)
+        self.scheduler.start()
+        runs = [self.add_run('a' * 64) for _ in range(5)]
+        await self.settle()
+        self.assertEqual(sorted(self.started), runs)
+        db = self.DBSession()
+        self.assertTrue(self.scheduler.queue_full(db) is False)
+        db.close()
+
+    @gen_test
+    async def test_recover(self):
+        # Dispatched before a restart
+        db = self.DBSession()
+        now = datetime.utcnow()
+        runs = [
+            database.Run(experiment_hash='a' * 64, dispatched=now)
+            for _ in range(3)
+        ]
+        runs[1].started = now
+        db.add_all(runs)
+        db.commit()
+        lost, interrupted, attached = [run.id for run in runs]
+        db.close()
+
+        self.scheduler.attach(
+            attached, 'a' * 64,
+            asyncio.get_event_loop().create_future(),
+        )
+        self.scheduler.start()
+        await self.settle()
+
+        # The run that hadn't started is started again
+        self.assertEqual(list(self.started), [lost])
+        db = self.DBSession()
+        run = db.query(database.Run).get(interrupted)
+        self.assertIsNotNone(run.done)
+        self.assertIs(run.success, False)
+        self.assertIsNone(db.query(database.Run).get(attached).done)
+        db.close()
+
+
+class FailingRunner(BaseRunner):
+    def run_sync(self, run_id):
+        raise RuntimeError("Can't get image")
+
+
+class TestRunFailure(AsyncTestCase):
+    @gen_test
+    async def test_failed(self):
+        DBSession = make_database(self)
+        updated = []
+        runner = FailingRunner(
+            DBSession=DBSession, object_store=None,
+            run_updated=updated.append,
+        )
+        self.addCleanup(runner.scheduler.executor.shutdown)
+        self.addCleanup(runner.scheduler.stop)
+        runner.start()
+
+        db = DBSession()
+        run = database.Run(experiment_hash='a' * 64)
+        db.add(run)
+        db.commit()
+        run_id = run.id
+        db.close()
+        await runner.run(run_id)
+        for _ in range(50):
+            if updated:
+                break
+            await asyncio.sleep(0.01)
+
+        # The run is not left looking queued
+        self.assertEqual(updated, [run_id])
+        db = DBSession()
+        run = db.query(database.Run).get(run_id)
+        self.assertIsNotNone(run.done)
+        self.assertIs(run.success, False)
+        db.close()
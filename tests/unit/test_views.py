@@ -0,0 +1,335 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from hashlib import sha256
+import json
+from tornado.testing import AsyncHTTPTestCase
+import tornado.web
+from unittest import mock
+
+from reproserver import database
+from reproserver import web
+from reproserver.web import views
+
+from . import make_database
+
+
+class FakeApplication(tornado.web.Application):
+    """Application with the handlers from `make_app()`, without services.
+    """
+    def __init__(self, handlers, **kwargs):
+        super(FakeApplication, self).__init__(handlers, **kwargs)
+        self.DBSession = self.test.DBSession
+        self.db_executor = ThreadPoolExecutor(2)
+        self.object_store = mock.Mock()
+        self.object_store.upload_file_once_async = mock.AsyncMock(
+            return_value=True,
+        )
+        self.access_tracker = mock.Mock()
+        self.runner = mock.Mock()
+        self.runner.scheduler.queue_full.return_value = False
+
+
+def multipart_body(fields, files):
+    boundary = 'testboundary'
+    parts = []
+    for name, value in fields:
+        parts.append(
+            'Content-Disposition: form-data; name="%s"\r\n'
+            '\r\n%s' % (name, value)
+        )
+    for name, filename, data in files:
+        parts.append(
+            'Content-Disposition: form-data; name="%s"; filename="%s"\r\n'
+            'Content-Type: application/octet-stream\r\n'
+            '\r\n%s' % (name, filename, data)
+        )
+    body = ''.join('--%s\r\n%s\r\n' % (boundary, part) for part in parts)
+    body += '--%s--\r\n' % boundary
+    return (
+        body.encode('utf-8'),
+        {'Content-Type': 'multipart/form-data; boundary=%s' % boundary},
+    )
+
+
+class ViewTestCase(AsyncHTTPTestCase):
+    def setUp(self):
+        self.DBSession = make_database(self)
+        db = self.DBSession()
+        experiment = db.query(database.Experiment).get('a' * 64)
+        experiment.parameters.append(database.Parameter(
+            name='seed', description="Seed", optional=False,
+        ))
+        experiment.parameters.append(database.Parameter(
+            name='size', description="Size", optional=True,
+        ))
+        experiment.paths.append(database.Path(
+            is_input=True, is_output=False, name='data', path='/data.csv',
+        ))
+        upload = database.Upload(experiment=experiment, filename='exp.rpz')
+        db.add(upload)
+        db.commit()
+        self.upload_short_id = upload.short_id
+        db.close()
+
+        super(ViewTestCase, self).setUp()
+        self.addCleanup(self._app.db_executor.shutdown)
+
+    def get_app(self):
+        FakeApplication.test = self
+        with mock.patch('reproserver.web.Application', FakeApplication):
+            return web.make_app(xsrf_cookies=False)
+
+    def get_runs(self):
+        db = self.DBSession()
+        try:
+            return [
+                (
+                    run.batch_id,
+                    {p.name: p.value for p in run.parameter_values},
+                    {f.name: f.hash for f in run.input_files},
+                )
+                for run in db.query(database.Run).order_by(database.Run.id)
+            ]
+        finally:
+            db.close()
+
+
+class TestStartRun(ViewTestCase):
+    def test_input_file(self):
+        body, headers = multipart_body(
+            [('param_seed', '42')],
+            [('inputfile_data', 'data.csv', 'a,b\n1,2\n')],
+        )
+        response = self.fetch(
+            '/run/%s' % self.upload_short_id,
+            method='POST', body=body, headers=headers,
+            follow_redirects=False,
+        )
+        self.assertEqual(response.code, 302)
+
+        # The file was streamed to disk, then uploaded from there
+        filehash = sha256(b'a,b\n1,2\n').hexdigest()
+        upload = self._app.object_store.upload_file_once_async
+        self.assertEqual(upload.call_count, 1)
+        self.assertEqual(upload.call_args[0][:2], ('inputs', filehash))
+        self.assertEqual(
+            self.get_runs(),
+            [(None, {'seed': '42'}, {'data': filehash})],
+        )
+        self.assertEqual(self._app.runner.run.call_count, 1)
+
+    def test_multiple_files(self):
+        body, headers = multipart_body(
+            [('param_seed', '42')],
+            [
+                ('inputfile_data', 'one.csv', 'one'),
+                ('inputfile_data', 'two.csv', 'two'),
+            ],
+        )
+        response = self.fetch(
+            '/run/%s' % self.upload_short_id,
+            method='POST', body=body, headers=headers,
+            follow_redirects=False,
+        )
+        self.assertEqual(response.code, 400)
+        self._app.object_store.upload_file_once_async.assert_not_called()
+        self.assertEqual(self.get_runs(), [])
+
+    def test_fields_too_long(self):
+        # Each field is under the limit, together they are not
+        body, headers = multipart_body(
+            [('param_seed', '42')] +
+            [('extra%d' % i, 'x' * 1024 ** 2) for i in range(2)],
+            [],
+        )
+        response = self.fetch(
+            '/run/%s' % self.upload_short_id,
+            method='POST', body=body, headers=headers,
+            follow_redirects=False,
+        )
+        self.assertEqual(response.code, 400)
+        self.assertEqual(self.get_runs(), [])
+
+
+class TestBatch(ViewTestCase):
+    def start_batch(self, fields, files=()):
+        body, headers = multipart_body(fields, files)
+        headers['Accept'] = 'application/json'
+        return self.fetch(
+            '/run/%s/batch' % self.upload_short_id,
+            method='POST', body=body, headers=headers,
+        )
+
+    def test_product(self):
+        response = self.start_batch(
+            [
+                ('param_seed', '1'), ('param_seed', '2'),
+                ('param_size', 'small'), ('param_size', 'large'),
+            ],
+            [
+                ('inputfile_data', 'one.csv', 'one'),
+                ('inputfile_data', 'two.csv', 'two'),
+            ],
+        )
+        self.assertEqual(response.code, 201)
+        result = json.loads(response.body.decode('utf-8'))
+        self.assertEqual(len(result['runs']), 8)
+        self.assertEqual(self._app.runner.run.call_count, 8)
+
+        one = sha256(b'one').hexdigest()
+        two = sha256(b'two').hexdigest()
+        upload = self._app.object_store.upload_file_once_async
+        self.assertEqual(
+            sorted(call[0][1] for call in upload.call_args_list),
+            sorted([one, two]),
+        )
+        runs = self.get_runs()
+        self.assertEqual(len(set(batch_id for batch_id, _, _ in runs)), 1)
+        self.assertEqual(
+            sorted(
+                (params['seed'], params['size'], inputs['data'])
+                for _, params, inputs in runs
+            ),
+            sorted(
+                (seed, size, data)
+                for seed in ['1', '2']
+                for size in ['small', 'large']
+                for data in [one, two]
+            ),
+        )
+
+    def test_parameter_sets(self):
+        response = self.start_batch([
+            ('param_size', 'small'),
+            ('parameter_sets', json.dumps([
+                {'seed': '1'},
+                {'seed': '2', 'size': 'large'},
+            ])),
+        ])
+        self.assertEqual(response.code, 201)
+        self.assertEqual(
+            [params for _, params, _ in self.get_runs()],
+            [
+                {'seed': '1', 'size': 'small'},
+                {'seed': '2', 'size': 'large'},
+            ],
+        )
+
+        # Missing required parameter
+        response = self.start_batch([
+            ('parameter_sets', json.dumps([{'size': 'small'}])),
+        ])
+        self.assertEqual(response.code, 400)
+        # Unknown parameter
+        response = self.start_batch([
+            ('parameter_sets', json.dumps([{'seed': '1', 'other': '2'}])),
+        ])
+        self.assertEqual(response.code, 400)
+        self.assertEqual(len(self.get_runs()), 2)
+
+    def test_too_many(self):
+        with mock.patch.object(views, 'MAX_BATCH_RUNS', 3):
+            response = self.start_batch(
+                [('param_seed', '1'), ('param_seed', '2')],
+                [
+                    ('inputfile_data', 'one.csv', 'one'),
+                    ('inputfile_data', 'two.csv', 'two'),
+                ],
+            )
+        self.assertEqual(response.code, 400)
+        self.assertEqual(self.get_runs(), [])
+        self._app.object_store.upload_file_once_async.assert_not_called()
+
+    def test_progress(self):
+        response = self.start_batch([
+            ('param_seed', '1'), ('param_seed', '2'),
+            ('param_seed', '3'), ('param_seed', '4'),
+        ])
+        self.assertEqual(response.code, 201)
+        batch_id = json.loads(response.body.decode('utf-8'))['id']
+
+        # Runs: succeeded, failed, running, queued
+        now = datetime.utcnow()
+        db = self.DBSession()
+        runs = db.query(database.Run).order_by(database.Run.id).all()
+        runs[0].started = runs[0].done = now
+        runs[0].success = True
+        runs[1].started = runs[1].done = now
+        runs[1].success = False
+        runs[2].started = now
+        db.commit()
+        db.close()
+
+        response = self.fetch('/batch/%s/json' % batch_id)
+        self.assertEqual(response.code, 200)
+        progress = json.loads(response.body.decode('utf-8'))
+        self.assertEqual(
+            {
+                k: v for k, v in progress.items()
+                if k != 'runs'
+            },
+            {
+                'total': 4, 'queued': 1, 'running': 1,
+                'succeeded': 1, 'failed': 1, 'done': False,
+            },
+        )
+        self.assertEqual(
+            [(run['status'], run['parameters']) for run in progress['runs']],
+            [
+                ('succeeded', {'seed': '1'}),
+                ('failed', {'seed': '2'}),
+                ('running', {'seed': '3'}),
+                ('queued', {'seed': '4'}),
+            ],
+        )
+
+        response = self.fetch('/batch/%s' % batch_id)
+        self.assertEqual(response.code, 200)
+        self.assertIn(
+            b'1 waiting,\n  1 running,\n  1 succeeded,\n  1 failed',
+            response.body,
+        )
+
+
+class TestResultsJson(ViewTestCase):
+    def test_invalid_cursor(self):
+        db = self.DBSession()
+        run = database.Run(experiment_hash='a' * 64)
+        db.add(run)
+        db.commit()
+        run_short_id = run.short_id
+        db.close()
+
+        for log_from in ('-5', 'abc'):
+            response = self.fetch(
+                '/results/%s/json?log_from=%s' % (run_short_id, log_from),
+            )
+            self.assertEqual(response.code, 400)
+        self.assertEqual(self._app.object_store.mock_calls, [])
+
+
+class TestResultsStream(ViewTestCase):
+    def test_invalid_cursor(self):
+        self._app.log_hub = mock.Mock()
+        db = self.DBSession()
+        run = database.Run(experiment_hash='a' * 64)
+        db.add(run)
+        db.commit()
+        run_short_id = run.short_id
+        db.close()
+
+        response = self.fetch(
+            '/results/%s/stream' % run_short_id,
+            headers={'Last-Event-ID': 'abc'},
+        )
+        self.assertEqual(response.code, 400)
+        response = self.fetch(
+            '/results/%s/stream?log_from=1.5' % run_short_id,
+        )
+        self.assertEqual(response.code, 400)
+        response = self.fetch(
+            '/results/%s/stream' % run_short_id,
+            headers={'Last-Event-ID': '-5'},
+        )
+        self.assertEqual(response.code, 400)
+        self._app.log_hub.subscribe.assert_not_called()